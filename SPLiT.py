@@ -19,6 +19,7 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import optparse
+import signal
 import threading
 import sys
 import time
@@ -27,6 +28,8 @@ import utils
 import proxy
 import pnp
 import http
+import metrics
+from profiler import profiler
 
 from pypxe import tftp #PyPXE TFTP service
 from pypxe import dhcp #PyPXE DHCP service
@@ -51,6 +54,20 @@ if __name__ == "__main__":
             help='Specify ip address to bind on (default: 127.0.0.1)')
     opt.add_option('-l', dest='logfile', type='string', default=None,
             help='Specify the log file (default: log to stdout)')
+    opt.add_option('--log-flush-interval', dest='log_flush_interval', type='float', default=0.5,
+            help='Write the logs from a background thread every LOG_FLUSH_INTERVAL seconds, 0 writes them synchronously (default: 0.5)')
+    opt.add_option('--log-queue-size', dest='log_queue_size', type='int', default=10000,
+            help='Max number of log records waiting for the writer thread, the exceeding records are dropped (default: 10000)')
+    opt.add_option('--profile', dest='profile', default=False, action='store_true',
+            help='Profile the services from the start, SIGUSR2 starts and stops the profiler at runtime (default: disabled)')
+    opt.add_option('--profile-mode', dest='profile_mode', type='choice', choices=['cprofile', 'sample'], default='cprofile',
+            help='Profiler mode: cprofile (every call, high overhead) or sample (stack sampling, low overhead) (default: cprofile)')
+    opt.add_option('--profile-interval', dest='profile_interval', type='int', default=10,
+            help='Sampling interval of the sample mode in milliseconds (default: 10)')
+    opt.add_option('--profile-dir', dest='profile_dir', type='string', default='profiles',
+            help='Directory of the profiles, written in pstats format when the profiler stops (default: profiles)')
+    opt.add_option('--metrics-port', dest='metrics_port', type='int', default=0,
+            help='Serve the metrics of all the services in the Prometheus text format on http://<ip>:METRICS_PORT/metrics (default: 0, disabled)')
     
     opt.add_option('--sip-redirect', dest='sip_redirect', default=False, action='store_true',
             help='Act as a redirect server')
@@ -58,10 +75,22 @@ if __name__ == "__main__":
             help='Specify the UDP port (default: 5060)')
     opt.add_option('--sip-log', dest='sip_logfile', type='string', default=None,
             help='Specify the SIP messages log file (default: log to stdout)')
+    opt.add_option('--sip-pcap', dest='sip_pcap', type='string', default=None,
+            help='Write the SIP messages received and sent in this pcap file, readable by Wireshark or sngrep (default: disabled)')
+    opt.add_option('--sip-pcap-size', dest='sip_pcap_size', type='int', default=100,
+            help='Rotate the pcap file when it exceeds SIP_PCAP_SIZE MB (default: 100)')
+    opt.add_option('--sip-pcap-files', dest='sip_pcap_files', type='int', default=5,
+            help='Number of rotated pcap files kept (default: 5)')
     opt.add_option('--sip-expires', dest='sip_expires', type='int', default=3600,
             help='Default registration expires (default: 3600)')
     opt.add_option('--sip-password', dest='sip_password', type='string', default='protected',
             help='Authentication password (default: protected)')
+    opt.add_option('--sip-registrar-file', dest='sip_registrar_file', type='string', default=None,
+            help='Persist the registrations in this file and reload them at startup (default: registrations are kept in memory only)')
+    opt.add_option('--sip-credentials', dest='sip_credentials', type='string', default=None,
+            help='File of "<username> <realm> <HA1>" lines with the users credentials, reloaded on SIGHUP (default: every user authenticates with the --sip-password)')
+    opt.add_option('--sip-nonce-lifetime', dest='sip_nonce_lifetime', type='int', default=300,
+            help='Seconds after which an authentication nonce is stale and must be renewed (default: 300)')
     opt.add_option('--sip-exposedip', dest='sip_exposed_ip', type='string', default=None,
             help='Exposed/Public IP to use into the Record-Route header, default: the local IP')
     opt.add_option('--sip-exposedport', dest='sip_exposed_port', type='int', default=None,
@@ -72,6 +101,32 @@ if __name__ == "__main__":
             help='Request the authentication for the specified requests')
     opt.add_option('--sip-no-record-route', dest='sip_no_record_route', default=False, action='store_true',
             help='Don\'t add the Record-Route header')
+    opt.add_option('--sip-transaction-cache', dest='sip_transaction_cache', type='int', default=10000,
+            help='Answer the request retransmissions from a cache of the last SIP_TRANSACTION_CACHE transactions, 0 disables the cache (default: 10000)')
+    opt.add_option('--sip-dialog-timeout', dest='sip_dialog_timeout', type='int', default=3600,
+            help='Forget the dialogs without requests for SIP_DIALOG_TIMEOUT seconds (default: 3600)')
+    opt.add_option('--sip-tcp', dest='sip_tcp', default=False, action='store_true',
+            help='Accept SIP over TCP on the SIP port too (default: UDP only)')
+    opt.add_option('--sip-tcp-max-connections', dest='sip_tcp_max_connections', type='int', default=1024,
+            help='Max number of open TCP connections (default: 1024)')
+    opt.add_option('--sip-tcp-idle-timeout', dest='sip_tcp_idle_timeout', type='int', default=600,
+            help='Close the TCP connections idle for SIP_TCP_IDLE_TIMEOUT seconds (default: 600)')
+    opt.add_option('--sip-batch-size', dest='sip_batch_size', type='int', default=32,
+            help='Max number of pending SIP datagrams read at every wakeup before handling them, 1 reads one datagram at a time (default: 32)')
+    opt.add_option('--sip-engine', dest='sip_engine', type='choice', choices=['threads', 'eventloop'], default='threads',
+            help='SIP transport engine: threads (SocketServer) or eventloop (single thread event loop) (default: threads)')
+    opt.add_option('--sip-workers', dest='sip_workers', type='int', default=0,
+            help='Run the SIP proxy in SIP_WORKERS processes sharing the SIP port with SO_REUSEPORT, terminal mode only (default: 0, single process)')
+    opt.add_option('--sip-threads', dest='sip_threads', type='int', default=0,
+            help='Handle the SIP messages with a pool of SIP_THREADS worker threads, 0 starts a thread per message (default: 0)')
+    opt.add_option('--sip-queue-size', dest='sip_queue_size', type='int', default=1000,
+            help='Max number of SIP messages waiting for a worker thread (default: 1000)')
+    opt.add_option('--sip-queue-full', dest='sip_queue_full', type='choice', choices=['drop', '503'], default='drop',
+            help='What to do with the requests when the worker queue is full: drop or 503 (default: drop)')
+    opt.add_option('--sip-overload-delay', dest='sip_overload_delay', type='int', default=500,
+            help='Reject the new requests with 503 when the average queueing delay exceeds SIP_OVERLOAD_DELAY milliseconds, 0 disables (default: 500)')
+    opt.add_option('--sip-overload-pending', dest='sip_overload_pending', type='int', default=1000,
+            help='Reject the new requests with 503 when SIP_OVERLOAD_PENDING messages are queued or being handled, 0 disables (default: 1000)')
 
     opt.add_option('--pnp', dest='pnp', default=False, action='store_true',
             help='Enable the PnP server, default: disabled')
@@ -91,6 +146,8 @@ if __name__ == "__main__":
             help='HTTP server root directory (default: http)')
     opt.add_option('--http-port', dest='http_port', default=80, type="int", action='store',
             help='HTTP server port (default: 80)')
+    opt.add_option('--http-metrics', dest='http_metrics', default=False, action='store_true',
+            help='Serve the metrics on /metrics from the HTTP server too, default: disabled')
 
     opt.add_option('--dhcp', dest='dhcp', default=False, action='store_true',
             help='Enable the DHCP server, default: disabled')
@@ -115,15 +172,32 @@ if __name__ == "__main__":
 
     options, args = opt.parse_args(sys.argv[1:])
 
-    main_logger = utils.setup_logger('main_logger', options.logfile, options.debug)
-    sip_logger = utils.setup_logger('sip_logger', options.sip_logfile, options.debug, str_format='%(asctime)s %(message)s')    
+    main_logger = utils.setup_logger('main_logger', options.logfile, options.debug,
+            flush_interval=options.log_flush_interval, queue_size=options.log_queue_size)
+    sip_logger = utils.setup_logger('sip_logger', options.sip_logfile, options.debug, str_format='%(asctime)s %(message)s',
+            flush_interval=options.log_flush_interval, queue_size=options.log_queue_size)
     
+    metrics.register_logs([main_logger, sip_logger])
     main_logger.info("Starting application")
     
     main_logger.debug("SIP: Writing SIP messages in %s log file" % options.sip_logfile)
     main_logger.debug("SIP: Authentication password: %s" % options.sip_password)
+    if options.sip_credentials:
+        main_logger.debug("SIP: Credentials file: %s" % options.sip_credentials)
     main_logger.debug("Logfile: %s" % options.logfile)
 
+    if options.metrics_port:
+        metrics_server = metrics.MetricsServer((options.ip_address, options.metrics_port), logger = main_logger)
+        metrics_server_thread = threading.Thread(name='metrics', target=metrics_server.serve_forever)
+        metrics_server_thread.daemon = True
+        metrics_server_thread.start()
+
+    profiler.configure(options.profile_mode, options.profile_interval / 1000.0, options.profile_dir, main_logger)
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
+    if options.profile:
+        profiler.start()
+
     if not options.terminal:
         try:
 	    import Tkinter as tk
@@ -141,12 +215,21 @@ if __name__ == "__main__":
             root.mainloop()
         except KeyboardInterrupt:
             main_logger.info("Exiting.") 
+        profiler.stop()
     else:
+        # exit cleanly on SIGTERM so that the queued log records are written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         running_services = []
         try:
-            sip_proxy = proxy.SipTracedUDPServer((options.ip_address, options.sip_port), proxy.UDPHandler, sip_logger, main_logger, options)
+            if options.sip_workers > 1:
+                sip_proxy = proxy.SipWorkers(options.sip_workers, proxy.engines[options.sip_engine], (options.ip_address, options.sip_port), proxy.UDPHandler, sip_logger, main_logger, options)
+            else:
+                sip_proxy = proxy.engines[options.sip_engine]((options.ip_address, options.sip_port), proxy.UDPHandler, sip_logger, main_logger, options)
+                profiler.instrument('sip', sip_proxy, 'finish_request')
             sip_proxy_thread = threading.Thread(name='sip', target=sip_proxy.serve_forever)
             sip_proxy_thread.daemon = True
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, lambda signum, frame: sip_proxy.reload_credentials())
         except Exception, e:
             main_logger.error("SIP: Cannot start the proxy: %s" % e)
             raise e
@@ -165,6 +248,7 @@ if __name__ == "__main__":
             if options.pnp:
                 main_logger.info("PnP: Starting server thread")
                 pnp_server = pnp.SipTracedMcastUDPServer(('224.0.1.75', 5060), pnp.UDPHandler, sip_logger, main_logger, options)
+                profiler.instrument('pnp', pnp_server, 'finish_request')
                 pnp_server_thread = threading.Thread(name='pnp', target=pnp_server.serve_forever)
                 pnp_server_thread.daemon = True
                 pnp_server_thread.start()
@@ -173,6 +257,8 @@ if __name__ == "__main__":
             if options.tftp:
                 main_logger.info("TFTP: Starting server thread")
                 tftp_server = tftp.TFTPD(ip = options.ip_address, port = options.tftp_port, mode_debug = options.debug, logger = main_logger, netboot_directory = options.tftp_root)
+                metrics.register_tftp(tftp_server)
+                profiler.instrument('tftp', tftp_server, 'handle_ready')
                 tftp_server_thread = threading.Thread(name='tftp', target=tftp_server.listen)
                 tftp_server_thread.daemon = True
                 tftp_server_thread.start()
@@ -180,7 +266,9 @@ if __name__ == "__main__":
             
             if options.http:
                 main_logger.info("HTTP: Starting server thread")
-                http_server = http.HTTPD(ip = options.ip_address, mode_debug = options.debug, logger = main_logger, port = options.http_port, work_directory = options.http_root)
+                http_server = http.HTTPD(ip = options.ip_address, mode_debug = options.debug, logger = main_logger, port = options.http_port, work_directory = options.http_root,
+                        metrics = metrics.registry if options.http_metrics else None)
+                profiler.instrument('http', http_server.server, 'finish_request')
                 http_server_thread = threading.Thread(name='http', target=http_server.listen)
                 http_server_thread.daemon = True
                 http_server_thread.start()
@@ -198,6 +286,8 @@ if __name__ == "__main__":
                         fileserver = options.dhcp_fileserver,
                         filename = options.dhcp_filename,
                         leases_file = options.dhcp_leasesfile)
+                metrics.register_dhcp(dhcp_server)
+                profiler.instrument('dhcp', dhcp_server, 'handle_message')
                 dhcp_server_thread = threading.Thread(name='dhcp', target=dhcp_server.listen)
                 dhcp_server_thread.daemon = True
                 dhcp_server_thread.start()
@@ -206,5 +296,10 @@ if __name__ == "__main__":
         except KeyboardInterrupt:
             main_logger.info("Exiting.")
         
-        while map(lambda x: x.isAlive(), running_services):
-            time.sleep(1)
+        try:
+            while map(lambda x: x.isAlive(), running_services):
+                time.sleep(1)
+        finally:
+            if sip_proxy_thread.isAlive():
+                sip_proxy.shutdown()
+            profiler.stop()
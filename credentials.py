@@ -0,0 +1,79 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+
+def ha1(username, realm, password):
+    return hashlib.md5("%s:%s:%s" % (username, realm, password)).hexdigest()
+
+class CredentialStore(object):
+    """Digest HA1 (md5 of username:realm:password) of the SIP users
+
+    With a credentials file the users are read from it, one
+    ``<username> <realm> <HA1>`` entry per line, empty lines and lines
+    starting with # are ignored. `load()` reads the file again.
+
+    Without a file every user authenticates with the global `password`,
+    its HA1 is computed once per username and realm and then cached.
+    """
+
+    max_cached = 10000
+
+    def __init__(self, password, path=None, logger=None):
+        self.password = password
+        self.path = path
+        self.logger = logger or logging.getLogger('main_logger')
+        self.entries = {}
+        if self.path:
+            self.load()
+
+    def load(self):
+        """(Re)load the credentials file, the current entries are kept on errors
+        """
+        entries = {}
+        try:
+            with open(self.path) as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    fields = line.split()
+                    if len(fields) != 3 or len(fields[2]) != 32:
+                        self.logger.warning("SIP: %s:%d: invalid credentials entry" % (self.path, lineno))
+                        continue
+                    username, realm, digest = fields
+                    entries[(username, realm)] = digest.lower()
+        except IOError, e:
+            self.logger.error("SIP: Cannot load the credentials file: %s" % e)
+            return False
+        # swap the whole index, lookups from other threads never see a partial load
+        self.entries = entries
+        self.logger.info("SIP: Loaded %d credentials from %s" % (len(entries), self.path))
+        return True
+
+    def lookup(self, username, realm):
+        """Return the HA1 of `username` in `realm`, None for unknown users
+        """
+        digest = self.entries.get((username, realm))
+        if digest is None and not self.path:
+            if len(self.entries) >= self.max_cached:
+                self.entries = {}
+            digest = ha1(username, realm, self.password)
+            self.entries[(username, realm)] = digest
+        return digest
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,146 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from transaction import TIMER_H
+
+# dialog states
+EARLY = "early"
+CONFIRMED = "confirmed"
+TERMINATED = "terminated"
+
+class Dialog(object):
+    """A dialog created by an INVITE forwarded by the proxy
+
+    `caller_route` and `callee_route` are the ``(socket, address)`` next hops
+    towards the two sides of the dialog.
+    """
+
+    __slots__ = ('call_id', 'caller_tag', 'callee_tag', 'caller_route', 'callee_route', 'state', 'last_used')
+
+    def __init__(self, call_id, caller_tag, caller_route, callee_route, now):
+        self.call_id = call_id
+        self.caller_tag = caller_tag
+        self.callee_tag = None
+        self.caller_route = caller_route
+        self.callee_route = callee_route
+        self.state = EARLY
+        self.last_used = now
+
+class DialogTable(object):
+    """Dialogs indexed by Call-ID and caller (From) tag
+
+    The in-dialog requests are routed with a single lookup: a request whose
+    From tag is the caller tag goes to the callee, a request whose To tag is
+    the caller tag goes to the caller.
+
+    The dialogs unused for `idle_timeout` seconds are removed, terminated
+    dialogs are kept `TIMER_H` seconds for the ACK of the final response.
+    Reaping is done by `expire()`, called periodically by the server.
+    """
+
+    def __init__(self, idle_timeout=3600):
+        self.idle_timeout = idle_timeout
+        self.dialogs = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reaped = 0
+
+    def create(self, call_id, caller_tag, caller_route, callee_route, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.dialogs[(call_id, caller_tag)] = Dialog(call_id, caller_tag, caller_route, callee_route, now)
+            self.created += 1
+
+    def find(self, call_id, from_tag, to_tag):
+        """Return the ``(dialog, from_caller)`` pair of an in-dialog request,
+        ``(None, None)`` if the dialog is unknown
+        """
+        dialog = self.dialogs.get((call_id, from_tag))
+        if dialog is not None and (dialog.callee_tag is None or dialog.callee_tag == to_tag):
+            return dialog, True
+        dialog = self.dialogs.get((call_id, to_tag))
+        if dialog is not None and (dialog.callee_tag is None or dialog.callee_tag == from_tag):
+            return dialog, False
+        return None, None
+
+    def route(self, call_id, from_tag, to_tag, now=None):
+        """Return the ``(socket, address)`` next hop of an in-dialog request
+        """
+        dialog, from_caller = self.find(call_id, from_tag, to_tag)
+        if dialog is None:
+            return None
+        dialog.last_used = now or time.time()
+        if from_caller:
+            return dialog.callee_route
+        return dialog.caller_route
+
+    def confirm(self, call_id, caller_tag, callee_tag):
+        """A 2xx response to the INVITE was received
+        """
+        dialog = self.dialogs.get((call_id, caller_tag))
+        if dialog is not None and dialog.state == EARLY:
+            dialog.callee_tag = callee_tag
+            dialog.state = CONFIRMED
+
+    def fail(self, call_id, caller_tag, now=None):
+        """A non-2xx final response to the INVITE was received, a failed
+        re-INVITE doesn't end a confirmed dialog
+        """
+        dialog = self.dialogs.get((call_id, caller_tag))
+        if dialog is not None and dialog.state == EARLY:
+            dialog.state = TERMINATED
+            dialog.last_used = now or time.time()
+
+    def terminate(self, call_id, caller_tag, now=None):
+        dialog = self.dialogs.get((call_id, caller_tag))
+        if dialog is not None and dialog.state != TERMINATED:
+            dialog.state = TERMINATED
+            dialog.last_used = now or time.time()
+
+    def expire(self, now=None):
+        """Remove the idle dialogs and the terminated ones older than `TIMER_H`
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.reap(now)
+
+    def reap(self, now):
+        # called with the lock held
+        idle = now - self.idle_timeout
+        terminated = now - TIMER_H
+        for key, dialog in self.dialogs.items():
+            if dialog.last_used < idle or (dialog.state == TERMINATED and dialog.last_used < terminated):
+                del self.dialogs[key]
+                self.reaped += 1
+
+    def stats(self):
+        """Return the count of early, confirmed and terminated dialogs
+        """
+        counts = {EARLY: 0, CONFIRMED: 0, TERMINATED: 0}
+        with self.lock:
+            for dialog in self.dialogs.values():
+                counts[dialog.state] += 1
+        counts['active'] = counts[EARLY] + counts[CONFIRMED]
+        counts['created'] = self.created
+        counts['reaped'] = self.reaped
+        return counts
+
+    def __len__(self):
+        return len(self.dialogs)
@@ -0,0 +1,239 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A minimal single thread event loop.
+
+The API follows the asyncio one (call_later, add_reader, DatagramProtocol,
+create_datagram_endpoint), asyncio itself is not available on Python 2.
+'''
+
+import errno
+import heapq
+import itertools
+import select
+import socket
+import threading
+import time
+import logging
+
+class TimerHandle(object):
+    """Returned by `EventLoop.call_later()`, can be used to cancel the call
+    """
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+
+    def __init__(self, logger=None):
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.running = False
+        self.stopped = threading.Event()
+        self.stopped.set()
+        self.logger = logger or logging.getLogger('main_logger')
+
+    def time(self):
+        return time.time()
+
+    def call_at(self, when, callback, *args):
+        handle = TimerHandle(when, callback, args)
+        with self.lock:
+            heapq.heappush(self.timers, (when, next(self.counter), handle))
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(0, callback, *args)
+
+    def add_reader(self, fd, callback, *args):
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        return self.readers.pop(fd, None) is not None
+
+    def add_writer(self, fd, callback, *args):
+        self.writers[fd] = (callback, args)
+
+    def remove_writer(self, fd):
+        return self.writers.pop(fd, None) is not None
+
+    def create_datagram_endpoint(self, protocol_factory, sock):
+        """Attach `sock` to the loop, returns the `(transport, protocol)` pair
+        """
+        protocol = protocol_factory()
+        transport = DatagramTransport(self, sock, protocol)
+        protocol.connection_made(transport)
+        return transport, protocol
+
+    def run_timers(self):
+        now = self.time()
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                when, count, handle = heapq.heappop(self.timers)
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception, e:
+                self.logger.exception("Event loop: error in timer %s: %s" % (handle.callback, e))
+
+    def next_timeout(self, poll_interval):
+        with self.lock:
+            if not self.timers:
+                return poll_interval
+            return max(0, min(poll_interval, self.timers[0][0] - self.time()))
+
+    def run_forever(self, poll_interval=0.5):
+        """Run until `stop()` is called
+
+        `poll_interval` is the max time spent in select(), it bounds the
+        latency of the calls scheduled from other threads.
+        """
+        self.running = True
+        self.stopped.clear()
+        try:
+            while self.running:
+                timeout = self.next_timeout(poll_interval)
+                fds = self.readers.keys()
+                wfds = self.writers.keys()
+                if fds or wfds:
+                    try:
+                        readable, writable, _ = select.select(fds, wfds, [], timeout)
+                    except (select.error, ValueError), e:
+                        if isinstance(e, select.error) and e.args[0] == errno.EINTR:
+                            # interrupted by a signal handler
+                            continue
+                        # a socket closed by another thread
+                        if not self.running:
+                            break
+                        raise
+                else:
+                    time.sleep(timeout)
+                    readable = writable = []
+                for fd in writable:
+                    writer = self.writers.get(fd)
+                    if writer:
+                        callback, args = writer
+                        try:
+                            callback(*args)
+                        except Exception, e:
+                            self.logger.exception("Event loop: error in writer %s: %s" % (callback, e))
+                for fd in readable:
+                    reader = self.readers.get(fd)
+                    if reader:
+                        callback, args = reader
+                        try:
+                            callback(*args)
+                        except Exception, e:
+                            self.logger.exception("Event loop: error in reader %s: %s" % (callback, e))
+                self.run_timers()
+        finally:
+            self.running = False
+            self.stopped.set()
+
+    def stop(self, wait=True):
+        self.running = False
+        if wait:
+            self.stopped.wait()
+
+def drain(sock, max_size, max_count):
+    """Return up to `max_count` ``(data, address)`` datagrams already
+    received by `sock`, without blocking
+    """
+    datagrams = []
+    flags = getattr(socket, 'MSG_DONTWAIT', None)
+    if flags is None:
+        return datagrams
+    try:
+        while len(datagrams) < max_count:
+            datagrams.append(sock.recvfrom(max_size, flags))
+    except socket.error, e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+    return datagrams
+
+class DatagramProtocol(object):
+    """Interface for datagram protocols
+    """
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+class DatagramTransport(object):
+    """Datagram transport reading up to `max_batch` datagrams per wakeup
+
+    The pending datagrams are drained with non blocking reads, then passed to
+    the protocol. The batch sizes are counted in the `batch_sizes` histogram
+    if defined, `received` is the time the last batch was read.
+    """
+
+    max_size = 65535
+    max_batch = 1
+    batch_sizes = None
+    received = 0
+
+    def __init__(self, loop, sock, protocol):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.loop.add_reader(sock, self.read_ready)
+
+    def read_ready(self):
+        try:
+            batch = [self.sock.recvfrom(self.max_size)]
+        except Exception, e:
+            self.protocol.error_received(e)
+            return
+        if self.max_batch > 1:
+            batch.extend(drain(self.sock, self.max_size, self.max_batch - 1))
+        self.received = time.time()
+        if self.batch_sizes is not None:
+            self.batch_sizes.observe(len(batch))
+        for data, addr in batch:
+            self.protocol.datagram_received(data, addr)
+
+    def sendto(self, data, addr):
+        return self.sock.sendto(data, addr)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'socket':
+            return self.sock
+        if name == 'sockname':
+            return self.sock.getsockname()
+        return default
+
+    def close(self):
+        self.loop.remove_reader(self.sock)
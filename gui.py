@@ -26,6 +26,8 @@ import utils
 import proxy
 import pnp
 import http
+import metrics
+from profiler import profiler
 
 from pypxe import tftp
 from pypxe import dhcp
@@ -283,7 +285,8 @@ class MainFrame:
         self.main_logger.debug("Logfile: %s" % self.options.logfile)
  
         try:
-            self.sip_proxy = proxy.SipTracedUDPServer((self.options.ip_address, self.options.sip_port), proxy.UDPHandler, self.sip_trace_logger, self.main_logger, self.options)
+            self.sip_proxy = proxy.engines[self.options.sip_engine]((self.options.ip_address, self.options.sip_port), proxy.UDPHandler, self.sip_trace_logger, self.main_logger, self.options)
+            profiler.instrument('sip', self.sip_proxy, 'finish_request')
             self.sip_server_thread = threading.Thread(name='sip', target=self.sip_proxy.serve_forever)
             self.sip_server_thread.daemon = True
             self.sip_server_thread.start()
@@ -302,6 +305,7 @@ class MainFrame:
     def stop_sip_proxy(self):
         self.main_logger.debug("SIP: Stopping thread")
         self.sip_proxy.shutdown()
+        self.sip_proxy.stop_workers()
         self.sip_proxy.socket.close()
         self.sip_proxy = None
         self.main_logger.debug("SIP: Stopped thread")
@@ -316,6 +320,8 @@ class MainFrame:
         self.main_logger.debug("TFTP Server port: %s", self.options.tftp_port)
         try:
             self.tftp_server = tftp.TFTPD(ip = self.options.ip_address, port = self.options.tftp_port, mode_debug = self.options.debug, logger = self.main_logger, netboot_directory = self.options.tftp_root)
+            metrics.register_tftp(self.tftp_server)
+            profiler.instrument('tftp', self.tftp_server, 'handle_ready')
             self.tftp_server_thread = threading.Thread(name='tftp', target=self.tftp_server.listen)
             self.tftp_server_thread.daemon = True
             self.tftp_server_thread.start()           
@@ -353,6 +359,8 @@ class MainFrame:
                         fileserver = self.options.dhcp_fileserver,
                         filename = self.options.dhcp_filename,
                         leases_file = self.options.dhcp_leasesfile)
+            metrics.register_dhcp(self.dhcp_server)
+            profiler.instrument('dhcp', self.dhcp_server, 'handle_message')
             self.dhcp_server_thread = threading.Thread(name='dhcp', target=self.dhcp_server.listen)
             self.dhcp_server_thread.daemon = True
             self.dhcp_server_thread.start()
@@ -376,7 +384,9 @@ class MainFrame:
         
         self.main_logger.debug("HTTP Server port: %s", self.options.http_port)
         try:
-            self.http_server = http.HTTPD(ip = self.options.ip_address, mode_debug = self.options.debug, port = self.options.http_port, logger = self.main_logger, work_directory = self.options.http_root)
+            self.http_server = http.HTTPD(ip = self.options.ip_address, mode_debug = self.options.debug, port = self.options.http_port, logger = self.main_logger, work_directory = self.options.http_root,
+                    metrics = metrics.registry if self.options.http_metrics else None)
+            profiler.instrument('http', self.http_server.server, 'finish_request')
             self.http_server_thread = threading.Thread(name='http', target=self.http_server.listen)
             self.http_server_thread.daemon = True
             self.http_server_thread.start()           
@@ -402,6 +412,7 @@ class MainFrame:
  
         try:
             self.pnp_server = pnp.SipTracedMcastUDPServer(('224.0.1.75', 5060), pnp.UDPHandler, self.sip_trace_logger, self.main_logger, self.options)
+            profiler.instrument('pnp', self.pnp_server, 'finish_request')
             self.pnp_server_thread = threading.Thread(name='pnp', target=self.pnp_server.serve_forever)
             self.pnp_server_thread.daemon = True
             self.pnp_server_thread.start()
@@ -413,6 +424,7 @@ class MainFrame:
     def stop_pnp_server(self):
         self.main_logger.debug("PnP: Stopping thread")
         self.pnp_server.shutdown()
+        self.pnp_server.stop_workers()
         self.pnp_server.socket.close()
         self.pnp_server = None
         self.main_logger.debug("PnP: Stopped thread")
@@ -10,6 +10,8 @@ import threading
 import posixpath
 import urllib
 
+import metrics
+
 try:
     # Python 2.x
     from SocketServer import ThreadingMixIn
@@ -24,9 +26,10 @@ class HTTPDThreadedServer(ThreadingMixIn, HTTPServer):
 
     allow_reuse_address = True
 
-    def __init__(self, server_address, RequestHandlerClass, logger, path):
+    def __init__(self, server_address, RequestHandlerClass, logger, path, metrics=None):
         self.logger = logger
         self.path = path
+        self.metrics = metrics
         HTTPServer.__init__(self, server_address, RequestHandlerClass)
 
     def shutdown(self):
@@ -35,8 +38,25 @@ class HTTPDThreadedServer(ThreadingMixIn, HTTPServer):
         HTTPServer.shutdown(self)
     
 
+http_requests = metrics.registry.counter("http_requests_total", "HTTP responses sent", ("code",))
+
 class MySimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
 
+    def do_GET(self):
+        if self.server.metrics is not None and self.path.split('?', 1)[0] == '/metrics':
+            body = self.server.metrics.render()
+            self.send_response(200)
+            self.send_header("Content-Type", metrics.CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_response(self, code, message=None):
+        http_requests.inc(str(code))
+        SimpleHTTPRequestHandler.send_response(self, code, message)
+
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax.
 
@@ -77,9 +97,10 @@ class HTTPD():
         self.work_directory = serverSettings.get('work_directory', '.')
         self.mode_debug = serverSettings.get('mode_debug', False) #debug mode
         self.logger =  serverSettings.get('logger', None)
+        self.metrics = serverSettings.get('metrics', None) # registry served on /metrics
 
         handler = MySimpleHTTPRequestHandler
-        self.server = HTTPDThreadedServer((self.ip, self.port), handler, self.logger, self.work_directory)
+        self.server = HTTPDThreadedServer((self.ip, self.port), handler, self.logger, self.work_directory, self.metrics)
  
         # setup logger
         if self.logger == None:
@@ -0,0 +1,266 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Metrics of all the services in the Prometheus text format.
+
+The metrics are created from the module `registry` and updated by the
+services, the values owned by other objects (registrar size, TFTP transfers)
+are read at every scrape by the callbacks registered with
+`Registry.callback()`. `Registry.render()` returns the exposition text
+served by the HTTP server on /metrics or by `MetricsServer`.
+'''
+
+import threading
+import logging
+
+try:
+    # Python 2.x
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    # Python 3.x
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# seconds
+LATENCY_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+def format_labels(names, values, extra=""):
+    labels = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(labels)
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+class Counter(object):
+    """Monotonic counter, one value per tuple of label values
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *values, **kwargs):
+        """Add `amount` (default 1) to the counter with the label `values`
+        """
+        amount = kwargs.get('amount', 1)
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def get(self, *values):
+        return self.values.get(values, 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for values, value in items:
+            yield self.name, format_labels(self.labels, values), value
+
+class Gauge(Counter):
+
+    type = "gauge"
+
+    def set(self, value, *values):
+        with self.lock:
+            self.values[values] = value
+
+class Histogram(object):
+    """Cumulative histogram of the observed values with the bucket upper `bounds`
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), bounds=LATENCY_BOUNDS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = tuple(bounds)
+        # label values -> [bucket counts..., sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *values):
+        with self.lock:
+            entry = self.values.get(values)
+            if entry is None:
+                entry = self.values[values] = [0] * (len(self.bounds) + 2)
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            else:
+                entry[-2] += 1
+            entry[-1] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((values, list(entry)) for values, entry in self.values.items())
+        for values, entry in items:
+            count = 0
+            for bound, n in zip(self.bounds + (float("inf"),), entry):
+                count += n
+                yield self.name + "_bucket", format_labels(self.labels, values, 'le="%s"' % format_value(float(bound))), count
+            yield self.name + "_sum", format_labels(self.labels, values), entry[-1]
+            yield self.name + "_count", format_labels(self.labels, values), count
+
+class Callback(object):
+    """Metric read at every scrape from `function`, returning the value or
+    a ``{label values: value}`` dict
+    """
+
+    def __init__(self, name, help, type, function, labels=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.function = function
+        self.labels = labels
+
+    def samples(self):
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for values, v in sorted(value.items()):
+            yield self.name, format_labels(self.labels, values), v
+
+class Registry(object):
+    """The metrics by name, creating a metric already registered returns the
+    existing one
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, Callback):
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), bounds=LATENCY_BOUNDS):
+        return self.register(Histogram(name, help, labels, bounds))
+
+    def callback(self, name, help, function, type="gauge", labels=()):
+        """Register `function` as the source of the `name` metric, replacing
+        the previous one
+        """
+        return self.register(Callback(name, help, type, function, labels))
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            try:
+                samples = list(metric.samples())
+            except Exception, e:
+                logging.getLogger('main_logger').warning("Cannot read the %s metric: %s" % (name, e))
+                continue
+            lines.append("# HELP %s %s" % (name, metric.help))
+            lines.append("# TYPE %s %s" % (name, metric.type))
+            for sample, labels, value in samples:
+                lines.append("%s%s %s" % (sample, labels, format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+registry = Registry()
+
+def register_tftp(server, registry=registry):
+    """Read the TFTP metrics from the `server` stats
+    """
+    registry.callback("tftp_transfers_active", "TFTP transfers in progress", lambda: server.stats()['active'])
+    registry.callback("tftp_transfers_total", "TFTP transfers started", lambda: server.stats()['transfers'], type="counter")
+    registry.callback("tftp_sent_bytes_total", "TFTP file bytes sent", lambda: server.stats()['bytes_sent'], type="counter")
+
+def register_dhcp(server, registry=registry):
+    """Read the DHCP metrics from the `server` stats
+    """
+    registry.callback("dhcp_offers_total", "DHCP offers sent", lambda: server.stats()['offers'], type="counter")
+    registry.callback("dhcp_acks_total", "DHCP acks sent", lambda: server.stats()['acks'], type="counter")
+
+def register_pool(service, server, registry=registry):
+    """Read the worker pool metrics of `service` from the `server` pool stats
+    """
+    stats = server.pool_stats
+    registry.callback("%s_worker_queue_depth" % service, "%s requests waiting for a worker thread" % service.upper(),
+            lambda: stats().get('queue_depth', 0))
+    registry.callback("%s_worker_queue_max_depth" % service, "%s max requests seen waiting for a worker thread" % service.upper(),
+            lambda: stats().get('queue_max_depth', 0))
+    registry.callback("%s_worker_queue_dropped_total" % service, "%s requests dropped with the worker queue full" % service.upper(),
+            lambda: stats().get('dropped', 0), type="counter")
+    registry.callback("%s_worker_queue_rejected_total" % service, "%s requests rejected with 503 with the worker queue full" % service.upper(),
+            lambda: stats().get('rejected', 0), type="counter")
+
+def register_logs(loggers, registry=registry):
+    """Read the queue metrics of the background log writers of `loggers`,
+    labelled by logger name
+    """
+    handlers = [(logger.name, handler) for logger in loggers for handler in logger.handlers if hasattr(handler, 'stats')]
+    def read(key):
+        return lambda: dict(((name,), handler.stats()[key]) for name, handler in handlers)
+    registry.callback("log_queue_depth", "Log records waiting for the writer thread", read('queue_depth'), labels=("logger",))
+    registry.callback("log_queue_max_depth", "Max log records seen waiting for the writer thread", read('queue_max_depth'), labels=("logger",))
+    registry.callback("log_records_written_total", "Log records written", read('written'), type="counter", labels=("logger",))
+    registry.callback("log_records_dropped_total", "Log records dropped with the queue full", read('dropped'), type="counter", labels=("logger",))
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("Metrics: %s - %s" % (self.client_address[0], format % args))
+
+class MetricsServer(HTTPServer):
+    """Dedicated HTTP server answering GET /metrics, one scrape at a time
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, registry=registry, logger=None):
+        self.registry = registry
+        self.logger = logger or logging.getLogger('main_logger')
+        HTTPServer.__init__(self, server_address, MetricsRequestHandler)
+        self.logger.info("NOTICE: Metrics server starting on %s:%d" % server_address)
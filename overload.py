@@ -0,0 +1,174 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import random
+import re
+import threading
+import time
+import logging
+
+rx_to_tag = re.compile("^(?:to|t)[ \t]*:[^\r\n]*;[ \t]*tag=", re.I | re.M)
+
+# overload levels
+NORMAL = 0
+SHED_PRIORITY = 1 # new INVITE and REGISTER are rejected
+SHED_NEW = 2 # every out of dialog request is rejected
+
+level_names = {
+    NORMAL: "normal",
+    SHED_PRIORITY: "shedding new INVITE/REGISTER",
+    SHED_NEW: "shedding all new requests",
+}
+
+# requests always admitted: they belong to a transaction or dialog already accepted
+always_admitted = ("ACK", "CANCEL", "BYE", "PRACK")
+# requests shed first
+priority_shed = ("INVITE", "REGISTER")
+
+class OverloadControl(object):
+    """Admission control based on the queueing delay and the pending requests
+
+    The load is the max of the queueing delay (time between the reception of
+    a message and the start of its handling, averaged) over `max_delay` and of
+    the pending messages (being handled or queued) over `max_pending`. With a
+    load of 1 the new INVITE and REGISTER requests are rejected, with a load
+    of 2 all the requests out of a dialog are. Responses and in-dialog
+    requests are always admitted, as the retransmissions of the requests
+    already admitted when `retransmission(data, source)` is defined and
+    returns True for them. The level goes back to normal when the load falls
+    under 0.8.
+
+    The averaged delay decays with a `half_life` so it recovers even when no
+    request is admitted.
+    """
+
+    alpha = 0.1
+    half_life = 1.0
+    max_retry_after = 60
+
+    def __init__(self, max_delay=0.5, max_pending=1000, logger=None, retransmission=None):
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.retransmission = retransmission
+        self.logger = logger or logging.getLogger('main_logger')
+        self.lock = threading.Lock()
+        self.level = NORMAL
+        self.delay = 0.0
+        self.service_time = 0.0
+        self.last_update = time.time()
+        self.inflight = 0
+        self.admitted = 0
+        self.shed = {}
+
+    def current_delay(self, now=None):
+        if now is None:
+            now = time.time()
+        return self.delay * 0.5 ** ((now - self.last_update) / self.half_life)
+
+    def load(self, queue_depth=0):
+        delay = self.current_delay()
+        load = 0
+        if self.max_delay:
+            load = delay / self.max_delay
+        if self.max_pending:
+            load = max(load, float(self.inflight + queue_depth) / self.max_pending)
+        return load
+
+    def update_level(self, queue_depth=0):
+        load = self.load(queue_depth)
+        level = self.level
+        if load >= 2:
+            level = SHED_NEW
+        elif load >= 1:
+            if level == NORMAL or load < 1.6:
+                level = SHED_PRIORITY
+        elif load < 0.8:
+            level = NORMAL
+        if level != self.level:
+            if level > self.level:
+                self.logger.warning("SIP: Overload: %s (delay %d ms, %d pending)" % (level_names[level], self.delay * 1000, self.inflight + queue_depth))
+            else:
+                self.logger.info("SIP: Overload: %s" % level_names[level])
+            self.level = level
+        return level
+
+    def admit(self, data, queue_depth=0, source=None):
+        """Check if the message `data` received from `source` can be handled
+
+        Returns None if admitted, else the Retry-After seconds for the 503.
+        """
+        if self.update_level(queue_depth) == NORMAL:
+            self.admitted += 1
+            return None
+        method = data[:data.find(" ")]
+        if method == "SIP/2.0" or method in always_admitted:
+            self.admitted += 1
+            return None
+        if self.level == SHED_PRIORITY and method not in priority_shed:
+            self.admitted += 1
+            return None
+        end = data.find("\r\n\r\n")
+        if rx_to_tag.search(data, 0, end if end >= 0 else len(data)):
+            # in-dialog request
+            self.admitted += 1
+            return None
+        if self.retransmission is not None and self.retransmission(data, source):
+            # the request is already being handled
+            self.admitted += 1
+            return None
+        with self.lock:
+            self.shed[method] = self.shed.get(method, 0) + 1
+        return self.retry_after(queue_depth)
+
+    def retry_after(self, queue_depth=0):
+        """Seconds needed to drain the pending messages, with a random spread
+        so that the rejected clients don't come back all together
+        """
+        drain = (self.inflight + queue_depth) * self.service_time + self.delay
+        retry = max(1, int(math.ceil(drain * 2)))
+        retry += random.randint(0, retry)
+        return min(retry, self.max_retry_after)
+
+    def started(self, delay):
+        now = time.time()
+        with self.lock:
+            decay = 0.5 ** ((now - self.last_update) / self.half_life)
+            self.delay = self.delay * decay * (1 - self.alpha) + delay * self.alpha
+            self.last_update = now
+            self.inflight += 1
+        return now
+
+    def finished(self, started):
+        duration = time.time() - started
+        with self.lock:
+            self.inflight -= 1
+            self.service_time = self.service_time * (1 - self.alpha) + duration * self.alpha
+
+    def stats(self):
+        """Return the overload level and signals and the shed requests per method
+        """
+        stats = {
+            'level': self.level,
+            'state': level_names[self.level],
+            'delay_ms': self.current_delay() * 1000,
+            'service_time_ms': self.service_time * 1000,
+            'inflight': self.inflight,
+            'admitted': self.admitted,
+            'shed': sum(self.shed.values()),
+        }
+        for method, count in self.shed.items():
+            stats['shed_%s' % method] = count
+        return stats
@@ -0,0 +1,175 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+SIP messages trace in the pcap format, readable by Wireshark, tshark or sngrep.
+
+Every message is written as an Ethernet/IPv4/UDP packet built from its real
+source and destination addresses and ports, the payload is the message as
+received or sent. The records are kept in a buffer written to the file when
+it is full or at least every `flush_interval` seconds by a background thread,
+the file is rotated when it exceeds `max_size` bytes keeping `backups` old
+files (trace.pcap.1, ...).
+'''
+
+import os
+import socket
+import struct
+import threading
+import time
+import logging
+
+MAGIC = 0xa1b2c3d4
+LINKTYPE_ETHERNET = 1
+SNAPLEN = 65535
+
+# file header: magic, version 2.4, GMT offset, timestamps accuracy, snaplen, link type
+file_header = struct.pack("<IHHiIII", MAGIC, 2, 4, 0, 0, SNAPLEN, LINKTYPE_ETHERNET)
+# fake MAC addresses and the IPv4 ethertype
+ethernet_header = "\x02\x00\x00\x00\x00\x02" "\x02\x00\x00\x00\x00\x01" "\x08\x00"
+# IPv4: version and header length, TOS, total length, id, DF flag, TTL,
+# protocol, checksum, source, destination
+ip_header = struct.Struct("!BBHHHBBH4s4s")
+# UDP: ports, length, no checksum
+udp_header = struct.Struct("!HHHH")
+# seconds, microseconds, captured and original length
+record_header = struct.Struct("<IIII")
+HEADERS_SIZE = len(ethernet_header) + ip_header.size + udp_header.size
+
+def ip_checksum(header):
+    words = struct.unpack("!10H", header)
+    total = sum(words)
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+class PcapWriter(object):
+    """Buffered and rotated pcap file of UDP datagrams, safe to share between threads
+    """
+
+    def __init__(self, path, max_size=100 * 1024 * 1024, backups=5, buffer_size=256 * 1024, flush_interval=1.0, logger=None):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.logger = logger or logging.getLogger('main_logger')
+        self.lock = threading.Lock()
+        self.addresses = {}
+        self.ident = 0
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.packets = 0
+        self.errors = 0
+        self.file = None
+        self.last_flush = time.time()
+        self.open()
+        self.flusher = threading.Thread(name='pcap-writer', target=self.flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def open(self):
+        self.file = open(self.path, "wb")
+        self.file.write(file_header)
+        self.size = len(file_header)
+
+    def address(self, ip):
+        packed = self.addresses.get(ip)
+        if packed is None:
+            try:
+                packed = socket.inet_aton(ip)
+            except socket.error:
+                packed = "\x00\x00\x00\x00"
+            self.addresses[ip] = packed
+        return packed
+
+    def write(self, data, source, destination, timestamp=None):
+        """Add the `data` datagram sent from the `source` to the `destination`
+        ``(ip, port)`` address
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        length = len(data)
+        if length + HEADERS_SIZE > SNAPLEN:
+            data = data[:SNAPLEN - HEADERS_SIZE]
+            length = len(data)
+        with self.lock:
+            if self.file is None:
+                return
+            self.ident = (self.ident + 1) & 0xffff
+            ip = ip_header.pack(0x45, 0, length + 28, self.ident, 0x4000, 64, socket.IPPROTO_UDP, 0,
+                    self.address(source[0]), self.address(destination[0]))
+            ip = ip[:10] + struct.pack("!H", ip_checksum(ip)) + ip[12:]
+            size = length + HEADERS_SIZE
+            self.buffer.append(record_header.pack(int(timestamp), int((timestamp % 1) * 1000000), size, size))
+            self.buffer.append(ethernet_header)
+            self.buffer.append(ip)
+            self.buffer.append(udp_header.pack(source[1], destination[1], length + 8, 0))
+            self.buffer.append(data)
+            self.buffered += size + record_header.size
+            self.packets += 1
+            if self.buffered >= self.buffer_size:
+                self.flush_buffer()
+
+    def flush_buffer(self):
+        if self.buffered and self.size + self.buffered > self.max_size and self.size > len(file_header):
+            self.rotate()
+        try:
+            self.file.write("".join(self.buffer))
+            self.file.flush()
+            self.size += self.buffered
+            self.written += self.buffered
+        except (IOError, OSError), e:
+            self.errors += 1
+            self.logger.error("SIP: Cannot write the pcap trace %s: %s" % (self.path, e))
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.time()
+
+    def rotate(self):
+        self.file.close()
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                name = "%s.%d" % (self.path, i)
+                if os.path.exists(name):
+                    os.rename(name, "%s.%d" % (self.path, i + 1))
+            if self.backups > 0:
+                os.rename(self.path, "%s.1" % self.path)
+        except OSError, e:
+            self.logger.error("SIP: Cannot rotate the pcap trace %s: %s" % (self.path, e))
+        self.open()
+
+    def flush_loop(self):
+        while self.file is not None:
+            time.sleep(self.flush_interval)
+            if time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None and self.buffered:
+                self.flush_buffer()
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.flush_buffer()
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {'packets': self.packets, 'bytes': self.written, 'errors': self.errors}
@@ -20,6 +20,10 @@ import socket
 import sys
 import errno
 import platform
+import logging
+
+import utils
+import metrics
 
 # Regexp matching SIP messages:
 rx_subscribe = re.compile("^SUBSCRIBE")
@@ -38,20 +42,6 @@ rx_cvia = re.compile("^v:")
 rx_contact = re.compile("^Contact:")
 rx_ccontact = re.compile("^m:")
 
-def hexdump( chars, sep, width ):
-    """Dump chars in hex and ascii format
-    """
-    data = []
-    while chars:
-        line = chars[:width]
-        chars = chars[width:]
-        line = line.ljust( width, '\000' )
-        data.append("%s%s%s" % ( sep.join( "%02x" % ord(c) for c in line ),sep, quotechars( line )))
-    return data
-
-def quotechars( chars ):
-	return ''.join( ['.', c][c.isalnum()] for c in chars )
-
 class pnp_phone(object):
     """Basic representation of a snom phone."""
 
@@ -76,13 +66,17 @@ class pnp_phone(object):
         n =  "%s:%s:%s:%s:%s:%s" % (m[0:2], m[2:4], m[4:6], m[6:8], m[8:10], m[10:])
         return n
 
-class SipTracedMcastUDPServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
+class SipTracedMcastUDPServer(utils.WorkerPoolMixIn, SocketServer.UDPServer):
+    # max hex dumps of non-SIP datagrams per second
+    dump_rate = 10
+
     def __init__(self, server_address, RequestHandlerClass, sip_logger, main_logger, options):
         # don't let the parent bind.
         SocketServer.UDPServer.__init__(self,(server_address[0], server_address[1]), RequestHandlerClass, bind_and_activate=False)
         self.sip_logger = sip_logger
         self.main_logger = main_logger
         self.options = options
+        self.dumps = utils.RateLimit(self.dump_rate)
        
         self.main_logger.info("NOTICE: PnP Server starting on %s:%d and %s:%d." % (server_address[0], server_address[1], self.options.ip_address, self.options.sip_port))
 
@@ -101,6 +95,14 @@ class SipTracedMcastUDPServer(SocketServer.ThreadingMixIn, SocketServer.UDPServe
             self.socket.bind((server_address[0], server_address[1]))
         self.server_address = self.socket.getsockname()
 
+        if getattr(options, 'sip_threads', 0) > 0:
+            self.start_workers(options.sip_threads, options.sip_queue_size, "drop", name="pnp-worker")
+            metrics.register_pool("pnp", self)
+
+    def verify_request(self, request, client_address):
+        # drop the keep-alives before handing them to a thread
+        return not utils.is_keepalive(request[0])
+
 class UDPHandler(SocketServer.BaseRequestHandler):   
 
     def sendTo(self, data, client_address):
@@ -247,11 +249,12 @@ class UDPHandler(SocketServer.BaseRequestHandler):
         if rx_request_uri.search(request_uri) or rx_code.search(request_uri):
             self.server.sip_logger.debug("Received from %s:%d (%d bytes):\n\n%s" %  (self.client_address[0], self.client_address[1], len(data), data))
             self.processRequest()
-        else:
-            if len(data) > 4:
-                self.server.sip_logger.debug("Received from %s:%d (%d bytes):\n\n" %  (self.client_address[0], self.client_address[1], len(data)))
-                mess = hexdump(data,' ',16)
-                self.server.sip_logger.debug('PnP Hex data:\n' + '\n'.join(mess))
+        elif self.server.sip_logger.isEnabledFor(logging.DEBUG) and self.server.dumps.allow():
+            suppressed = self.server.dumps.take_suppressed()
+            if suppressed:
+                self.server.sip_logger.debug("PnP: %d non-SIP datagrams not dumped" % suppressed)
+            self.server.sip_logger.debug("Received from %s:%d (%d bytes):\n\n" %  (self.client_address[0], self.client_address[1], len(data)))
+            self.server.sip_logger.debug('PnP Hex data:\n' + '\n'.join(utils.hexdump(data, ' ', 16)))
 
 if __name__ == '__main__':
     import utils
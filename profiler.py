@@ -0,0 +1,238 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+On-demand CPU profiling of the services.
+
+The per-message entry points of every service (`finish_request` of the
+SocketServer based services, the handlers of the DHCP and TFTP loops) are
+wrapped by `Profiler.instrument()` with the name of the service. While the
+profiler is stopped the wrappers only check a flag.
+
+Two modes are available:
+
+- cprofile: every call is run under a cProfile profiler, one per thread
+  running the service at the same time, so the thread pool and the thread
+  per request models are both supported. The overhead is high.
+- sample: a thread looks at the stacks of the threads inside the wrapped
+  calls every `interval` seconds. The overhead is low, the call counts in
+  the snapshots are sample counts and the times are estimates.
+
+`stop()` writes a pstats file per service in `directory`, to be read with
+`python -m pstats <file>` or any pstats viewer.
+'''
+
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import logging
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+MODES = ("cprofile", "sample")
+
+class Profiler(object):
+
+    def __init__(self, mode="cprofile", interval=0.01, directory="profiles", logger=None):
+        self.configure(mode, interval, directory, logger)
+        self.active = False
+        self.lock = threading.Lock()
+        self.started = None
+        # cprofile mode: service -> [profiles], and the profiles not in use
+        self.profiles = {}
+        self.idle = {}
+        # sample mode: thread ident -> service, service -> {stack: samples}
+        self.threads = {}
+        self.samples = {}
+        self.sampler = None
+        self.wrapper_codes = set()
+
+    def configure(self, mode=None, interval=None, directory=None, logger=None):
+        if mode is not None:
+            if mode not in MODES:
+                raise ValueError("Unknown profiling mode: %s" % mode)
+            self.mode = mode
+        if interval is not None:
+            self.interval = interval
+        if directory is not None:
+            self.directory = directory
+        if logger is not None:
+            self.logger = logger
+        elif not hasattr(self, 'logger'):
+            self.logger = logging.getLogger('main_logger')
+
+    def instrument(self, service, obj, *names):
+        """Replace the `names` methods of `obj` with wrappers profiling them
+        as part of `service`
+        """
+        for name in names:
+            setattr(obj, name, self.wrap(service, getattr(obj, name)))
+
+    def wrap(self, service, function):
+        def profiled(*args, **kwargs):
+            if not self.active:
+                return function(*args, **kwargs)
+            if self.mode == "sample":
+                ident = get_ident()
+                if ident in self.threads:
+                    return function(*args, **kwargs)
+                self.threads[ident] = service
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.threads.pop(ident, None)
+            profile = self.acquire(service)
+            if profile is None:
+                # nested call, already profiled
+                return function(*args, **kwargs)
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.release(service, profile)
+        self.wrapper_codes.add(profiled.func_code)
+        return profiled
+
+    def acquire(self, service):
+        ident = get_ident()
+        with self.lock:
+            if ident in self.threads:
+                return None
+            self.threads[ident] = service
+            idle = self.idle.setdefault(service, [])
+            if idle:
+                return idle.pop()
+            profile = cProfile.Profile()
+            self.profiles.setdefault(service, []).append(profile)
+            return profile
+
+    def release(self, service, profile):
+        with self.lock:
+            self.threads.pop(get_ident(), None)
+            if profile in self.profiles.get(service, ()):
+                self.idle[service].append(profile)
+
+    def start(self):
+        if self.active:
+            return
+        self.profiles = {}
+        self.idle = {}
+        self.samples = {}
+        self.threads = {}
+        self.started = time.time()
+        self.active = True
+        if self.mode == "sample":
+            self.sampler = threading.Thread(name='profiler', target=self.sample_loop)
+            self.sampler.daemon = True
+            self.sampler.start()
+        self.logger.info("Profiler: started in %s mode" % self.mode)
+
+    def stop(self):
+        """Stop profiling and write the snapshots, return their file names
+        """
+        if not self.active:
+            return []
+        self.active = False
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+        try:
+            files = self.write_snapshots()
+        except (IOError, OSError), e:
+            self.logger.error("Profiler: cannot write the snapshots: %s" % e)
+            return []
+        if files:
+            self.logger.info("Profiler: stopped, snapshots written: %s" % ", ".join(files))
+        else:
+            self.logger.info("Profiler: stopped, no service call profiled")
+        return files
+
+    def toggle(self):
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+    def sample_loop(self):
+        while self.active:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, service in self.threads.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and frame.f_code not in self.wrapper_codes:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if stack:
+                    counts = self.samples.setdefault(service, {})
+                    stack = tuple(stack)
+                    counts[stack] = counts.get(stack, 0) + 1
+
+    def sample_stats(self, counts):
+        """Build the pstats data of the sampled stacks (innermost call first)
+        """
+        stats = {}
+        for stack, n in counts.items():
+            elapsed = n * self.interval
+            seen = set()
+            for i, function in enumerate(stack):
+                entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+                if i == 0:
+                    entry[2] += elapsed
+                if function in seen:
+                    continue
+                seen.add(function)
+                entry[0] += n
+                entry[1] += n
+                entry[3] += elapsed
+                if i + 1 < len(stack):
+                    caller = entry[4].setdefault(stack[i + 1], [0, 0, 0.0, 0.0])
+                    caller[0] += n
+                    caller[1] += n
+                    caller[3] += elapsed
+                    if i == 0:
+                        caller[2] += elapsed
+        return dict((function, (cc, nc, tt, ct, dict((k, tuple(v)) for k, v in callers.items())))
+                for function, (cc, nc, tt, ct, callers) in stats.items())
+
+    def write_snapshots(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        label = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        files = []
+        if self.mode == "sample":
+            services = self.samples.items()
+        else:
+            services = self.profiles.items()
+        for service, data in sorted(services):
+            path = os.path.join(self.directory, "%s-%s-%s.pstats" % (service, self.mode, label))
+            if self.mode == "sample":
+                with open(path, "wb") as f:
+                    marshal.dump(self.sample_stats(data), f)
+            else:
+                pstats.Stats(*data).dump_stats(path)
+            files.append(path)
+        return files
+
+profiler = Profiler()
@@ -23,119 +23,552 @@ import socket
 import sys
 import time
 import hashlib
-import random
+import logging
+import hmac
+import os
+import multiprocessing
+import signal
+
+import utils
+import eventloop
+import metrics
+import tcp
+from sipmessage import SipMessage
+from registrar import Registrar
+from credentials import CredentialStore
+from transaction import TransactionCache
+from dialog import DialogTable
+from overload import OverloadControl
+from pcap import PcapWriter
 
 # Regexp matching SIP messages:
-rx_register = re.compile("^REGISTER")
-rx_invite = re.compile("^INVITE")
-rx_ack = re.compile("^ACK")
-rx_prack = re.compile("^PRACK")
-rx_cancel = re.compile("^CANCEL")
-rx_bye = re.compile("^BYE")
-rx_options = re.compile("^OPTIONS")
-rx_subscribe = re.compile("^SUBSCRIBE")
-rx_publish = re.compile("^PUBLISH")
-rx_notify = re.compile("^NOTIFY")
-rx_info = re.compile("^INFO")
-rx_message = re.compile("^MESSAGE")
-rx_refer = re.compile("^REFER")
-rx_update = re.compile("^UPDATE")
-rx_from = re.compile("^From:")
-rx_cfrom = re.compile("^f:")
-rx_to = re.compile("^To:")
-rx_cto = re.compile("^t:")
 rx_tag = re.compile(";tag=(.*)")
-rx_contact = re.compile("^Contact:")
-rx_ccontact = re.compile("^m:")
-rx_useragent = re.compile("^User-Agent:")
-rx_contentdisposition = re.compile("^Content-Disposition:")
-rx_supported = re.compile("^Supported:")
-rx_sessionexpires = re.compile("^Session-Expires:")
-rx_maxforward = re.compile("^Max-Forwards:")
 rx_uri_with_params = re.compile("sip:([^@]*)@([^;>$]*)")
 rx_uri = re.compile("sip:([^@]*)@([^>$]*)")
 rx_addr = re.compile("sip:([^ ;>$]*)")
 #rx_addrport = re.compile("([^:]*):(.*)")
-rx_code = re.compile("^SIP/2.0 ([^ ]*)")
 #rx_invalid = re.compile("^192\.168")
 #rx_invalid2 = re.compile("^10\.")
 #rx_cseq = re.compile("^CSeq:")
 #rx_callid = re.compile("Call-ID: (.*)$")
 #rx_rr = re.compile("^Record-Route:")
-rx_request_uri = re.compile("^([^ ]*) sip:([^ ]*?)(;.*)* SIP/2.0")
-rx_route = re.compile("^Route: (.*)")
-rx_record_route = re.compile("^Record-Route:")
-rx_contentlength = re.compile("^Content-Length:")
-rx_ccontentlength = re.compile("^l:")
-rx_contenttype = re.compile("^Content-Type:")
-rx_via = re.compile("^Via:")
-rx_cvia = re.compile("^v:")
 rx_branch = re.compile(";branch=([^;]*)")
+rx_top_branch = re.compile("^(?:via|v)[ \t]*:[^\r\n]*?;[ \t]*branch=([^;, \t\r\n]+)", re.I | re.M)
 rx_rport = re.compile(";rport$|;rport;")
+rx_via_sent_by = re.compile("SIP/2.0/([^ \t]+)[ \t]+([^;:, \t]+)(?::([0-9]+))?")
+rx_via_received = re.compile(";[ \t]*received=([^;, \t]+)")
+rx_via_rport = re.compile(";[ \t]*rport=([0-9]+)")
 rx_contact_expires = re.compile("expires=([^;$]*)")
-rx_expires = re.compile("^Expires: (.*)$")
-rx_authorization = re.compile("^Authorization: +\S{6} (.*)")
-rx_proxy_authorization = re.compile("^Proxy-Authorization: +\S{6} (.*)")
+rx_credentials = re.compile("^\S+ +(.*)")
 rx_kv= re.compile("([^=]*)=(.*)")
 
 local_tag = '123456-SPLiT'
 
-def hexdump( chars, sep, width ):
-    """Dump chars in hex and ascii format
+# checkAuthorization() results
+AUTH_OK = "ok"
+AUTH_FAILED = "failed"
+AUTH_STALE = "stale"
+# realm of the digest challenges
+AUTH_REALM = "dummy"
+
+# Request handlers, keyed by SIP method
+request_handlers = {
+    "REGISTER": "processRegister",
+    "INVITE": "processInvite",
+    "ACK": "processAck",
+    "BYE": "processGenericRequest",
+    "CANCEL": "processGenericRequest",
+    "OPTIONS": "processGenericRequest",
+    "MESSAGE": "processGenericRequest",
+    "REFER": "processGenericRequest",
+    "PRACK": "processGenericRequest",
+    "UPDATE": "processGenericRequest",
+    "INFO": "processGenericRequest",
+    "SUBSCRIBE": "processGenericRequest",
+    "PUBLISH": "processPublish",
+    "NOTIFY": "processGenericRequest",
+}
+
+sip_requests = metrics.registry.counter("sip_requests_total", "SIP requests received", ("method",))
+sip_responses = metrics.registry.counter("sip_responses_total", "SIP responses received", ("method", "code"))
+sip_duration = metrics.registry.histogram("sip_request_duration_seconds", "Time spent handling the SIP requests", ("method",))
+sip_auth_challenges = metrics.registry.counter("sip_auth_challenges_total", "SIP digest challenges sent", ("header",))
+sip_auth_results = metrics.registry.counter("sip_auth_results_total", "SIP digest credentials checked", ("result",))
+sip_keepalives = metrics.registry.counter("sip_keepalives_total", "SIP keep-alives received")
+
+def generateNonce(secret, timestamp=None):
+    """Return a stateless nonce: the hex timestamp followed by the HMAC of
+    the timestamp keyed with the server `secret`
+
+    The nonce is not bound to an AOR, so the phones can reuse it for the
+    requests to any destination.
     """
-    data = []
-    while chars:
-        line = chars[:width]
-        chars = chars[width:]
-        line = line.ljust( width, '\000' )
-        data.append("%s%s%s" % ( sep.join( "%02x" % ord(c) for c in line ),sep, quotechars( line )))
-    return data
-
-def quotechars( chars ):
-	return ''.join( ['.', c][c.isalnum()] for c in chars )
-
-def generateNonce(n, str="0123456789abcdef"):
-    nonce = ""
-    for i in range(n):
-        a = int(random.uniform(0,len(str)))
-        nonce += str[a]
-    return nonce
+    if timestamp is None:
+        timestamp = int(time.time())
+    ts = "%08x" % timestamp
+    return ts + hmac.new(secret, ts, hashlib.sha1).hexdigest()
+
+def checkNonce(secret, nonce, lifetime):
+    """Check a nonce built by `generateNonce()`
+
+    Returns AUTH_OK, AUTH_STALE if the nonce is older than `lifetime` seconds
+    or AUTH_FAILED if it wasn't issued by this server.
+    """
+    try:
+        timestamp = int(nonce[:8], 16)
+    except ValueError:
+        return AUTH_FAILED
+    if not hmac.compare_digest(generateNonce(secret, timestamp), nonce):
+        return AUTH_FAILED
+    if timestamp + lifetime < time.time():
+        return AUTH_STALE
+    return AUTH_OK
     
-class SipTracedUDPServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
-    def __init__(self, server_address, RequestHandlerClass, sip_logger, main_logger, options):
+def addReceived(line, client_address, rport=False):
+    """Add the received (and rport) parameters to a Via header line, with
+    `rport` the rport parameter is added even if the client didn't ask it
+    """
+    # rport processing
+    if rx_rport.search(line):
+        text = "received=%s;rport=%d" % client_address
+        return line.replace("rport",text)
+    elif rport:
+        return "%s;received=%s;rport=%d" % (line, client_address[0], client_address[1])
+    else:
+        text = "received=%s" % client_address[0]
+        return "%s;%s" % (line,text)
+
+def viaAddress(via):
+    """Return the transport and the ``(host, port)`` address the responses
+    to the `via` header value are sent to: the received and rport
+    parameters, else the sent-by, as in RFC 3261 18.2.2 and RFC 3581
+    """
+    md = rx_via_sent_by.match(via)
+    if not md:
+        return None
+    transport, host, port = md.groups()
+    # the first value of a comma separated list
+    comma = via.find(",", md.end())
+    if comma >= 0:
+        via = via[:comma]
+    md = rx_via_received.search(via)
+    if md:
+        host = md.group(1)
+    md = rx_via_rport.search(via)
+    if md:
+        port = md.group(1)
+    return transport.upper(), (host, int(port or 5060))
+
+def buildResponse(msg, code, client_address, headers=()):
+    """Build the text of a `code` response to the `msg` request, with the
+    additional `headers` lines
+    """
+    response = msg.copy()
+    response.set_start_line("SIP/2.0 " + code)
+    response.body = ""
+    for pos in response.positions("To"):
+        line = response.headers[pos][1]
+        if not rx_tag.search(line):
+            response.replace_at(pos, "%s%s" % (line,";tag=%s" % local_tag))
+    positions = response.positions("Via")
+    if positions:
+        response.replace_at(positions[0], addReceived(response.headers[positions[0]][1], client_address))
+    for pos in response.positions("Content-Length"):
+        if response.headers[pos][1][:2].lower() == "l:":
+            response.replace_at(pos, "l: 0")
+        else:
+            response.replace_at(pos, "Content-Length: 0")
+    for header in headers:
+        response.append(header)
+    return response.serialize()
+
+def is_authenticated(function):
+    def _is_authenticated(self, method, uri, code):
+        self.debug("SIP: Request %s received, checking auth", method)
+
+        # remove Authorization header for response
+        proxy_auth = self.getAuthorization("Proxy-Authorization", "Authorization")
+
+        result = None
+        if len(proxy_auth)> 0:
+            # the caller authenticates
+            result = self.checkAuthorization(proxy_auth, self.getOrigin(), method=method)
+            sip_auth_results.inc(result)
+            if result == AUTH_FAILED:
+                self.debug("SIP: Authentication failure")
+                self.removeContact()
+                self.sendResponse("403 Forbidden")
+                return
+        if result != AUTH_OK:
+            self.debug("SIP: Requesting authentication")
+            self.removeContact()
+            self.sendChallenge("Proxy-Authenticate", stale=(result == AUTH_STALE))
+            return
+        self.debug("SIP: Request authenticated")
+        return function(self, method, uri, code)
+    return _is_authenticated
+
+class HeaderRules(object):
+    """The --sip-customheader rules, parsed and compiled once
+
+    Every rule is ``<method>:<URI-regex>:<SIP-Header>``, the method ``*``
+    matches every method. The rules are indexed by method, each method gets
+    its own rules and the wildcard ones in configuration order, the methods
+    without their own rules use the wildcard list.
+    """
+
+    def __init__(self, rules, logger):
+        self.by_method = {}
+        self.wildcard = []
+        compiled = []
+        for full_header in rules:
+            fields = full_header.split(':', 2)
+            if len(fields) < 3:
+                logger.error("SIP: Invalid custom header value: '%s'" % full_header)
+                continue
+            method, uri_r, header = fields
+            try:
+                rx = re.compile(uri_r)
+            except re.error:
+                logger.error("SIP: Invalid regex: '%s'" % uri_r)
+                continue
+            compiled.append((method.upper(), uri_r, rx, header))
+        for rule in compiled:
+            if rule[0] == '*':
+                self.wildcard.append(rule)
+            else:
+                self.by_method.setdefault(rule[0], [])
+        for method, method_rules in self.by_method.items():
+            method_rules.extend([rule for rule in compiled if rule[0] in (method, '*')])
+
+    def methods(self):
+        """Return the methods with rules, '*' if any rule applies to all the methods
+        """
+        methods = set(self.by_method.keys())
+        if self.wildcard:
+            methods.add('*')
+        return methods
+
+    def match(self, method, uri):
+        """Return the headers to add to a `method` request for `uri`
+        """
+        headers = []
+        for rule_method, uri_r, rx, header in self.by_method.get(method, self.wildcard):
+            if rx.match(uri):
+                headers.append((uri_r, header))
+        return headers
+
+def add_headers(function):
+    def _add_headers(self, method, uri, code):
+        for uri_r, header in self.server.header_rules.match(method, uri):
+            self.debug("SIP: Matched custom header regex '%s' against '%s' URI", uri_r, uri)
+            self.debug("SIP: Adding header '%s'", header)
+            self.msg.insert(1, header)
+        return function(self, method, uri, code)
+    return _add_headers
+
+def build_dispatch(handler, options, header_rules):
+    """Build the method dispatch table.
+
+    Returns a dict mapping the first token of the start line (the method,
+    or "SIP/2.0" for responses) to the handler chain for that method:
+    authentication, custom headers and redirect mode are decided here once,
+    according to `options`, instead of on every request.
+    """
+    header_methods = header_rules.methods()
+    dispatch = {}
+    for method, name in request_handlers.items():
+        if method in ("REGISTER", "PUBLISH"):
+            dispatch[method] = getattr(handler, name)
+            continue
+        if options.sip_redirect:
+            if method == "INVITE":
+                name = "redirectInvite"
+            elif method == "ACK":
+                name = "redirectIgnore"
+            else:
+                name = "redirectNotAllowed"
+        chain = getattr(handler, name)
+        if method in header_methods or '*' in header_methods:
+            chain = add_headers(chain)
+        if method in options.authenticated_requests:
+            chain = is_authenticated(chain)
+        dispatch[method] = chain
+    if options.sip_redirect:
+        dispatch["SIP/2.0"] = getattr(handler, "redirectIgnore")
+    else:
+        dispatch["SIP/2.0"] = getattr(handler, "processCode")
+    return dispatch
+
+def proxyHeaders(server_address, options):
+    """Return the Record-Route header and the top Via value used by the proxy
+    """
+    recordroute = None
+    if not options.sip_no_record_route:
+        if options.sip_exposed_ip:
+            rr_ip = options.sip_exposed_ip
+        else:
+            rr_ip = server_address[0]
+        if options.sip_exposed_port:
+            rr_port = options.sip_exposed_port
+        else:
+            rr_port = server_address[1]
+        recordroute = "Record-Route: <sip:%s:%d;lr>" % (rr_ip, rr_port)
+    topvia_value = "SIP/2.0/UDP %s:%d" % (server_address[0], server_address[1])
+    return recordroute, topvia_value
+
+class SipTracedUDPServer(utils.WorkerPoolMixIn, SocketServer.UDPServer):
+    use_workers = True
+    # max hex dumps of non-SIP datagrams per second
+    dump_rate = 10
+
+    def __init__(self, server_address, RequestHandlerClass, sip_logger, main_logger, options, registrar=None, nonce_secret=None, reuse_port=False):
+        """`registrar` can be a dict-like object shared with other processes,
+        `nonce_secret` is the key signing the nonces (random if not defined),
+        `reuse_port` binds the socket with SO_REUSEPORT
+        """
         self.allow_reuse_address = True
+        self.reuse_port = reuse_port
         SocketServer.UDPServer.__init__(self, server_address, RequestHandlerClass)
         self.sip_logger = sip_logger
         self.main_logger = main_logger
         self.options = options
        
         self.allow_reuse_address = True
-        self.registrar = {}
-        self.auth = {}
-        if not self.options.sip_no_record_route:
-            if self.options.sip_exposed_ip:
-                rr_ip = self.options.sip_exposed_ip
-            else:
-                rr_ip = server_address[0]
-            if self.options.sip_exposed_port:
-                rr_port = self.options.sip_exposed_port
-            else:
-                rr_port = server_address[1]
-            self.recordroute = "Record-Route: <sip:%s:%d;lr>" % (rr_ip, rr_port)
-        self.topvia = "Via: SIP/2.0/UDP %s:%d" % (server_address[0], server_address[1])
+        # the sockets can't be shared between processes
+        self.shared_registrar = registrar is not None
+        if nonce_secret is None:
+            nonce_secret = os.urandom(20)
+        # with a shared registrar the journal is written by SipWorkers
+        self.registrar = Registrar(registrar, main_logger, journal=None if self.shared_registrar else options.sip_registrar_file)
+        self.nonce_secret = nonce_secret
+        if options.sip_transaction_cache > 0:
+            self.transactions = TransactionCache(options.sip_transaction_cache)
+        else:
+            self.transactions = None
+        self.dialogs = DialogTable(options.sip_dialog_timeout)
+        # the idle dialogs are reaped by the registrar expiry tick
+        self.registrar.on_tick = self.dialogs.expire
+        self.credentials = CredentialStore(options.sip_password, options.sip_credentials, main_logger)
+        self.recordroute, self.topvia_value = proxyHeaders(server_address, options)
+        self.topvia = "Via: %s" % self.topvia_value
+        self.topvia_tcp = self.topvia.replace("/UDP ", "/TCP ")
+        self.topvia_values = (self.topvia_value, self.topvia_tcp[5:])
+        self.header_rules = HeaderRules(options.sip_custom_headers, main_logger)
+        self.dispatch = build_dispatch(RequestHandlerClass, self.options, self.header_rules)
+        self.batch_sizes = utils.Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.dumps = utils.RateLimit(self.dump_rate)
+        self.overload = None
+        if options.sip_overload_delay > 0 or options.sip_overload_pending > 0:
+            self.overload = OverloadControl(options.sip_overload_delay / 1000.0, options.sip_overload_pending, main_logger,
+                    retransmission=self.is_retransmission if self.transactions is not None else None)
+        self.pcap = None
+        if options.sip_pcap:
+            self.pcap = self.create_pcap()
+        self.tcp = None
+        if options.sip_tcp:
+            self.tcp = self.create_tcp_server()
+        self.register_metrics()
+        if self.use_workers and self.options.sip_threads > 0:
+            self.main_logger.info("SIP: Using %d worker threads, queue size %d" % (self.options.sip_threads, self.options.sip_queue_size))
+            self.start_workers(self.options.sip_threads, self.options.sip_queue_size, self.options.sip_queue_full, name="sip-worker")
         self.main_logger.info("NOTICE: SIP Proxy starting on %s:%d" % (server_address[0], server_address[1]))
         #self.main_logger.debug("SIP: Config dump: %s" % self.options)
 
+    def register_metrics(self):
+        metrics.registry.callback("sip_registrar_bindings", "SIP bindings in the registrar", lambda: len(self.registrar))
+        metrics.registry.callback("sip_registrar_expired_total", "SIP bindings removed at their expiry", lambda: self.registrar.stats()['expired'], type="counter")
+        metrics.registry.callback("sip_registrar_refreshed_total", "SIP registrations refreshing a valid binding", lambda: self.registrar.stats()['refreshed'], type="counter")
+        metrics.registry.callback("sip_dialogs", "SIP dialogs early or confirmed, not the terminated ones kept for the retransmissions", lambda: self.dialogs.stats()['active'])
+        if self.overload is not None:
+            metrics.registry.callback("sip_overload_level", "SIP overload level, 0 normal, 1 shedding new INVITE/REGISTER, 2 shedding all new requests",
+                    lambda: self.overload.level)
+            metrics.registry.callback("sip_overload_shed_total", "SIP requests rejected by the overload control",
+                    lambda: dict(((method,), count) for method, count in self.overload.shed.items()), type="counter", labels=("method",))
+        if self.use_workers and self.options.sip_threads > 0:
+            metrics.register_pool("sip", self)
+        if self.tcp is not None:
+            metrics.registry.callback("sip_tcp_connections", "SIP TCP connections open", lambda: len(self.tcp.connections))
+
+    def create_pcap(self):
+        path = self.options.sip_pcap
+        if self.shared_registrar:
+            # a file per worker process
+            root, ext = os.path.splitext(path)
+            path = "%s-%d%s" % (root, os.getpid(), ext)
+        self.main_logger.info("SIP: Writing the SIP messages in the %s pcap file" % path)
+        return PcapWriter(path, self.options.sip_pcap_size * 1024 * 1024, self.options.sip_pcap_files, logger=self.main_logger)
+
+    def create_tcp_server(self, loop=None):
+        server = tcp.SipTCPServer(self.server_address, self.process_stream_message, self.main_logger,
+                max_connections=self.options.sip_tcp_max_connections, idle_timeout=self.options.sip_tcp_idle_timeout, loop=loop)
+        self.main_logger.info("NOTICE: SIP Proxy accepting TCP connections on %s:%d" % self.server_address)
+        return server
+
+    def _handle_request_noblock(self):
+        """Read all the pending datagrams, up to --sip-batch-size, then handle them
+        """
+        try:
+            request, client_address = self.get_request()
+        except socket.error:
+            return
+        batch = [(request, client_address)]
+        if self.options.sip_batch_size > 1:
+            try:
+                for data, client_address in eventloop.drain(self.socket, self.max_packet_size, self.options.sip_batch_size - 1):
+                    batch.append(((data, self.socket), client_address))
+            except socket.error, e:
+                self.main_logger.warning("SIP: Error receiving data: %s" % e)
+        self.batch_sizes.observe(len(batch))
+        for request, client_address in batch:
+            if self.verify_request(request, client_address):
+                try:
+                    self.process_request(request, client_address)
+                except:
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+
+    def process_stream_message(self, data, connection):
+        """Handle a SIP message received on a TCP `connection`
+        """
+        self.process_request((data, connection), connection.address)
+
+    def process_request(self, request, client_address):
+        """Answer the keep-alives, pass the admission control then schedule
+        the request, the admitted requests carry their arrival time
+        """
+        if utils.is_keepalive(request[0]):
+            self.keepalive(request, client_address)
+            return
+        if self.overload is not None:
+            retry_after = self.overload.admit(request[0], self.queue_depth(), client_address)
+            if retry_after is not None:
+                self.reject_request(request, client_address, retry_after)
+                return
+            request = (request[0], request[1], self.arrival_time(request))
+        self.schedule_request(request, client_address)
+
+    def schedule_request(self, request, client_address):
+        utils.WorkerPoolMixIn.process_request(self, request, client_address)
+
+    def is_retransmission(self, data, client_address):
+        """True if the `data` request is in the transaction cache, checked on
+        the raw message before shedding it
+        """
+        end = data.find("\r\n\r\n")
+        md = rx_top_branch.search(data, 0, end if end >= 0 else len(data))
+        if not md:
+            return False
+        key = self.transactions.key(md.group(1), data[:data.find(" ")], client_address)
+        return key is not None and self.transactions.contains(key, data)
+
+    def keepalive(self, request, client_address):
+        """Answer a CRLF ping with a CRLF pong, drop the other probes
+        """
+        sip_keepalives.inc()
+        if request[0] == "\r\n\r\n" and request[1] is self.socket:
+            try:
+                self.socket.sendto("\r\n", client_address)
+            except socket.error, e:
+                self.main_logger.warning("SIP: Cannot answer the keep-alive of %s:%d: %s" % (client_address[0], client_address[1], e))
+
+    def finish_request(self, request, client_address):
+        if len(request) < 3:
+            return SocketServer.UDPServer.finish_request(self, request, client_address)
+        started = self.overload.started(time.time() - request[2])
+        try:
+            SocketServer.UDPServer.finish_request(self, request, client_address)
+        finally:
+            self.overload.finished(started)
+
+    def arrival_time(self, request):
+        return time.time()
+
+    def queue_depth(self):
+        if self.workers:
+            return self.requests_queue.qsize()
+        return 0
+
+    def serve_forever(self, poll_interval=0.5):
+        self.registrar.start()
+        if self.tcp:
+            self.tcp.start()
+        SocketServer.UDPServer.serve_forever(self, poll_interval)
+
+    def shutdown(self):
+        self.registrar.stop()
+        # an instance restarted from the GUI loads the journal written here
+        self.registrar.close()
+        if self.tcp:
+            self.tcp.close()
+        SocketServer.UDPServer.shutdown(self)
+        if self.pcap:
+            self.pcap.close()
+        self.main_logger.info("SIP: Datagram batch sizes: %s" % self.batch_sizes)
+        if self.workers:
+            self.main_logger.info("SIP: Worker pool: %(workers)d workers, queue %(queue_depth)d/%(queue_size)d, max depth %(queue_max_depth)d, %(dropped)d dropped, %(rejected)d rejected" % self.pool_stats())
+
+    def reload_credentials(self):
+        return self.credentials.load() if self.credentials.path else False
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        SocketServer.UDPServer.server_bind(self)
+
+    def reject_request(self, request, client_address, retry_after=None):
+        data, sock = request[:2]
+        msg = SipMessage(data)
+        if not msg.is_request() or msg.method == "ACK":
+            return
+        headers = ()
+        if retry_after is not None:
+            headers = ("Retry-After: %d" % retry_after,)
+        text = buildResponse(msg, "503 Service Unavailable", client_address, headers)
+        sock.sendto(text, client_address)
+        if self.pcap is not None:
+            self.pcap.write(text, self.server_address, client_address)
+
 class UDPHandler(SocketServer.BaseRequestHandler):   
 
+    # log levels, checked once per message by handle()
+    log_debug = False
+    log_trace = False
+    # transaction cache key of the request being handled
+    transaction = None
+
+    def debug(self, msg, *args):
+        """Log on the main logger at debug level, `msg` is formatted with
+        `args` only if debug logging is enabled
+        """
+        if self.log_debug:
+            self.server.main_logger.debug(msg, *args)
+
+    def trace(self, msg, *args):
+        """Log the SIP messages on the SIP logger at debug level
+        """
+        if self.log_trace:
+            self.server.sip_logger.debug(msg, *args)
+
     def debugRegister(self):
-        self.server.main_logger.debug("SIP: *** REGISTRAR ***")
-        self.server.main_logger.debug("SIP: *****************")
+        if not self.log_debug:
+            return
+        self.debug("SIP: *** REGISTRAR ***")
+        self.debug("SIP: *****************")
         for key in self.server.registrar.keys():
-            self.server.main_logger.debug("SIP: %s -> %s" % (key,self.server.registrar[key][0]))
-        self.server.main_logger.debug("SIP: *****************")
+            self.debug("SIP: %s -> %s", key,self.server.registrar[key][0])
+        self.debug("SIP: Bindings: %(active)d active, %(expired)d expired, %(refreshed)d refreshed", self.server.registrar.stats())
+        self.debug("SIP: *****************")
 
-    def checkAuthorization(self, authorization, password, nonce, method="REGISTER"):
+    def checkAuthorization(self, authorization, aor, method="REGISTER"):
+        """Check the digest `authorization` credentials of `aor` against the
+        HA1 in the credential store, the username must be the user of `aor`
+        and the realm the challenged one
+
+        Returns AUTH_OK, AUTH_FAILED or AUTH_STALE when the credentials are
+        right but the nonce is expired or not issued by this server, so that
+        the client gets a new challenge.
+        """
         hash = {}
         list = authorization.split(",")
         for elem in list:
@@ -144,251 +577,309 @@ class UDPHandler(SocketServer.BaseRequestHandler):
                 value = string.strip(md.group(2),'" ')
                 key = string.strip(md.group(1))
                 hash[key]=value
-        # check nonce (response/request)
-        if hash["nonce"] != nonce:
-            self.server.main_logger.warning("SIP: Authentication: Incorrect nonce")
-            return False
+        try:
+            nonce = hash["nonce"]
+            username = hash["username"]
+            realm = hash["realm"]
+            a2="%s:%s" % (method, hash["uri"])
+            response = hash["response"]
+        except KeyError, e:
+            self.server.main_logger.warning("SIP: Authentication: missing %s parameter" % e)
+            return AUTH_FAILED
+        if username != aor.split("@", 1)[0]:
+            self.server.main_logger.warning("SIP: Authentication: user %s can't authenticate as %s" % (username, aor))
+            return AUTH_FAILED
+        if realm != AUTH_REALM:
+            self.server.main_logger.warning("SIP: Authentication: wrong realm %s" % realm)
+            return AUTH_FAILED
+        ha1 = self.server.credentials.lookup(username, realm)
+        if ha1 is None:
+            self.server.main_logger.warning("SIP: Authentication: unknown user %s in realm %s" % (username, realm))
+            return AUTH_FAILED
 
-        a1="%s:%s:%s" % (hash["username"],hash["realm"], password)
-        a2="%s:%s" % (method, hash["uri"])
-        ha1 = hashlib.md5(a1).hexdigest()
         ha2 = hashlib.md5(a2).hexdigest()
         b = "%s:%s:%s" % (ha1,nonce,ha2)
         expected = hashlib.md5(b).hexdigest()
-        if expected == hash["response"]:
-            self.server.main_logger.debug("SIP: Authentication: succeeded")
-            return True
+        if hmac.compare_digest(expected, response):
+            # check nonce (response/request)
+            nonce_status = checkNonce(self.server.nonce_secret, nonce, self.server.options.sip_nonce_lifetime)
+            if nonce_status == AUTH_FAILED:
+                self.server.main_logger.warning("SIP: Authentication: Incorrect nonce, sending a new challenge")
+                return AUTH_STALE
+            if nonce_status == AUTH_STALE:
+                self.debug("SIP: Authentication: stale nonce")
+                return AUTH_STALE
+            self.debug("SIP: Authentication: succeeded")
+            return AUTH_OK
         self.server.main_logger.warning("SIP: Authentication: expected= %s" % expected)
-        self.server.main_logger.warning("SIP: Authentication: response= %s" % hash["response"])
-        return False
+        self.server.main_logger.warning("SIP: Authentication: response= %s" % response)
+        return AUTH_FAILED
 
-    def changeRequestUri(self):
-        # change request uri
-        md = rx_request_uri.search(self.data[0])
-        if md:
-            method = md.group(1)
-            uri = md.group(2)
-            if self.server.registrar.has_key(uri):
-                uri = "sip:%s" % self.server.registrar[uri][0]
-                self.server.main_logger.debug("SIP: changeRequestUri: %s -> %s" % ( self.data[0] , "%s %s SIP/2.0" % (method,uri)))
-                self.data[0] = "%s %s SIP/2.0" % (method,uri)
+    def sendChallenge(self, header, stale=False):
+        """Reply with a 401 containing a digest challenge in the `header` header
+        """
+        nonce = generateNonce(self.server.nonce_secret)
+        challenge = "%s: Digest realm=\"%s\", nonce=\"%s\"" % (header, AUTH_REALM, nonce)
+        if stale:
+            challenge += ", stale=true"
+        self.msg.insert(5, challenge)
+        sip_auth_challenges.inc(header)
+        self.sendResponse("401 Unauthorized")
+
+    def changeRequestUri(self, binding):
+        # change request uri to the contact of the destination `binding`
+        if self.msg.uri is not None:
+            method = self.msg.method
+            uri = self.msg.uri
+            if binding is not None:
+                uri = "sip:%s" % binding[0]
+                self.debug("SIP: changeRequestUri: %s -> %s %s SIP/2.0", self.msg.start_line, method, uri)
+                self.msg.set_start_line("%s %s SIP/2.0" % (method,uri))
             else:
-                self.server.main_logger.debug("SIP: URI not found in Registrar: %s leaving the URI unchanged" % uri)
+                self.debug("SIP: URI not found in Registrar: %s leaving the URI unchanged", uri)
 
-    def removeHeader(self, regex, data=None):
+    def removeHeader(self, name):
         """
         remove a SIP header.
-        - `regex`contains the regex to extract the header
-        - if `data` is defined the `regex`is searched into data, otherwise in self.data
+        - `name` is the header name, compact forms are matched too
         """
-        if data == None:
-            read_data = self.data
-        else:
-            read_data = data
-        self.server.main_logger.debug("SIP: Removing header with regex %s" % regex.pattern)
-        data = []
-        for line in read_data:
-            if not regex.search(line):
-                data.append(line)
-            else:
-                self.server.main_logger.debug("SIP: Removed %s" % line)
-        return data
+        self.debug("SIP: Removing header %s", name)
+        for line in self.msg.remove(name):
+            self.debug("SIP: Removed %s", line)
 
-    def removeMaxForward(self, data=None):
-        return self.removeHeader(rx_maxforward, data)
+    def removeMaxForward(self):
+        self.removeHeader("Max-Forwards")
 
-    def removeRouteHeader(self, data=None):
-        return self.removeHeader(rx_route, data)
+    def removeRouteHeader(self):
+        self.removeHeader("Route")
 
-    def removeRecordRouteHeader(self, data=None):
-        return self.removeHeader(rx_record_route, data)
+    def removeRecordRouteHeader(self):
+        self.removeHeader("Record-Route")
 
-    def removeContact(self, data=None):
-        return self.removeHeader(rx_contact, data)
+    def removeContact(self):
+        self.removeHeader("Contact")
 
-    def removeContentType(self, data=None):
-        return self.removeHeader(rx_contenttype, data)
+    def removeContentType(self):
+        self.removeHeader("Content-Type")
     
-    def removeUserAgent(self, data=None):
-        return self.removeHeader(rx_useragent, data)
+    def removeUserAgent(self):
+        self.removeHeader("User-Agent")
     
-    def removeSessionExpires(self, data=None):
-        return self.removeHeader(rx_sessionexpires, data)
+    def removeSessionExpires(self):
+        self.removeHeader("Session-Expires")
 
-    def removeSupported(self, data=None):
-        return self.removeHeader(rx_supported, data)
+    def removeSupported(self):
+        self.removeHeader("Supported")
     
     def removeContentDisposition(self):
-        return self.removeHeader(rx_contentdisposition)
-
-    def addTopVia(self):
-        branch= ""
-        data = []
-        for line in self.data:
-            if rx_via.search(line) or rx_cvia.search(line):
-                md = rx_branch.search(line)
-                if md:
-                    branch=md.group(1)
-                    via = "%s;branch=%s" % (self.server.topvia, branch)
-                    data.append(via)
-                    self.server.main_logger.debug("SIP: Adding Top Via header: %s" % via)
-                # rport processing
-                if rx_rport.search(line):
-                    text = "received=%s;rport=%d" % self.client_address
-                    via = line.replace("rport",text)   
-                else:
-                    text = "received=%s" % self.client_address[0]
-                    via = "%s;%s" % (line,text)
-                self.server.main_logger.debug("SIP: Adding Top Via header: %s" % via)
-                data.append(via)
+        self.removeHeader("Content-Disposition")
+
+    def viaReceived(self, line):
+        # over TCP the responses go back on the connection of the request,
+        # received and rport identify it among those from the same host
+        return addReceived(line, self.client_address, getattr(self.socket, 'transport', "UDP") == "TCP")
+
+    def addTopVia(self, socket=None):
+        """Add the proxy Via, with the transport of `socket`, on top of the
+        request Via which gets the received parameter
+        """
+        positions = self.msg.positions("Via")
+        if not positions:
+            return
+        pos = positions[0]
+        line = self.msg.headers[pos][1]
+        via = self.viaReceived(line)
+        self.debug("SIP: Adding Top Via header: %s", via)
+        self.msg.replace_at(pos, via)
+        md = rx_branch.search(line)
+        if md:
+            branch=md.group(1)
+            if getattr(socket, 'transport', "UDP") == "TCP":
+                topvia = self.server.topvia_tcp
             else:
-                data.append(line)
-        return data
+                topvia = self.server.topvia
+            via = "%s;branch=%s" % (topvia, branch)
+            self.debug("SIP: Adding Top Via header: %s", via)
+            self.msg.insert(pos, via)
                 
     def removeTopVia(self):
-        data = []
-        for line in self.data:
-            if rx_via.search(line) or rx_cvia.search(line):
-                if not line.startswith(self.server.topvia):
-                    data.append(line)
-            else:
-                data.append(line)
-        return data
-        
-    def checkValidity(self,uri):
-        addrport, socket, client_addr, validity = self.server.registrar[uri]
-        now = int(time.time())
-        if validity > now:
-            return True
+        """Remove the proxy Via, returns False if the top Via is not the proxy one
+        """
+        positions = self.msg.positions("Via")
+        if not positions:
+            return False
+        name, line, value = self.msg.headers[positions[0]]
+        for topvia in self.server.topvia_values:
+            # the whole sent-by: 10.0.0.1:5060 is not 10.0.0.1:50601
+            if value.startswith(topvia) and value[len(topvia):len(topvia) + 1] in ("", ";", ",", " ", "\t"):
+                break
         else:
-            del self.server.registrar[uri]
-            self.server.main_logger.warning("SIP: Registration for %s has expired" % uri)
             return False
-    
-    def getSocketInfo(self,uri):
-        addrport, socket, client_addr, validity = self.server.registrar[uri]
-        return (socket,client_addr)
+        comma = value.find(",", len(topvia))
+        if comma < 0:
+            self.msg.remove_at(positions[0])
+        else:
+            # combined values (Via: <proxy>, <client>): keep the others
+            self.msg.replace_at(positions[0], "%s: %s" % (line.split(":", 1)[0], value[comma + 1:].lstrip()))
+        return True
+
+    def getViaRoute(self):
+        """Return the ``(socket, address)`` the response is sent to from the
+        Via under the proxy one, None if it can't be reached
+        """
+        via = self.msg.get("Via")
+        if via is None:
+            return None
+        address = viaAddress(via)
+        if address is None:
+            return None
+        transport, claddr = address
+        if transport != "TCP":
+            return self.server.socket, claddr
+        if self.server.tcp is None:
+            return None
+        # the connection of the request: its flow is in received and rport
+        connection = self.server.tcp.connection(claddr)
+        if connection is None:
+            return None
+        return connection, connection.address
+        
+    def getBinding(self, uri):
+        """Return the valid ``[contact, socket, client_address, validity]``
+        binding of `uri`, None if not registered or expired
+
+        The binding is read once per message: the expiry thread can remove
+        it at any time.
+        """
+        binding = self.server.registrar.lookup(uri)
+        if binding is None:
+            self.server.main_logger.warning("SIP: %s is not registered or has expired" % uri)
+        return binding
         
     def getDestination(self, with_params=True):
         destination = ""
-        for line in self.data:
-            if rx_to.search(line) or rx_cto.search(line):
-                if with_params:
-                    md = rx_uri_with_params.search(line)
-                else:
-                    md = rx_uri.search(line)
-                if md:
-                    destination = "%s@%s" %(md.group(1),md.group(2))
-                break
+        to = self.msg.get("To")
+        if to is not None:
+            if with_params:
+                md = rx_uri_with_params.search(to)
+            else:
+                md = rx_uri.search(to)
+            if md:
+                destination = "%s@%s" %(md.group(1),md.group(2))
         return destination
                 
     def getOrigin(self):
         origin = ""
-        for line in self.data:
-            if rx_from.search(line) or rx_cfrom.search(line):
-                md = rx_uri_with_params.search(line)
-                if md:
-                    origin = "%s@%s" %(md.group(1),md.group(2))
-                break
+        fromm = self.msg.get("From")
+        if fromm is not None:
+            md = rx_uri_with_params.search(fromm)
+            if md:
+                origin = "%s@%s" %(md.group(1),md.group(2))
         return origin
         
+    def getTag(self, name):
+        value = self.msg.get(name)
+        if value is not None:
+            md = rx_tag.search(value)
+            if md:
+                return md.group(1)
+        return None
+
+    def getDialogRoute(self):
+        """Return the ``(socket, address)`` next hop of an in-dialog request
+        from the dialog table, None for unknown dialogs
+        """
+        to_tag = self.getTag("To")
+        if to_tag is None:
+            return None
+        return self.server.dialogs.route(self.msg.get("Call-ID"), self.getTag("From"), to_tag)
+
+    def forwardInDialog(self, route):
+        socket, claddr = route
+        self.debug("SIP: %s: in-dialog destination %s:%d", self.msg.method, claddr[0], claddr[1])
+        self.addTopVia(socket)
+        self.removeRouteHeader()
+        if not self.server.options.sip_no_record_route:
+            self.msg.insert(0, self.server.recordroute)
+        text = self.msg.serialize()
+        self.sendTo(text, claddr, socket)
+        self.trace("Send to: %s:%d (%d bytes):\n\n%s", claddr[0], claddr[1], len(text),text)
+        if self.msg.method == "BYE":
+            dialog, from_caller = self.server.dialogs.find(self.msg.get("Call-ID"), self.getTag("From"), self.getTag("To"))
+            if dialog is not None:
+                self.server.dialogs.terminate(dialog.call_id, dialog.caller_tag)
+
     def sendResponse(self,code):
-        self.server.main_logger.debug("SIP: Sending Response %s" % code)
-        request_uri = "SIP/2.0 " + code
-        self.data[0]= request_uri
-        index = 0
-        data = []
-        for line in self.data:
-            data.append(line)
-            if rx_to.search(line) or rx_cto.search(line):
-                if not rx_tag.search(line):
-                    data[index] = "%s%s" % (line,";tag=%s" % local_tag)
-            if rx_via.search(line) or rx_cvia.search(line):
-                # rport processing
-                if rx_rport.search(line):
-                    text = "received=%s;rport=%d" % self.client_address
-                    data[index] = line.replace("rport",text) 
-                else:
-                    text = "received=%s" % self.client_address[0]
-                    data[index] = "%s;%s" % (line,text)      
-            if rx_contentlength.search(line):
-                data[index]="Content-Length: 0"
-            if rx_ccontentlength.search(line):
-                data[index]="l: 0"
-            index += 1
-            if line == "":
-                break
-        data.append("")
-        text = string.join(data,"\r\n")
+        self.debug("SIP: Sending Response %s", code)
+        text = buildResponse(self.msg, code, self.client_address)
         self.sendTo(text, self.client_address)
-        self.server.sip_logger.debug("Send to: %s:%d (%d bytes):\n\n%s" % (self.client_address[0], self.client_address[1], len(text),text))
+        self.trace("Send to: %s:%d (%d bytes):\n\n%s", self.client_address[0], self.client_address[1], len(text),text)
     
     def sendTo(self, data, client_address, socket=None):
-        self.server.main_logger.debug("SIP: Sending to %s:%d" % (client_address))
+        self.debug("SIP: Sending to %s:%d", *client_address)
         if socket:
             sent = socket.sendto(data, client_address)
         else:
             sent = self.socket.sendto(data, client_address)
-        self.server.main_logger.debug("SIP: Succesfully sent %d bytes" % sent)
+        self.debug("SIP: Succesfully sent %d bytes", sent)
+        if self.server.pcap is not None:
+            self.server.pcap.write(data, self.server.server_address, client_address)
+        if self.transaction is not None:
+            self.server.transactions.store(self.transaction, self.msg.raw, data, client_address, socket, forwarded=not data.startswith("SIP/2.0"))
 
-    def processRegister(self):
-        self.server.main_logger.info("SIP: Register received: %s" % self.data[0])
+    def getAuthorization(self, *names):
+        """Return the credentials of the first `names` header found and remove it
+        """
+        for name in names:
+            positions = self.msg.positions(name)
+            if positions:
+                md = rx_credentials.search(self.msg.headers[positions[0]][2])
+                self.msg.remove_at(positions[0])
+                if md:
+                    return md.group(1)
+        return ""
+
+    def processRegister(self, method, uri, code):
+        self.server.main_logger.info("SIP: Register received: %s" % self.msg.start_line)
         fromm = ""
         contact = ""
         contact_expires = ""
         header_expires = ""
         expires = None
         validity = 0
-        authorization = ""
-        index = 0
-        auth_index = 0
-        data = []
-        size = len(self.data)
-
-        for line in self.data:
-            if rx_to.search(line) or rx_cto.search(line):
-                md = rx_uri.search(line)
-                if md:
-                    fromm = "%s@%s" % (md.group(1),md.group(2))
-            if rx_contact.search(line) or rx_ccontact.search(line):
-                md = rx_uri.search(line)
-                if md:
-                    contact = "%s@%s" % (md.group(1), md.group(2))
-                    self.server.main_logger.debug("SIP: Registration: Contact from rx_uri regex: %s" % contact)
-                else:
-                    md = rx_addr.search(line)
-                    if md:
-                        contact = md.group(1)
-                        self.server.main_logger.debug("SIP: Registration: Contact from rx_addr regex: %s" % contact)
-                md = rx_contact_expires.search(line)
-                if md:
-                    contact_expires = md.group(1)
-            md = rx_expires.search(line)
+
+        to = self.msg.get("To")
+        if to is not None:
+            md = rx_uri.search(to)
             if md:
-                header_expires = md.group(1)
-            
-            md = rx_authorization.search(line)
+                fromm = "%s@%s" % (md.group(1),md.group(2))
+        for line in self.msg.get_all("Contact"):
+            md = rx_uri.search(line)
+            if md:
+                contact = "%s@%s" % (md.group(1), md.group(2))
+                self.debug("SIP: Registration: Contact from rx_uri regex: %s", contact)
+            else:
+                md = rx_addr.search(line)
+                if md:
+                    contact = md.group(1)
+                    self.debug("SIP: Registration: Contact from rx_addr regex: %s", contact)
+            md = rx_contact_expires.search(line)
             if md:
-                authorization= md.group(1)
-                auth_index = index
-                #print authorization
-            index += 1
+                contact_expires = md.group(1)
+        header_expires = self.msg.get("Expires", "")
 
         # remove Authorization header for response
-        if auth_index > 0:
-            self.data.pop(auth_index)
+        authorization = self.getAuthorization("Authorization")
 
-        if len(authorization)> 0 and self.server.auth.has_key(fromm):
-            nonce = self.server.auth[fromm]
-            if not self.checkAuthorization(authorization, self.server.options.sip_password, nonce):
+        result = None
+        if len(authorization)> 0:
+            result = self.checkAuthorization(authorization, fromm)
+            sip_auth_results.inc(result)
+            if result == AUTH_FAILED:
                 self.sendResponse("403 Forbidden")
                 return
-        else:
-            nonce = generateNonce(32)
-            self.server.auth[fromm]=nonce
-            header = "WWW-Authenticate: Digest realm=\"%s\", nonce=\"%s\"" % ("dummy",nonce)
-            self.data.insert(6,header)
-            self.sendResponse("401 Unauthorized")
+        if result != AUTH_OK:
+            self.sendChallenge("WWW-Authenticate", stale=(result == AUTH_STALE))
             return
 
         if len(contact_expires) > 0:
@@ -397,324 +888,431 @@ class UDPHandler(SocketServer.BaseRequestHandler):
             expires = int(header_expires)
 
         if expires == 0:
-            if self.server.registrar.has_key(fromm):
-                del self.server.registrar[fromm]
+            if self.server.registrar.unregister(fromm):
                 self.sendResponse("200 0K")
                 return
 
         elif expires == None:
             expires = self.server.options.sip_expires
             header = "Expires: %s" % expires
-            self.data.insert(6, header)
+            self.msg.insert(5, header)
 
         if expires != 0:
             now = int(time.time())
             validity = now + expires
 
         self.server.main_logger.info("SIP: Registration: From: %s - Contact: %s" % (fromm,contact))
-        self.server.main_logger.debug("SIP: Registration: Client address: %s:%s" % self.client_address)
-        self.server.main_logger.debug("SIP: Registration: Expires= %d" % expires)
-        self.server.registrar[fromm]=[contact,self.socket,self.client_address,validity]
+        self.debug("SIP: Registration: Client address: %s:%s", *self.client_address)
+        self.debug("SIP: Registration: Expires= %d", expires)
+        if self.server.shared_registrar:
+            # replies are sent with the socket of the process handling them
+            self.server.registrar.register(fromm, contact, None, self.client_address, validity)
+        else:
+            self.server.registrar.register(fromm, contact, self.socket, self.client_address, validity)
         self.debugRegister()
         self.sendResponse("200 0K")
 
-    def is_authenticated(function):
-        def _is_authenticated(self, *args, **kwargs):
-            proxy_auth = ""
-            index = 0
-            auth_index = 0
+    def redirectInvite(self, method, uri, code):
+        self.debug("SIP: Acting as a redirect server")
+        origin = self.getOrigin()
+        if len(origin) == 0 or self.server.registrar.lookup(origin) is None:
+            self.debug("SIP: Invite: Origin not found: %s", origin)
+            self.sendResponse("400 Bad Request")
+            return
+        destination = self.getDestination(with_params=True)
+        if len(destination) > 0:
+            self.debug("SIP: Destination: %s", destination)
+            binding = self.getBinding(destination)
+            if binding is not None:
+                contact = binding[0]
+                header = "Contact: <sip:%s>" % contact
+                self.removeContact()
+                self.removeContentType()
+                self.removeUserAgent()
+                self.removeSessionExpires()
+                self.removeSupported()
+                self.removeContentDisposition()
+                self.removeMaxForward()
+                self.removeRouteHeader()
+                self.debug("SIP: Destination %s", header)
+                self.msg.insert(5,header)
+                self.sendResponse("302 Moved Temporarily")
+                self.debug("SIP: Destination Contact: %s", contact)
+            else:
+                self.server.main_logger.info("SIP: Destination not found in registrar")
+                self.sendResponse("404 Not Found")
+        else:
+            self.server.main_logger.error("SIP: Error retreiving destination")
+            self.sendResponse("404 Not Found") #TODO: is the right message here ?
 
-            md = rx_request_uri.search(self.data[0])
-            if md:
-                method = md.group(1)
+    def redirectIgnore(self, method, uri, code):
+        if code is not None:
+            self.debug("SIP: Received code, ignoring")
+        else:
+            self.debug("SIP: Received %s, ignoring", method)
 
-            if method not in self.server.options.authenticated_requests:
-                return function(self)
+    def redirectNotAllowed(self, method, uri, code):
+        self.debug("SIP: non-INVITE received")
+        self.sendResponse("405 Method Not Allowed")
 
-            self.server.main_logger.debug("SIP: Request %s received, checking auth" % method)
+    def processPublish(self, method, uri, code):
+        self.sendResponse("200 0K")
 
-            for line in self.data:
-                if rx_to.search(line) or rx_cto.search(line):
-                    md = rx_uri.search(line)
-                    if md:
-                        fromm = "%s@%s" % (md.group(1),md.group(2))
-                md = rx_proxy_authorization.search(line) or rx_authorization.search(line)
-                if md:
-                    proxy_auth= md.group(1)
-                    auth_index = index
-                index += 1
-
-            # remove Authorization header for response
-            if auth_index > 0:
-                self.data.pop(auth_index)
-
-            if len(proxy_auth)> 0 and self.server.auth.has_key(fromm):
-                nonce = self.server.auth[fromm]
-                if not self.checkAuthorization(proxy_auth, self.server.options.sip_password, nonce, method=method):
-                    self.server.main_logger.debug("SIP: Authentication failure")
-                    self.data = self.removeContact()
-                    self.sendResponse("403 Forbidden")
-                    return
-            else:
-                nonce = generateNonce(32)
-                self.server.auth[fromm]=nonce
-                header = "Proxy-Authenticate: Digest realm=\"%s\", nonce=\"%s\"" % ("dummy",nonce)
-                self.data.insert(6,header)
-                self.server.main_logger.debug("SIP: Requesting authentication")
-                self.data = self.removeContact()
-                self.sendResponse("401 Unauthorized")
-                return
-            self.server.main_logger.debug("SIP: Request authenticated")
-            return function(self)
-        return _is_authenticated
-
-    def add_headers(function):
-        def _add_headers(self, *args, **kwargs):
-            if len(self.server.options.sip_custom_headers) > 0:
-                for full_header in self.server.options.sip_custom_headers:
-                    md = rx_request_uri.search(self.data[0])
-                    if md:
-                        method = md.group(1)
-                        uri = md.group(2)
-                    else:
-                        self.server.main_logger.debug("SIP: Custom headers: received code, ignoring")
-                        return function(self)
-
-                    conf_header_method = full_header.split(':')[0]
-                    try:
-                        conf_header_uri_r = full_header.split(':')[1]
-                        conf_header_value = ':'.join(full_header.split(':')[2:])
-                    except IndexError:
-                        self.server.main_logger.error("SIP: Invalid custom header value: '%s'" % full_header)
-                        continue
-
-                    if conf_header_method.upper() == method.upper() or conf_header_method == '*':
-                        self.server.main_logger.debug("SIP: Matched custom method '%s' against '%s'" % (conf_header_method, method))
-                        try:
-                            match = re.match(conf_header_uri_r, uri)
-                        except:
-                            self.server.main_logger.error("SIP: Invalid regex: '%s'" % conf_header_uri_r)
-                            continue
-                        if match: 
-                            self.server.main_logger.debug("SIP: Matched custom header regex '%s' against '%s' URI" % (conf_header_uri_r, uri))
-                            self.server.main_logger.debug("SIP: Adding header '%s'" % conf_header_value)
-                            self.data.insert(2, conf_header_value)
-
-            return function(self)
-        return _add_headers
-
-    def is_redirect(function):
-        def _is_redirect(self, *args, **kwargs):
-            if self.server.options.sip_redirect:
-                self.server.main_logger.debug("SIP: Acting as a redirect server")
-                
-                md = rx_request_uri.search(self.data[0])
-                if md:
-                    method = md.group(1)
-                    uri = md.group(2)
-                else:
-                    if rx_code.search(self.data[0]):
-                        self.server.main_logger.debug("SIP: Received code, ignoring")
-                    return
-                if method.upper() == "ACK":
-                    self.server.main_logger.debug("SIP: Received ACK, ignoring")
-                    return
-                if method.upper() != "INVITE":
-                    self.server.main_logger.debug("SIP: non-INVITE received")
-                    self.sendResponse("405 Method Not Allowed")
-                    return
-
-                origin = self.getOrigin()
-                if len(origin) == 0 or not self.server.registrar.has_key(origin):
-                    self.server.main_logger.debug("SIP: Invite: Origin not found: %s" % origin)
-                    self.sendResponse("400 Bad Request")
-                    return
-                destination = self.getDestination(with_params=True)
-                if len(destination) > 0:
-                    self.server.main_logger.debug("SIP: Destination: %s" % destination)
-                    if self.server.registrar.has_key(destination) and self.checkValidity(destination):
-                        contact = self.server.registrar[destination][0]
-                        header = "Contact: <sip:%s>" % contact
-                        self.data = self.removeContact()
-                        self.data = self.removeContentType()
-                        self.data = self.removeUserAgent()
-                        self.data = self.removeSessionExpires()
-                        self.data = self.removeSupported()
-                        self.data = self.removeContentDisposition()
-                        self.data = self.removeMaxForward()
-                        #self.data = self.addTopVia()
-                        self.data = self.removeRouteHeader()
-                        self.server.main_logger.debug("SIP: Destination %s" % header)
-                        self.data.insert(6,header)
-                        self.sendResponse("302 Moved Temporarily")
-                        self.server.main_logger.debug("SIP: Destination Contact: %s" % contact)
-                        return
-                    else:
-                        self.server.main_logger.info("SIP: Destination not found in registrar")
-                        self.sendResponse("404 Not Found")
-                        return
-                else:
-                    self.server.main_logger.error("SIP: Error retreiving destination")
-                    self.sendResponse("404 Not Found") #TODO: is the right message here ?
-                    return
-            else:
-                self.server.main_logger.debug("SIP: Running in proxy mode")
-            return function(self)
-        return _is_redirect
-
-    @is_authenticated
-    @add_headers
-    @is_redirect
-    def processInvite(self):
-        self.server.main_logger.debug("SIP: INVITE received")
+    def processInvite(self, method, uri, code):
+        self.debug("SIP: INVITE received")
+        route = self.getDialogRoute()
+        if route is not None:
+            self.forwardInDialog(route)
+            return
         origin = self.getOrigin()
-        if len(origin) == 0 or not self.server.registrar.has_key(origin):
-            self.server.main_logger.debug("SIP: Invite: Origin not found: %s" % origin)
+        # the caller binding before forwarding, it can expire meanwhile
+        caller = self.server.registrar.lookup(origin) if len(origin) > 0 else None
+        if caller is None:
+            self.debug("SIP: Invite: Origin not found: %s", origin)
             self.sendResponse("400 Bad Request")
             return
         destination = self.getDestination(with_params=True)
         if len(destination) > 0:
             self.server.main_logger.info("SIP: Invite: destination %s" % destination)
-            if self.server.registrar.has_key(destination) and self.checkValidity(destination):
-                socket,claddr = self.getSocketInfo(destination)
-                self.changeRequestUri()
-                self.data = self.addTopVia()
-                data = self.removeRouteHeader()
+            binding = self.getBinding(destination)
+            if binding is not None:
+                socket, claddr = binding[1], binding[2]
+                self.changeRequestUri(binding)
+                self.addTopVia(socket)
+                self.removeRouteHeader()
                 if not self.server.options.sip_no_record_route:
-                    data.insert(1, self.server.recordroute)
-                text = string.join(data,"\r\n")
+                    self.msg.insert(0, self.server.recordroute)
+                text = self.msg.serialize()
                 self.sendTo(text , claddr, socket)
-                self.server.main_logger.debug("SIP: Forwarding INVITE to %s:%d" % (claddr[0], claddr[1]))
-                self.server.sip_logger.debug("Send to: %s:%d (%d bytes):\n\n%s" % (claddr[0], claddr[1], len(text),text))
+                self.debug("SIP: Forwarding INVITE to %s:%d", claddr[0], claddr[1])
+                self.trace("Send to: %s:%d (%d bytes):\n\n%s", claddr[0], claddr[1], len(text),text)
+                if self.getTag("To") is None:
+                    self.server.dialogs.create(self.msg.get("Call-ID"), self.getTag("From"), (caller[1], caller[2]), (socket, claddr))
             else:
                 self.sendResponse("404 Not Found")
         else:
             self.sendResponse("500 Server Internal Error")
 
-    @is_authenticated
-    @add_headers
-    @is_redirect
-    def processAck(self):
+    def processAck(self, method, uri, code):
         route = None
-        self.server.main_logger.info("SIP: ACK received: %s" % self.data[0])
-        #FIXME: really stupid way to idenitify an ACK belonging to a locally generated code.
-        for line in self.data:
-            if rx_to.search(line) or rx_cto.search(line):
-                md = rx_tag.search(line)
-                if md:
-                    tag = md.group(1)
-                    if tag == local_tag:
-                        self.server.main_logger.warning("SIP: ACK to local code, ignoring")
-                        return
+        self.server.main_logger.info("SIP: ACK received: %s" % self.msg.start_line)
+        route = self.getDialogRoute()
+        if route is not None:
+            self.forwardInDialog(route)
+            return
+        # not in the dialog table: the ACK of a locally generated response
+        # or of a dialog handled by another process or before a restart
+        if self.getTag("To") == local_tag:
+            self.server.main_logger.warning("SIP: ACK to local code, ignoring")
+            return
         destination = self.getDestination()
         if len(destination) > 0:
             self.server.main_logger.info("SIP: ACK: destination %s" % destination)
-            if self.server.registrar.has_key(destination):
-                socket,claddr = self.getSocketInfo(destination)
-                self.data = self.addTopVia()
-                data = self.removeRouteHeader()
+            binding = self.getBinding(destination)
+            if binding is not None:
+                socket, claddr = binding[1], binding[2]
+                self.addTopVia(socket)
+                self.removeRouteHeader()
                 if not self.server.options.sip_no_record_route:
-                    data.insert(1, self.server.recordroute)
-                text = string.join(data,"\r\n")
+                    self.msg.insert(0, self.server.recordroute)
+                text = self.msg.serialize()
                 self.sendTo(text, claddr, socket)
-                self.server.sip_logger.debug("SIP: Send to: %s:%d (%d bytes):\n\n%s" % (claddr[0], claddr[1], len(text),text))
+                self.trace("SIP: Send to: %s:%d (%d bytes):\n\n%s", claddr[0], claddr[1], len(text),text)
             else:
                 self.server.main_logger.error("SIP: ACK not proxied: destination not found")
 
-    @is_authenticated
-    @add_headers
-    @is_redirect
-    def processGenericRequest(self):
-        self.server.main_logger.info("SIP: Request received: %s" % self.data[0])
+    def processGenericRequest(self, method, uri, code):
+        self.server.main_logger.info("SIP: Request received: %s" % self.msg.start_line)
+        route = self.getDialogRoute()
+        if route is not None:
+            self.forwardInDialog(route)
+            return
         origin = self.getOrigin()
-        if len(origin) == 0 or not self.server.registrar.has_key(origin):
-            self.server.main_logger.debug("SIP: Origin not found: %s" % origin)
+        if len(origin) == 0 or self.server.registrar.lookup(origin) is None:
+            self.debug("SIP: Origin not found: %s", origin)
             self.sendResponse("400 Bad Request")
             return
         destination = self.getDestination()
         if len(destination) > 0:
             self.server.main_logger.info("SIP: Destination %s" % destination)
-            if self.server.registrar.has_key(destination) and self.checkValidity(destination):
-                socket,claddr = self.getSocketInfo(destination)
-                self.changeRequestUri()
-                self.data = self.addTopVia()
-                data = self.removeRouteHeader()
+            binding = self.getBinding(destination)
+            if binding is not None:
+                socket, claddr = binding[1], binding[2]
+                self.changeRequestUri(binding)
+                self.addTopVia(socket)
+                self.removeRouteHeader()
                 if not self.server.options.sip_no_record_route:
                     #insert Record-Route
-                    data.insert(1, self.server.recordroute)
-                text = string.join(data,"\r\n")
+                    self.msg.insert(0, self.server.recordroute)
+                text = self.msg.serialize()
                 self.sendTo(text, claddr, socket)
-                self.server.sip_logger.debug("Send to: %s:%d (%d bytes):\n\n%s" % (claddr[0], claddr[1], len(text),text))
+                self.trace("Send to: %s:%d (%d bytes):\n\n%s", claddr[0], claddr[1], len(text),text)
             else:
                 self.sendResponse("404 Not found")
         else:
             self.sendResponse("500 Server Internal Error")
     
-    @is_redirect
-    def processCode(self):
-        self.server.main_logger.info("SIP: Code received: %s" % self.data[0])
-        origin = self.getOrigin()
-        if len(origin) > 0:
-            self.server.main_logger.debug("SIP: Code: origin %s" % origin)
-            if self.server.registrar.has_key(origin):
-                socket,claddr = self.getSocketInfo(origin)
-                data = self.removeTopVia()
-                data = self.removeRouteHeader(data)
-                self.server.main_logger.debug("SIP: Code received: %s" % self.data[0])
-                text = string.join(data,"\r\n")
-                self.sendTo(text,claddr, socket)
-                self.server.sip_logger.debug("Send to: %s:%d (%d bytes):\n\n%s" % (claddr[0], claddr[1], len(text),text))
+    def processCode(self, method, uri, code):
+        """Forward the response statelessly: remove the proxy Via and send
+        to the address of the next one
+        """
+        self.server.main_logger.info("SIP: Code received: %s" % self.msg.start_line)
+        if not self.removeTopVia():
+            self.server.main_logger.warning("SIP: Code: the top Via is not the proxy one, dropping the response")
+            return
+        route = self.getViaRoute()
+        if route is None:
+            self.server.main_logger.warning("SIP: Code: no route to the Via %s, dropping the response" % self.msg.get("Via"))
+            return
+        socket, claddr = route
+        self.debug("SIP: Code: forwarding to %s:%d", claddr[0], claddr[1])
+        self.removeRouteHeader()
+        text = self.msg.serialize()
+        self.sendTo(text, claddr, socket)
+        self.trace("Send to: %s:%d (%d bytes):\n\n%s", claddr[0], claddr[1], len(text),text)
+        cseq = self.msg.get("CSeq", "").split()
+        if code.isdigit() and int(code) >= 200 and len(cseq) == 2:
+            if self.server.transactions is not None:
+                # answer the retransmissions of the request with the final response
+                self.server.transactions.complete(self.getBranch(), cseq[1], text, claddr, socket)
+            if cseq[1] == "INVITE":
+                self.updateDialog(code)
                 
+    def updateDialog(self, code):
+        """Confirm or terminate the dialog of the INVITE answered by `code`
+        """
+        call_id = self.msg.get("Call-ID")
+        caller_tag = self.getTag("From")
+        if code.startswith("2"):
+            self.server.dialogs.confirm(call_id, caller_tag, self.getTag("To"))
+        else:
+            self.server.dialogs.fail(call_id, caller_tag)
+
     def processRequest(self):
-        if len(self.data) > 0:
-            request_uri = self.data[0]
-            if rx_register.search(request_uri):
-                self.processRegister()
-            elif rx_invite.search(request_uri):
-                self.processInvite()
-            elif rx_ack.search(request_uri):
-                self.processAck()
-            elif rx_bye.search(request_uri):
-                self.processGenericRequest()
-            elif rx_cancel.search(request_uri):
-                self.processGenericRequest()
-            elif rx_options.search(request_uri):
-                self.processGenericRequest()
-            elif rx_message.search(request_uri):
-                self.processGenericRequest()
-            elif rx_refer.search(request_uri):
-                self.processGenericRequest()
-            elif rx_prack.search(request_uri):
-                self.processGenericRequest()
-            elif rx_update.search(request_uri):
-                self.processGenericRequest()
-            elif rx_info.search(request_uri):
-                #self.sendResponse("200 0K")
-                self.processGenericRequest()
-            elif rx_subscribe.search(request_uri):
-                self.processGenericRequest()
-                #self.sendResponse("200 0K")
-            elif rx_publish.search(request_uri):
-                self.sendResponse("200 0K")
-            elif rx_notify.search(request_uri):
-                self.processGenericRequest()
-                #self.sendResponse("200 0K")
-            elif rx_code.search(request_uri):
-                self.processCode()
-            else:
-                self.server.main_logger.error("SIP: request_uri %s" % request_uri)          
-                #print "message %s unknown" % self.data
+        if self.msg.is_response():
+            token = "SIP/2.0"
+        else:
+            token = self.msg.method
+        chain = self.server.dispatch.get(token)
+        if chain is None:
+            self.server.main_logger.error("SIP: request_uri %s" % self.msg.start_line)
+            return
+        chain(self, self.msg.method, self.msg.uri, self.msg.code)
     
+    def getBranch(self):
+        via = self.msg.get("Via")
+        if via:
+            md = rx_branch.search(via)
+            if md:
+                return md.group(1)
+        return None
+
+    def retransmitted(self):
+        """Send again the message sent for a retransmitted request
+
+        Sets `self.transaction` to the transaction key of a new request,
+        `sendTo()` stores the message sent for it in the transaction cache.
+        """
+        self.transaction = None
+        transactions = self.server.transactions
+        if transactions is None or not self.msg.is_request() or self.msg.method == "ACK":
+            return False
+        key = transactions.key(self.getBranch(), self.msg.method, self.client_address)
+        if key is None:
+            return False
+        entry = transactions.lookup(key, self.msg.raw)
+        if entry is None:
+            self.transaction = key
+            return False
+        data, client_address, socket = entry
+        self.debug("SIP: Retransmission of %s, sending again the cached message to %s:%d", self.msg.method, client_address[0], client_address[1])
+        (socket or self.socket).sendto(data, client_address)
+        if self.server.pcap is not None:
+            self.server.pcap.write(data, self.server.server_address, client_address)
+        self.trace("Send to: %s:%d (%d bytes):\n\n%s", client_address[0], client_address[1], len(data), data)
+        return True
+
+    def countMessage(self, started):
+        """Update the SIP metrics, the unknown methods and codes are counted
+        as "other" to bound the number of series
+        """
+        if self.msg.is_request():
+            method = self.msg.method if request_handlers.has_key(self.msg.method) else "other"
+            sip_requests.inc(method)
+            sip_duration.observe(time.time() - started, method)
+        else:
+            cseq = self.msg.get("CSeq", "").split()
+            method = cseq[-1] if cseq and request_handlers.has_key(cseq[-1]) else "other"
+            code = self.msg.code if len(self.msg.code) == 3 and self.msg.code.isdigit() else "other"
+            sip_responses.inc(method, code)
+
     def handle(self):
+        started = time.time()
         data = self.request[0]
-        self.data = data.split("\r\n")
         self.socket = self.request[1]
-        request_uri = self.data[0]
-        if rx_request_uri.search(request_uri) or rx_code.search(request_uri):
-            self.server.sip_logger.debug("Received from %s:%d (%d bytes):\n\n%s" %  (self.client_address[0], self.client_address[1], len(data), data))
-            self.processRequest()
+        self.log_debug = self.server.main_logger.isEnabledFor(logging.DEBUG)
+        self.log_trace = self.server.sip_logger.isEnabledFor(logging.DEBUG)
+        if self.server.pcap is not None:
+            self.server.pcap.write(data, self.client_address, self.server.server_address, started)
+        self.msg = SipMessage(data)
+        if self.msg.is_request() or self.msg.is_response():
+            self.trace("Received from %s:%d (%d bytes):\n\n%s", self.client_address[0], self.client_address[1], len(data), data)
+            if not self.retransmitted():
+                self.processRequest()
+            self.countMessage(started)
+        elif self.log_trace and self.server.dumps.allow():
+            suppressed = self.server.dumps.take_suppressed()
+            if suppressed:
+                self.trace("SIP: %d non-SIP datagrams not dumped", suppressed)
+            self.trace("Received from %s:%d (%d bytes):\n\n", self.client_address[0], self.client_address[1], len(data))
+            self.trace('SIP Hex data:\n%s', '\n'.join(utils.hexdump(data, ' ', 16)))
+
+class SipDatagramProtocol(eventloop.DatagramProtocol):
+    """Feed the datagrams received by the event loop to the request handler
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.process_request((data, self.transport.sock), addr)
+
+    def error_received(self, exc):
+        self.server.main_logger.error("SIP: Error receiving data: %s" % exc)
+
+class SipLoopUDPServer(SipTracedUDPServer):
+    """SIP proxy running all the datagrams and timers in a single event loop thread
+    """
+    use_workers = False
+
+    def __init__(self, server_address, RequestHandlerClass, sip_logger, main_logger, options, **kwargs):
+        self.loop = eventloop.EventLoop(main_logger)
+        SipTracedUDPServer.__init__(self, server_address, RequestHandlerClass, sip_logger, main_logger, options, **kwargs)
+        self.transport, self.protocol = self.loop.create_datagram_endpoint(lambda: SipDatagramProtocol(self), self.socket)
+        self.transport.max_batch = options.sip_batch_size
+        self.transport.batch_sizes = self.batch_sizes
+        self.loop.call_later(self.registrar.expiry_interval, self.expireRegistrations)
+
+    def create_tcp_server(self):
+        # the TCP connections are served by the same loop
+        return SipTracedUDPServer.create_tcp_server(self, self.loop)
+
+    def schedule_request(self, request, client_address):
+        # handled inline by the loop thread
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+
+    def arrival_time(self, request):
+        # the datagrams wait in the read batch
+        if request[1] is self.socket:
+            return self.transport.received
+        return time.time()
+
+    def expireRegistrations(self):
+        self.registrar.tick()
+        self.loop.call_later(self.registrar.expiry_interval, self.expireRegistrations)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.main_logger.debug("SIP: Serving requests from the event loop")
+        self.loop.run_forever(poll_interval)
+
+    def shutdown(self):
+        self.loop.stop()
+        self.registrar.stop()
+        self.registrar.close()
+        if self.tcp:
+            self.tcp.close()
+        if self.pcap:
+            self.pcap.close()
+        self.main_logger.info("SIP: Datagram batch sizes: %s" % self.batch_sizes)
+
+class SipWorkers(object):
+    """Run the SIP proxy in `workers` processes
+
+    Every process binds the SIP port with SO_REUSEPORT, so the kernel spreads
+    the datagrams between them. The registrar is kept in a `multiprocessing.Manager`
+    process shared by all the workers, the nonces are signed with the same secret.
+    """
+
+    def __init__(self, workers, server_class, server_address, RequestHandlerClass, sip_logger, main_logger, options):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise Exception("SO_REUSEPORT is not supported on this platform")
+        if options.sip_tcp:
+            raise Exception("SIP over TCP is not supported with multiple worker processes")
+        self.workers = workers
+        self.server_class = server_class
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.sip_logger = sip_logger
+        self.main_logger = main_logger
+        self.options = options
+        self.recordroute, self.topvia_value = proxyHeaders(server_address, options)
+        self.topvia = "Via: %s" % self.topvia_value
+
+        self.manager = multiprocessing.Manager()
+        self.registrar = self.manager.dict()
+        if options.sip_registrar_file:
+            # the shared bindings are snapshotted by the parent process
+            self.journal = Registrar(self.registrar, main_logger, journal=options.sip_registrar_file)
+            self.journal.compact_interval = 10
         else:
-            if len(data) > 4:
-                self.server.sip_logger.debug("Received from %s:%d (%d bytes):\n\n" %  (self.client_address[0], self.client_address[1], len(data)))
-                mess = hexdump(data,' ',16)
-                self.server.sip_logger.debug('SIP Hex data:\n' + '\n'.join(mess))
+            self.journal = None
+        self.nonce_secret = os.urandom(20)
+        self.processes = []
+        # exit cleanly on SIGTERM, the daemon workers are terminated at exit
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    def serve(self):
+        # the parent process terminates the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server = self.server_class(self.server_address, self.RequestHandlerClass, self.sip_logger, self.main_logger, self.options,
+                registrar=self.registrar, nonce_secret=self.nonce_secret, reuse_port=True)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: server.reload_credentials())
+        try:
+            server.serve_forever()
+        finally:
+            # the worker processes don't run the exit handlers, flush the logs here
+            if server.pcap:
+                server.pcap.close()
+            logging.shutdown()
+
+    def serve_forever(self):
+        self.main_logger.info("SIP: Starting %d worker processes" % self.workers)
+        if self.journal:
+            self.journal.start()
+        for i in range(self.workers):
+            process = multiprocessing.Process(name="sip-%d" % i, target=self.serve)
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        for process in self.processes:
+            process.join()
+
+    def reload_credentials(self):
+        """Ask every worker process to reload its credential store
+        """
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+        return bool(self.options.sip_credentials)
+
+    def shutdown(self):
+        for process in self.processes:
+            process.terminate()
+        self.processes = []
+        if self.journal:
+            self.journal.stop()
+            self.journal.close()
+        self.manager.shutdown()
+
+# SIP transport engines, selected by the --sip-engine option
+engines = {
+    'threads': SipTracedUDPServer,
+    'eventloop': SipLoopUDPServer,
+}
@@ -73,6 +73,8 @@ class DHCPD:
         self.logger = serverSettings.get('logger', None)
         
         self.running = True
+        self.offers = 0
+        self.acks = 0
 
         # setup logger
         if self.logger == None:
@@ -276,6 +278,7 @@ class DHCPD:
         #self.logger.debug('  <--BEGIN RESPONSE-->\n\t{response}\n\t<--END RESPONSE-->'.format(response = repr(response)))
         try:
             self.sock.sendto(response, (self.broadcast, 68))
+            self.offers += 1
         except Exception, e:
             self.logger.error("DHCP: error sending Offer: %s" % e)
 
@@ -292,6 +295,7 @@ class DHCPD:
         self.logger.debug('  <--BEGIN OPTIONS-->\n\t{optionsResponse}\n\t<--END OPTIONS-->'.format(optionsResponse = repr(optionsResponse)))
         #self.logger.debug('  <--BEGIN RESPONSE-->\n\t{response}\n\t<--END RESPONSE-->'.format(response = repr(response)))
         self.sock.sendto(response, (self.broadcast, 68))
+        self.acks += 1
 
     def validateReq(self):
         # TODO
@@ -315,28 +319,36 @@ class DHCPD:
                 message, address = self.sock.recvfrom(1024)
             except Exception, e:
                 continue
-            try:
-                clientmac = struct.unpack('!28x6s', message[:34])
-            except struct.error, e:
-                self.logger.debug("Error parsing client mac")
-                continue
-            self.logger.debug('Received message')
-            #self.logger.debug('  <--BEGIN MESSAGE-->\n\t{message}\n\t<--END MESSAGE-->'.format(message = repr(message)))
-            self.options = self.tlvParse(message[240:])
-            self.logger.debug('Parsed received options')
-            self.logger.debug('  <--BEGIN OPTIONS-->\n\t{options}\n\t<--END OPTIONS-->'.format(options = repr(self.options)))
-            if not self.validateReq():
-                continue
-            type = ord(self.options[53][0]) #see RFC2131 page 10
-            if type == 1:
-                self.logger.debug('Received DHCPOFFER')
-                self.dhcpOffer(message)
-            elif type == 3 and address[0] == '0.0.0.0':
-                self.logger.debug('Received DHCPACK')
-                self.dhcpAck(message)
-            elif type == 3 and address[0] != '0.0.0.0':
-                self.logger.debug('Received DHCPACK')
-                self.dhcpAck(message)
+            self.handle_message(message, address)
+
+    def handle_message(self, message, address):
+        '''Handles a DHCP message received from address'''
+        try:
+            clientmac = struct.unpack('!28x6s', message[:34])
+        except struct.error, e:
+            self.logger.debug("Error parsing client mac")
+            return
+        self.logger.debug('Received message')
+        #self.logger.debug('  <--BEGIN MESSAGE-->\n\t{message}\n\t<--END MESSAGE-->'.format(message = repr(message)))
+        self.options = self.tlvParse(message[240:])
+        self.logger.debug('Parsed received options')
+        self.logger.debug('  <--BEGIN OPTIONS-->\n\t{options}\n\t<--END OPTIONS-->'.format(options = repr(self.options)))
+        if not self.validateReq():
+            return
+        type = ord(self.options[53][0]) #see RFC2131 page 10
+        if type == 1:
+            self.logger.debug('Received DHCPOFFER')
+            self.dhcpOffer(message)
+        elif type == 3 and address[0] == '0.0.0.0':
+            self.logger.debug('Received DHCPACK')
+            self.dhcpAck(message)
+        elif type == 3 and address[0] != '0.0.0.0':
+            self.logger.debug('Received DHCPACK')
+            self.dhcpAck(message)
+
+    def stats(self):
+        '''Returns the offers and acks sent.'''
+        return {'offers': self.offers, 'acks': self.acks}
 
     def shutdown(self):
         self.sock.sendto("", (self.ip, self.port))
@@ -21,6 +21,7 @@ class Client:
     '''Client instance for TFTPD.'''
     def __init__(self, mainsock, parent):
 
+        self.parent = parent
         self.default_retries = parent.default_retries
         self.timeout = parent.timeout
         self.ip = parent.ip
@@ -60,6 +61,7 @@ class Client:
         response = struct.pack('!HH', 3, self.block % 65536)
         response += data
         self.sock.sendto(response, self.address)
+        self.parent.bytes_sent += len(data)
         # self.logger.debug('Sending block {0}'.format(self.block))
         self.retries -= 1
         self.sent_time = time.time()
@@ -146,6 +148,7 @@ class Client:
             self.complete()
             return
         self.logger.info('TFTP: GET {filename}'.format(filename=self.filename))
+        self.parent.transfers += 1
         self.fh = open(self.filename, 'rb')
         self.filesize = os.path.getsize(self.filename)
 
@@ -267,6 +270,8 @@ class TFTPD:
         self.logger.debug('Network Boot Directory: {0}'.format(self.netboot_directory))
 
         self.ongoing = []
+        self.transfers = 0
+        self.bytes_sent = 0
 
         # start in network boot file directory and then chroot,
         # this simplifies target later as well as offers a slight security increase
@@ -287,12 +292,7 @@ class TFTPD:
                 break
             if self.running:
                 for sock in rlist:
-                    if sock == self.sock:
-                        # main socket, so new client
-                        self.ongoing.append(Client(sock, self))
-                    else:
-                        # client socket, so tell the client object it's ready
-                        sock.parent.ready()
+                    self.handle_ready(sock)
                 # if we haven't recieved an ACK in timeout time, retry
                 for client in self.ongoing:
                     if client.no_ack():
@@ -304,6 +304,23 @@ class TFTPD:
                         self.logger.error("Max retries reached. Closing connection with client {0}".format(client.address))
                         client.complete()
 
+    def handle_ready(self, sock):
+        '''Handles a message received on the main socket or on a client socket.'''
+        if sock == self.sock:
+            # main socket, so new client
+            self.ongoing.append(Client(sock, self))
+        else:
+            # client socket, so tell the client object it's ready
+            sock.parent.ready()
+
+    def stats(self):
+        '''Returns the active and total transfers and the bytes sent.'''
+        return {
+            'active': len([client for client in self.ongoing if not client.dead]),
+            'transfers': self.transfers,
+            'bytes_sent': self.bytes_sent,
+        }
+
     def shutdown(self):
         self.running = False
         self.sock.close()
@@ -0,0 +1,329 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import gc
+import heapq
+import os
+import threading
+import time
+import logging
+
+class Registrar(object):
+    """SIP registrar with an expiry scheduler
+
+    Bindings are stored as ``[contact, socket, client_address, validity]``
+    lists keyed by the AOR (user@host). Every registration pushes its validity
+    in a min-heap, `expire()` pops the expired entries so that a binding is
+    removed as soon as it expires, even if nobody looks it up anymore.
+
+    Refreshed or removed bindings leave stale entries in the heap, they are
+    recognised because their validity doesn't match the stored binding and
+    they are discarded when popped.
+
+    The class can be used as a read only dict, `bindings` can be a dict-like
+    object shared with other processes.
+
+    If `journal` is defined the bindings are persisted in that file: it's
+    loaded at startup, then every change is appended to it. The journal is
+    compacted, rewriting only the valid bindings, when it grows over twice
+    the bindings count or every `compact_interval` seconds if set. Every
+    line is a tab separated record::
+
+        R <validity> <host> <port> <AOR> <contact>
+        U <AOR>
+
+    The sockets are not persisted, the reloaded bindings are reached with the
+    server socket.
+    """
+
+    expiry_interval = 1
+    compact_interval = None
+    compact_min = 1000
+    # called at every tick, for the other periodic cleanups of the server
+    on_tick = None
+
+    def __init__(self, bindings=None, logger=None, journal=None):
+        if bindings is None:
+            bindings = {}
+        self.bindings = bindings
+        self.logger = logger or logging.getLogger('main_logger')
+        self.heap = []
+        # heap size checked against the bindings count, which is an IPC
+        # round trip when the bindings are shared with other processes
+        self.heap_limit = 64
+        self.lock = threading.Lock()
+        self.expired = 0
+        self.refreshed = 0
+        self.running = False
+        self.journal_path = journal
+        self.journal = None
+        self.closed = False
+        self.journal_lock = threading.Lock()
+        self.journal_entries = 0
+        self.last_compaction = 0
+        if journal:
+            lines = self.load()
+            if lines > 2 * len(self.bindings) + self.compact_min:
+                self.compact()
+            else:
+                self.journal = open(journal, "a")
+                self.journal_entries = lines
+                self.last_compaction = time.time()
+            atexit.register(self.close)
+
+    def register(self, uri, contact, socket, client_address, validity):
+        if self.journal:
+            self.write_journal("R\t%s\t%s\t%d\t%s\t%s\n" % (validity, client_address[0], client_address[1], uri, contact))
+        with self.lock:
+            # under the lock: expire() doesn't remove a binding refreshed meanwhile
+            binding = self.bindings.get(uri)
+            if binding is not None and binding[3] > time.time():
+                self.refreshed += 1
+            self.bindings[uri] = [contact, socket, client_address, validity]
+            heapq.heappush(self.heap, (validity, uri))
+            if len(self.heap) > self.heap_limit:
+                count = len(self.bindings)
+                if len(self.heap) > 2 * count + 64:
+                    # too many stale entries: rebuild the heap from the bindings
+                    self.heap = [(b[3], u) for u, b in self.bindings.items()]
+                    heapq.heapify(self.heap)
+                    count = len(self.heap)
+                self.heap_limit = 2 * count + 64
+
+    def unregister(self, uri):
+        """Remove the `uri` binding, returns it or None if not registered
+        """
+        binding = self.bindings.pop(uri, None)
+        if binding is not None and self.journal:
+            self.write_journal("U\t%s\n" % uri)
+        return binding
+
+    def lookup(self, uri):
+        """Return the valid binding for `uri`, None if missing or expired
+        """
+        binding = self.bindings.get(uri)
+        if binding is None or binding[3] > time.time():
+            return binding
+        return None
+
+    def expire(self, now=None):
+        """Remove the expired bindings, returns the expired AORs
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                validity, uri = heapq.heappop(self.heap)
+                binding = self.bindings.get(uri)
+                if binding is None or binding[3] != validity:
+                    # removed or refreshed
+                    continue
+                binding = self.bindings.pop(uri, None)
+                if binding is not None and binding[3] != validity:
+                    # refreshed by another process sharing the bindings
+                    self.bindings.setdefault(uri, binding)
+                    continue
+                expired.append(uri)
+            self.expired += len(expired)
+        for uri in expired:
+            self.logger.info("SIP: Registration for %s has expired" % uri)
+        return expired
+
+    def next_expiry(self):
+        with self.lock:
+            if self.heap:
+                return self.heap[0][0]
+        return None
+
+    def stats(self):
+        """Return the count of active, expired and refreshed bindings
+        """
+        return {
+            'active': len(self.bindings),
+            'expired': self.expired,
+            'refreshed': self.refreshed,
+        }
+
+    def load(self):
+        """Load the valid bindings from the journal, returns the journal lines count
+        """
+        if not os.path.exists(self.journal_path):
+            return 0
+        start = time.time()
+        # the loaded records are not garbage, don't let the collector scan them over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            lines, bindings = self.read_journal()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.bindings.update(bindings)
+        with self.lock:
+            self.heap = [(b[3], uri) for uri, b in bindings.iteritems()]
+            heapq.heapify(self.heap)
+            self.heap_limit = 2 * len(self.heap) + 64
+        self.logger.info("SIP: Registrar: loaded %d bindings from %s in %.3fs" % (len(bindings), self.journal_path, time.time() - start))
+        return lines
+
+    def read_journal(self):
+        records = {}
+        lines = 0
+        with open(self.journal_path) as f:
+            # only the last record of every AOR is parsed
+            for line in f:
+                lines += 1
+                fields = line.rstrip("\n").split("\t", 5)
+                if fields[0] == "R" and len(fields) == 6:
+                    records[fields[4]] = fields
+                elif fields[0] == "U" and len(fields) == 2:
+                    records.pop(fields[1], None)
+                else:
+                    # truncated by a crash while writing
+                    self.logger.warning("SIP: Registrar: skipping invalid journal line: %r" % line)
+        now = time.time()
+        bindings = {}
+        for uri, fields in records.iteritems():
+            try:
+                validity = float(fields[1])
+                if validity > now:
+                    bindings[uri] = [fields[5], None, (fields[2], int(fields[3])), validity]
+            except ValueError:
+                self.logger.warning("SIP: Registrar: skipping invalid journal record for %s" % uri)
+        return lines, bindings
+
+    def write_journal(self, line):
+        with self.journal_lock:
+            if self.journal:
+                self.journal.write(line)
+                self.journal_entries += 1
+
+    def compact(self):
+        """Rewrite the journal with the valid bindings only
+        """
+        now = time.time()
+        tmp = "%s.tmp" % self.journal_path
+        with self.journal_lock:
+            if self.closed:
+                return
+            entries = 0
+            with open(tmp, "w") as f:
+                for uri, b in self.bindings.items():
+                    if b[3] > now:
+                        f.write("R\t%s\t%s\t%d\t%s\t%s\n" % (b[3], b[2][0], b[2][1], uri, b[0]))
+                        entries += 1
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.journal_path)
+            if self.journal:
+                self.journal.close()
+            self.journal = open(self.journal_path, "a")
+            self.journal_entries = entries
+            self.last_compaction = now
+
+    def checkpoint(self):
+        """Flush the journal, compact it when needed
+        """
+        if not self.journal_path:
+            return
+        if self.journal_entries > 2 * len(self.bindings) + self.compact_min or \
+                (self.compact_interval and time.time() - self.last_compaction > self.compact_interval):
+            self.compact()
+        else:
+            with self.journal_lock:
+                if self.journal:
+                    self.journal.flush()
+
+    def close(self):
+        """Compact and close the journal, only once: a closed registrar
+        doesn't write the journal anymore, even from the atexit handler
+        """
+        if self.closed or not self.journal:
+            return
+        try:
+            self.compact()
+        except Exception, e:
+            self.logger.error("SIP: Registrar: cannot write the journal: %s" % e)
+        with self.journal_lock:
+            self.closed = True
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def tick(self):
+        """Remove the expired bindings, checkpoint the journal and call `on_tick`
+        """
+        self.expire()
+        try:
+            self.checkpoint()
+        except (IOError, OSError), e:
+            self.logger.error("SIP: Registrar: cannot write the journal: %s" % e)
+        if self.on_tick is not None:
+            try:
+                self.on_tick()
+            except Exception, e:
+                self.logger.exception("SIP: Registrar: error in the periodic cleanup: %s" % e)
+
+    def serve_expiry(self):
+        self.running = True
+        while self.running:
+            self.tick()
+            time.sleep(self.expiry_interval)
+
+    def start(self):
+        """Start a background thread removing the expired bindings
+        """
+        t = threading.Thread(name='sip-registrar', target=self.serve_expiry)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        with self.journal_lock:
+            if self.journal:
+                self.journal.flush()
+
+    # dict interface
+    def __contains__(self, uri):
+        return uri in self.bindings
+
+    def has_key(self, uri):
+        return uri in self.bindings
+
+    def __getitem__(self, uri):
+        return self.bindings[uri]
+
+    def __delitem__(self, uri):
+        del self.bindings[uri]
+
+    def __len__(self):
+        return len(self.bindings)
+
+    def __iter__(self):
+        return iter(self.bindings.keys())
+
+    def keys(self):
+        return self.bindings.keys()
+
+    def items(self):
+        return self.bindings.items()
+
+    def get(self, uri, default=None):
+        return self.bindings.get(uri, default)
+
+    def pop(self, uri, default=None):
+        return self.bindings.pop(uri, default)
@@ -0,0 +1,211 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compact header forms (RFC 3261 section 7.3.3 and extensions)
+compact_headers = {
+    'f': 'from',
+    't': 'to',
+    'v': 'via',
+    'm': 'contact',
+    'l': 'content-length',
+    'i': 'call-id',
+    'c': 'content-type',
+    'e': 'content-encoding',
+    'k': 'supported',
+    's': 'subject',
+    'o': 'event',
+    'r': 'refer-to',
+    'u': 'allow-events',
+    'x': 'session-expires',
+}
+
+def header_key(name):
+    """Return the canonical (lower case, long form) key for a header name
+    """
+    name = name.strip().lower()
+    return compact_headers.get(name, name)
+
+class SipMessage(object):
+    """A SIP message parsed once.
+
+    The message is split in a start line, a list of header lines and a body.
+    Headers are indexed by canonical name so that lookups are case insensitive
+    and compact forms (f, t, v, m, l...) are resolved to the long form.
+
+    Every header is stored as a ``(key, line, value)`` tuple where ``line`` is
+    the header line as received and ``value`` is the text after the colon.
+
+    Only the header region is split and edited: the body is never parsed, it
+    stays in the received data (`raw` from `body_offset`) until it is
+    replaced and it is copied once, untouched, by `serialize()`.
+    """
+
+    # replaced body, None while the body is the one received
+    _body = None
+
+    def __init__(self, data):
+        self.raw = data
+        end = data.find("\r\n\r\n")
+        if end < 0:
+            head = data.rstrip("\r\n")
+            self.body_offset = len(data)
+        else:
+            head = data[:end]
+            self.body_offset = end + 4
+
+        lines = head.split("\r\n")
+        self.headers = []
+        for line in lines[1:]:
+            if line[:1] in (" ", "\t") and self.headers:
+                # header folding: glue the continuation to the previous line
+                line = "%s %s" % (self.headers[-1][1], line.strip())
+                self.headers[-1] = self._entry(line)
+            else:
+                self.headers.append(self._entry(line))
+        self.set_start_line(lines[0])
+        self._reindex()
+
+    def _entry(self, line):
+        name, sep, value = line.partition(":")
+        if not sep:
+            return ("", line, "")
+        return (header_key(name), line, value.strip())
+
+    def _reindex(self):
+        self.index = {}
+        for pos, entry in enumerate(self.headers):
+            self.index.setdefault(entry[0], []).append(pos)
+
+    def set_start_line(self, line):
+        """Replace the start line and parse method, URI and response code
+        """
+        self.start_line = line
+        self.method = None
+        self.request_uri = None
+        self.uri = None
+        self.code = None
+        self.reason = None
+        parts = line.split(" ", 2)
+        if parts[0] == "SIP/2.0":
+            if len(parts) > 1:
+                self.code = parts[1]
+                self.reason = parts[2] if len(parts) > 2 else ""
+        elif len(parts) == 3 and parts[2] == "SIP/2.0":
+            self.method = parts[0]
+            self.request_uri = parts[1]
+            if self.request_uri.startswith("sip:"):
+                # user@host part without URI parameters
+                self.uri = self.request_uri[4:].split(";", 1)[0]
+
+    @property
+    def body(self):
+        if self._body is None:
+            return self.raw[self.body_offset:]
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    def is_request(self):
+        return self.uri is not None
+
+    def is_response(self):
+        return self.code is not None
+
+    def has(self, name):
+        return header_key(name) in self.index
+
+    def get(self, name, default=None):
+        """Return the value of the first `name` header, `default` if missing
+        """
+        positions = self.index.get(header_key(name))
+        if positions:
+            return self.headers[positions[0]][2]
+        return default
+
+    def get_all(self, name):
+        """Return the values of all the `name` headers in message order
+        """
+        return [self.headers[pos][2] for pos in self.index.get(header_key(name), [])]
+
+    def positions(self, name):
+        """Return the positions of the `name` headers in `self.headers`
+        """
+        return list(self.index.get(header_key(name), []))
+
+    def remove(self, name):
+        """Remove all the `name` headers, returns the removed lines
+        """
+        key = header_key(name)
+        if key not in self.index:
+            return []
+        removed = [entry[1] for entry in self.headers if entry[0] == key]
+        self.headers = [entry for entry in self.headers if entry[0] != key]
+        self._reindex()
+        return removed
+
+    def remove_at(self, pos):
+        """Remove the header at position `pos`, returns the removed line
+        """
+        entry = self.headers.pop(pos)
+        self._reindex()
+        return entry[1]
+
+    def replace_at(self, pos, line):
+        self.headers[pos] = self._entry(line)
+        self._reindex()
+
+    def insert(self, pos, line):
+        """Insert the header `line` at position `pos` of the header list
+        """
+        self.headers.insert(pos, self._entry(line))
+        self._reindex()
+
+    def append(self, line):
+        self.headers.append(self._entry(line))
+        self.index.setdefault(self.headers[-1][0], []).append(len(self.headers) - 1)
+
+    def copy(self):
+        msg = SipMessage.__new__(SipMessage)
+        msg.__dict__.update(self.__dict__)
+        msg.headers = list(self.headers)
+        msg._reindex()
+        return msg
+
+    def head(self):
+        """Return the start line and the headers, terminated by the empty line
+        """
+        lines = [self.start_line]
+        lines.extend([entry[1] for entry in self.headers])
+        lines.append("")
+        lines.append("")
+        return "\r\n".join(lines)
+
+    def serialize(self):
+        """Return the message, gathering the start line, the headers and the
+        body in a single join
+        """
+        lines = [self.start_line]
+        lines.extend([entry[1] for entry in self.headers])
+        lines.append("")
+        if self._body is None:
+            lines.append(self.raw[self.body_offset:])
+        else:
+            lines.append(self._body)
+        return "\r\n".join(lines)
+
+    def __str__(self):
+        return self.serialize()
@@ -0,0 +1,264 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+SIP over TCP: stream framing and connection table.
+
+All the connections are read by a single event loop, every complete SIP
+message is passed to the `dispatch` callable with the `TCPConnection` it was
+received on. `TCPConnection.sendto()` has the socket signature so the SIP
+handlers can use a connection in place of the UDP socket.
+
+The sockets are non blocking: what a peer doesn't read right away is kept
+in the connection output buffer and written when the socket is writable, a
+slow peer never blocks the loop.
+'''
+
+import errno
+import re
+import socket
+import threading
+import time
+import logging
+
+import eventloop
+
+rx_content_length = re.compile("^(?:content-length|l)[ \t]*:[ \t]*([0-9]+)", re.I | re.M)
+
+class TCPConnection(object):
+
+    transport = "TCP"
+    max_message_size = 65536
+    max_output_size = 1024 * 1024
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.buffer = ""
+        self.output = ""
+        # when the output buffer started waiting for the peer
+        self.blocked = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self.last_activity = time.time()
+
+    def sendto(self, data, address=None):
+        """Send `data` on the connection, `address` is ignored
+
+        The data the socket doesn't take is buffered and written by the
+        loop, the connection is closed if the buffer exceeds `max_output_size`.
+        """
+        if self.closed:
+            self.server.logger.warning("SIP: TCP connection to %s:%d closed, message not sent" % self.address)
+            return 0
+        size = len(data)
+        try:
+            with self.lock:
+                if not self.output:
+                    sent = self.send(data)
+                    if sent == size:
+                        self.last_activity = time.time()
+                        return size
+                    data = data[sent:]
+                    self.blocked = time.time()
+                    self.server.loop.add_writer(self.sock, self.write_ready)
+                if len(self.output) + len(data) > self.max_output_size:
+                    raise socket.error(errno.ENOBUFS, "output buffer full, the peer doesn't read")
+                self.output += data
+        except socket.error, e:
+            self.server.logger.warning("SIP: Cannot send to %s:%d over TCP: %s" % (self.address[0], self.address[1], e))
+            self.server.loop.call_soon(self.server.close_connection, self)
+            return 0
+        return size
+
+    def send(self, data):
+        """Write `data` without blocking, returns the bytes written
+        """
+        try:
+            return self.sock.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def write_ready(self):
+        try:
+            with self.lock:
+                sent = self.send(self.output)
+                self.output = self.output[sent:]
+                if sent:
+                    self.last_activity = time.time()
+                if self.output:
+                    if sent:
+                        self.blocked = time.time()
+                    return
+                self.blocked = None
+                self.server.loop.remove_writer(self.sock)
+        except socket.error, e:
+            self.server.logger.warning("SIP: Cannot send to %s:%d over TCP: %s" % (self.address[0], self.address[1], e))
+            self.server.close_connection(self)
+
+    def read_ready(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self.server.close_connection(self)
+            return
+        self.last_activity = time.time()
+        self.buffer += data
+        for message in self.messages():
+            self.server.dispatch(message, self)
+
+    def messages(self):
+        """Split the complete messages out of the buffer
+        """
+        while self.buffer:
+            if self.buffer.startswith("\r\n\r\n"):
+                # RFC 5626 keep-alive ping, answer with a pong
+                self.buffer = self.buffer[4:]
+                self.sendto("\r\n")
+                continue
+            if self.buffer.startswith("\r\n"):
+                self.buffer = self.buffer[2:]
+                continue
+            end = self.buffer.find("\r\n\r\n")
+            if end < 0:
+                if len(self.buffer) > self.max_message_size:
+                    self.server.logger.warning("SIP: Message from %s:%d too long, closing the connection" % self.address)
+                    self.server.close_connection(self)
+                break
+            md = rx_content_length.search(self.buffer, 0, end)
+            length = end + 4 + (int(md.group(1)) if md else 0)
+            if length > self.max_message_size:
+                self.server.logger.warning("SIP: Message from %s:%d too long, closing the connection" % self.address)
+                self.server.close_connection(self)
+                break
+            if len(self.buffer) < length:
+                break
+            message = self.buffer[:length]
+            self.buffer = self.buffer[length:]
+            yield message
+
+class SipTCPServer(object):
+    """TCP listener keeping a table of the connections keyed by flow (remote address)
+
+    At most `max_connections` connections are kept, the connections idle for
+    `idle_timeout` seconds are closed, as those with output waiting for more
+    than `send_timeout` seconds. The connections are served by `loop` or, if
+    not defined, by an event loop run by `start()` in its own thread.
+    """
+
+    send_timeout = 5
+    reap_interval = 1
+
+    def __init__(self, server_address, dispatch, logger=None, max_connections=1024, idle_timeout=600, loop=None):
+        self.server_address = server_address
+        self.dispatch = dispatch
+        self.logger = logger or logging.getLogger('main_logger')
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connections = {}
+        self.accepted = 0
+        self.refused = 0
+        self.idle_closed = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(server_address)
+        self.sock.listen(128)
+
+        self.own_loop = loop is None
+        self.loop = loop or eventloop.EventLoop(self.logger)
+        self.loop.add_reader(self.sock, self.accept)
+        self.loop.call_later(self.reap_interval, self.reap_idle)
+
+    def accept(self):
+        try:
+            sock, address = self.sock.accept()
+        except socket.error, e:
+            self.logger.warning("SIP: TCP accept failed: %s" % e)
+            return
+        if len(self.connections) >= self.max_connections:
+            self.refused += 1
+            self.logger.warning("SIP: Too many TCP connections (%d), refusing %s:%d" % (len(self.connections), address[0], address[1]))
+            sock.close()
+            return
+        sock.setblocking(False)
+        connection = TCPConnection(self, sock, address)
+        self.connections[address] = connection
+        self.accepted += 1
+        self.loop.add_reader(sock, connection.read_ready)
+        self.logger.debug("SIP: TCP connection from %s:%d" % address)
+
+    def connection(self, address):
+        """Return the open connection with `address`, None if missing
+        """
+        return self.connections.get(address)
+
+    def close_connection(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.loop.remove_reader(connection.sock)
+        self.loop.remove_writer(connection.sock)
+        if self.connections.get(connection.address) is connection:
+            del self.connections[connection.address]
+        try:
+            connection.sock.close()
+        except socket.error:
+            pass
+        self.logger.debug("SIP: TCP connection from %s:%d closed" % connection.address)
+
+    def reap_idle(self):
+        now = time.time()
+        idle = now - self.idle_timeout
+        for connection in self.connections.values():
+            if connection.last_activity < idle:
+                self.idle_closed += 1
+                self.close_connection(connection)
+            elif connection.blocked is not None and connection.blocked < now - self.send_timeout:
+                self.logger.warning("SIP: TCP peer %s:%d doesn't read, closing the connection" % connection.address)
+                self.close_connection(connection)
+        self.loop.call_later(self.reap_interval, self.reap_idle)
+
+    def stats(self):
+        return {
+            'connections': len(self.connections),
+            'accepted': self.accepted,
+            'refused': self.refused,
+            'idle_closed': self.idle_closed,
+        }
+
+    def start(self):
+        """Run the event loop in a thread, if not shared with another server
+        """
+        if not self.own_loop:
+            return
+        t = threading.Thread(name='sip-tcp', target=self.loop.run_forever)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        if self.own_loop:
+            self.loop.stop()
+        for connection in self.connections.values():
+            self.close_connection(connection)
+        self.loop.remove_reader(self.sock)
+        self.sock.close()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Micro-benchmarks of the SIP, DHCP and TFTP hot functions.
+
+Every benchmark times one function on a realistic fixture, without network
+I/O: the sockets are replaced by `NullSocket`. The SIP handler methods
+modifying the message run on a fresh copy of the fixture every time, the
+`sipmessage.copy` benchmark gives the cost of that copy.
+
+    python tests/benchmarks.py run -o baseline.json
+    ... change the code ...
+    python tests/benchmarks.py compare baseline.json
+
+`compare` runs the benchmarks again (or reads a second results file) and
+flags the benchmarks slower than the baseline by more than `--threshold`
+percent, the exit status is 1 when there are regressions.
+'''
+
+import json
+import optparse
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import utils
+import proxy
+import pcap
+from sipmessage import SipMessage
+from pypxe import dhcp
+from pypxe import tftp
+
+CLIENT = ("192.168.1.10", 5060)
+
+REGISTER = "\r\n".join([
+    "REGISTER sip:192.168.1.1 SIP/2.0",
+    "Via: SIP/2.0/UDP 192.168.1.10:5060;branch=z9hG4bK-524287-1---7ed1c6f3c25a7b6d;rport",
+    "Max-Forwards: 70",
+    "Contact: <sip:100@192.168.1.10:5060;line=x7d1f8q2>;reg-id=1;q=1.0;+sip.instance=\"<urn:uuid:3a6d5fe2-0ba8-4bd6-97a2-9a6bc07f1d2a>\";audio;mobility=\"fixed\";duplex=\"full\";description=\"snom370\";actions=\"broadcast\";events=\"dialog\";expires=3600",
+    "To: \"100\" <sip:100@192.168.1.1>",
+    "From: \"100\" <sip:100@192.168.1.1>;tag=2bd6a3b5",
+    "Call-ID: 8cd3fb0c94a9c33b@192.168.1.10",
+    "CSeq: 2 REGISTER",
+    "Expires: 3600",
+    "Allow: INVITE, ACK, CANCEL, BYE, REFER, OPTIONS, NOTIFY, SUBSCRIBE, PRACK, MESSAGE, INFO, UPDATE",
+    "Allow-Events: talk, hold, refer, call-info",
+    "Supported: outbound, timer, gruu",
+    "User-Agent: snom370/8.7.5.35",
+    "%(authorization)s",
+    "Content-Length: 0",
+    "", ""])
+
+INVITE_SDP = "\r\n".join([
+    "v=0",
+    "o=root 2063 2063 IN IP4 192.168.1.10",
+    "s=call",
+    "c=IN IP4 192.168.1.10",
+    "t=0 0",
+    "m=audio 62942 RTP/AVP 9 0 8 3 99 112 101",
+    "a=rtpmap:9 G722/8000",
+    "a=rtpmap:0 PCMU/8000",
+    "a=rtpmap:8 PCMA/8000",
+    "a=rtpmap:3 GSM/8000",
+    "a=rtpmap:99 G726-32/8000",
+    "a=rtpmap:112 AAL2-G726-32/8000",
+    "a=rtpmap:101 telephone-event/8000",
+    "a=fmtp:101 0-15",
+    "a=ptime:20",
+    "a=sendrecv",
+    ""])
+
+INVITE = "\r\n".join([
+    "INVITE sip:200@192.168.1.1;user=phone SIP/2.0",
+    "Via: SIP/2.0/UDP 192.168.1.10:5060;branch=z9hG4bK-x1y2dbw0vw6m;rport",
+    "From: \"100\" <sip:100@192.168.1.1>;tag=ch5kb3tpwd",
+    "To: <sip:200@192.168.1.1;user=phone>",
+    "Call-ID: 3c26700e4ebf-sflotf5hu53y",
+    "CSeq: 1 INVITE",
+    "Max-Forwards: 70",
+    "Contact: <sip:100@192.168.1.10:5060;line=x7d1f8q2>;reg-id=1",
+    "User-Agent: snom370/8.7.5.35",
+    "Accept: application/sdp",
+    "Allow: INVITE, ACK, CANCEL, BYE, REFER, OPTIONS, NOTIFY, SUBSCRIBE, PRACK, MESSAGE, INFO, UPDATE",
+    "Allow-Events: talk, hold, refer, call-info",
+    "Supported: timer, 100rel, replaces, from-change",
+    "Session-Expires: 3600",
+    "Min-SE: 90",
+    "Content-Type: application/sdp",
+    "Content-Length: %d" % len(INVITE_SDP),
+    "", INVITE_SDP])
+
+class NullSocket(object):
+    """Socket discarding the data sent
+    """
+
+    transport = "UDP"
+
+    def sendto(self, data, address):
+        return len(data)
+
+class Options(object):
+    """The SPLiT options used by the SIP server, with their default values
+    """
+
+    sip_redirect = False
+    sip_expires = 3600
+    sip_password = "protected"
+    sip_registrar_file = None
+    sip_credentials = None
+    sip_nonce_lifetime = 300
+    sip_exposed_ip = None
+    sip_exposed_port = None
+    sip_custom_headers = []
+    sip_no_record_route = False
+    authenticated_requests = []
+    sip_transaction_cache = 10000
+    sip_dialog_timeout = 3600
+    sip_tcp = False
+    sip_batch_size = 32
+    sip_threads = 0
+    sip_queue_size = 1000
+    sip_queue_full = "drop"
+    sip_overload_delay = 0
+    sip_overload_pending = 0
+    sip_pcap = None
+
+def instance(cls):
+    """An instance of `cls` without running its constructor
+    """
+    class Fixture(cls):
+        def __init__(self):
+            pass
+    return Fixture()
+
+def digest_authorization(server, username, realm, password, method, uri):
+    nonce = proxy.generateNonce(server.nonce_secret)
+    ha1 = proxy.hashlib.md5("%s:%s:%s" % (username, realm, password)).hexdigest()
+    ha2 = proxy.hashlib.md5("%s:%s" % (method, uri)).hexdigest()
+    response = proxy.hashlib.md5("%s:%s:%s" % (ha1, nonce, ha2)).hexdigest()
+    return 'Digest username="%s", realm="%s", nonce="%s", uri="%s", response="%s", algorithm=MD5' % (
+            username, realm, nonce, uri, response)
+
+def sip_server():
+    main_logger = utils.setup_logger('benchmark_main', os.devnull)
+    sip_logger = utils.setup_logger('benchmark_sip', os.devnull)
+    return proxy.SipTracedUDPServer(("127.0.0.1", 0), proxy.UDPHandler, sip_logger, main_logger, Options())
+
+def sip_handler(server, data):
+    """A request handler with the `data` message, without handling it
+    """
+    handler = instance(proxy.UDPHandler)
+    handler.server = server
+    handler.client_address = CLIENT
+    handler.socket = NullSocket()
+    handler.request = (data, handler.socket)
+    handler.msg = SipMessage(data)
+    return handler
+
+# the benchmarks: every function returns the callable to time
+
+def bench_sipmessage_parse(server):
+    return lambda: SipMessage(INVITE)
+
+def bench_sipmessage_serialize(server):
+    msg = SipMessage(INVITE)
+    return msg.serialize
+
+def bench_sipmessage_copy(server):
+    msg = SipMessage(INVITE)
+    return msg.copy
+
+def bench_add_top_via(server):
+    handler = sip_handler(server, INVITE)
+    template = handler.msg
+    def run():
+        handler.msg = template.copy()
+        handler.addTopVia()
+    return run
+
+def bench_remove_header(server):
+    handler = sip_handler(server, INVITE)
+    template = handler.msg
+    def run():
+        handler.msg = template.copy()
+        handler.removeHeader("Session-Expires")
+    return run
+
+def bench_send_response(server):
+    handler = sip_handler(server, INVITE)
+    return lambda: handler.sendResponse("486 Busy Here")
+
+def bench_process_code(server):
+    # a 200 OK to the INVITE forwarded by the proxy, sent to a null socket
+    view = instance(server.__class__)
+    view.__dict__.update(server.__dict__)
+    view.socket = NullSocket()
+    view.transactions = None
+    request = sip_handler(view, INVITE)
+    request.addTopVia()
+    handler = sip_handler(view, proxy.buildResponse(request.msg, "200 OK", CLIENT))
+    template = handler.msg
+    def run():
+        handler.msg = template.copy()
+        handler.processCode(None, None, "200")
+    return run
+
+def bench_process_register(server):
+    authorization = digest_authorization(server, "100", "dummy", "protected", "REGISTER", "sip:192.168.1.1")
+    handler = sip_handler(server, REGISTER % {'authorization': "Authorization: %s" % authorization})
+    template = handler.msg
+    def run():
+        handler.msg = template.copy()
+        handler.processRegister("REGISTER", "192.168.1.1", None)
+    return run
+
+def bench_check_authorization(server):
+    authorization = digest_authorization(server, "100", "dummy", "protected", "REGISTER", "sip:192.168.1.1")
+    handler = sip_handler(server, REGISTER % {'authorization': "Authorization: %s" % authorization})
+    credentials = authorization.split(" ", 1)[1]
+    return lambda: handler.checkAuthorization(credentials, "100@192.168.1.1")
+
+def dhcp_server(leases=100):
+    """A DHCP server with `leases` active leases, without socket
+    """
+    server = instance(dhcp.DHCPD)
+    server.ip = "192.168.1.1"
+    server.offerfrom = "192.168.1.100"
+    server.offerto = "192.168.1.250"
+    server.leases_file = os.devnull
+    server.magic = struct.pack('!I', 0x63825363)
+    server.logger = utils.setup_logger('benchmark_dhcp', os.devnull)
+    server.leases = defaultdict(dhcp.default_lease)
+    for i in range(leases):
+        mac = struct.pack('!HI', 0x0004, 0x13000000 + i)
+        server.leases[mac] = {'ip': "192.168.1.%d" % (100 + i % 150), 'expire': time.time() + 86400}
+    return server
+
+DHCP_OPTIONS = (
+    "\x35\x01\x01"                                      # message type: discover
+    "\x3d\x07\x01\x00\x04\x13\x00\x00\x01"              # client identifier
+    "\x37\x0c\x01\x03\x06\x0c\x0f\x1c\x2a\x42\x43\x78\x7a\x7d"  # parameter request list
+    "\x39\x02\x05\xdc"                                  # max message size
+    "\x3c\x0e" "snom370 8.7.5"  "\x00"                  # vendor class
+    "\x0c\x0f" "snom37000041300"                     # hostname
+    "\xff")
+
+def dhcp_discover(mac):
+    header = struct.pack('!BBBB4sHHIIII16s', 1, 1, 6, 0, "\x12\x34\x56\x78", 0, 0x8000, 0, 0, 0, 0, mac + "\x00" * 10)
+    return header + "\x00" * 192 + struct.pack('!I', 0x63825363) + DHCP_OPTIONS
+
+def bench_dhcp_next_ip(server):
+    server = dhcp_server()
+    return server.nextIP
+
+def bench_dhcp_tlv_parse(server):
+    server = dhcp_server()
+    return lambda: server.tlvParse(DHCP_OPTIONS)
+
+def bench_dhcp_craft_header(server):
+    server = dhcp_server()
+    # a client with a lease, the header of a new lease writes the leases file
+    message = dhcp_discover(struct.pack('!HI', 0x0004, 0x13000001))
+    return lambda: server.craftHeader(message)
+
+def bench_tftp_send_block(server):
+    fd, path = tempfile.mkstemp(prefix="benchmark-tftp-")
+    os.write(fd, os.urandom(1024 * 1024))
+    os.close(fd)
+    parent = instance(tftp.TFTPD)
+    parent.bytes_sent = 0
+    client = instance(tftp.Client)
+    client.parent = parent
+    client.sock = NullSocket()
+    client.address = CLIENT
+    client.fh = open(path, 'rb')
+    os.unlink(path)
+    client.blksize = 1432
+    client.block = 1
+    client.retries = 5
+    blocks = 1024 * 1024 / client.blksize
+    def run():
+        client.block = client.block % blocks + 1
+        client.send_block()
+    return run
+
+def bench_pcap_write(server):
+    writer = pcap.PcapWriter(os.devnull)
+    return lambda: writer.write(INVITE, CLIENT, ("127.0.0.1", 5060))
+
+benchmarks = [
+    ("sipmessage.parse", bench_sipmessage_parse),
+    ("sipmessage.serialize", bench_sipmessage_serialize),
+    ("sipmessage.copy", bench_sipmessage_copy),
+    ("proxy.addTopVia", bench_add_top_via),
+    ("proxy.removeHeader", bench_remove_header),
+    ("proxy.sendResponse", bench_send_response),
+    ("proxy.processCode", bench_process_code),
+    ("proxy.processRegister", bench_process_register),
+    ("proxy.checkAuthorization", bench_check_authorization),
+    ("dhcp.nextIP", bench_dhcp_next_ip),
+    ("dhcp.tlvParse", bench_dhcp_tlv_parse),
+    ("dhcp.craftHeader", bench_dhcp_craft_header),
+    ("tftp.send_block", bench_tftp_send_block),
+    ("pcap.write", bench_pcap_write),
+]
+
+def measure(function, repeat, min_time):
+    """Return the best time per call in microseconds and the loops per repeat,
+    the loops are calibrated so that a repeat lasts at least `min_time`
+    """
+    loops = 1
+    while True:
+        started = time.time()
+        for i in xrange(loops):
+            function()
+        elapsed = time.time() - started
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed
+    for i in range(repeat - 1):
+        started = time.time()
+        for i in xrange(loops):
+            function()
+        best = min(best, time.time() - started)
+    return best * 1e6 / loops, loops
+
+def run(options):
+    server = sip_server()
+    results = {}
+    for name, setup in benchmarks:
+        if options.filter and options.filter not in name:
+            continue
+        usec, loops = measure(setup(server), options.repeat, options.min_time)
+        results[name] = {'usec': round(usec, 3), 'loops': loops}
+        print >> sys.stderr, "%-28s %10.2f us" % (name, usec)
+    server.server_close()
+    return {
+        'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': options.repeat,
+        'results': results,
+    }
+
+def compare(baseline, current, threshold):
+    """Print the changes from `baseline` to `current`, return the regressions
+    """
+    regressions = []
+    print "%-28s %10s %10s %8s" % ("benchmark", "baseline", "current", "change")
+    for name, setup in benchmarks:
+        if name not in baseline['results'] or name not in current['results']:
+            continue
+        before = baseline['results'][name]['usec']
+        after = current['results'][name]['usec']
+        change = (after - before) * 100.0 / before if before else 0
+        flag = ""
+        if change > threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "faster"
+        print "%-28s %8.2fus %8.2fus %+7.1f%% %s" % (name, before, after, change, flag)
+    return regressions
+
+if __name__ == "__main__":
+    opt = optparse.OptionParser(usage="%prog run [-o RESULTS]\n       %prog compare BASELINE [RESULTS]")
+    opt.add_option('-o', dest='output', default=None,
+            help='Write the results (the baseline) to this JSON file')
+    opt.add_option('--repeat', dest='repeat', type='int', default=5,
+            help='Repeats of every benchmark, the best is kept (default: 5)')
+    opt.add_option('--min-time', dest='min_time', type='float', default=0.2,
+            help='Min seconds of a repeat (default: 0.2)')
+    opt.add_option('--filter', dest='filter', default=None,
+            help='Run only the benchmarks whose name contains FILTER')
+    opt.add_option('--threshold', dest='threshold', type='float', default=10,
+            help='Percent slowdown flagged as a regression by compare (default: 10)')
+    options, args = opt.parse_args(sys.argv[1:])
+
+    if not args or args[0] not in ("run", "compare") or (args[0] == "compare" and len(args) < 2):
+        opt.print_usage()
+        sys.exit(2)
+
+    if args[0] == "run":
+        results = run(options)
+        if options.output:
+            with open(options.output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            print json.dumps(results, indent=2, sort_keys=True)
+        sys.exit(0)
+
+    with open(args[1]) as f:
+        baseline = json.load(f)
+    if len(args) > 2:
+        with open(args[2]) as f:
+            current = json.load(f)
+    else:
+        current = run(options)
+        if options.output:
+            with open(options.output, "w") as f:
+                json.dump(current, f, indent=2, sort_keys=True)
+    regressions = compare(baseline, current, options.threshold)
+    if regressions:
+        print "%d regressions over %.0f%%: %s" % (len(regressions), options.threshold, ", ".join(regressions))
+        sys.exit(1)
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+SIP load generator for a running SPLiT, no external binaries needed.
+
+`--users` UACs and as many UASes are registered on the proxy (users 1XXXX
+and 2XXXX, answering the digest challenges with `--password`), then the UACs
+call the UASes at `--rate` calls per second for `--duration` seconds: every
+call is INVITE, 200, ACK, BYE, 200. The UASes answer every INVITE with a 200
+right away. All the UACs share a socket and all the UASes share another one,
+the proxy routes to them by registered user.
+
+The report gives the REGISTER and call rates, the success rate, the failures
+by reason and the latency percentiles of the registrations (challenge
+included), of the call setup (INVITE to 200) and of the whole call (INVITE to
+the 200 of the BYE). There are no retransmissions: a lost message makes the
+call fail after `--timeout` seconds.
+
+Example:
+
+    ./SPLiT.py -t -i 127.0.0.1 &
+    python tests/loadgen.py --proxy 127.0.0.1:5060 --users 100 --rate 200 --duration 30
+'''
+
+import collections
+import errno
+import hashlib
+import json
+import optparse
+import os
+import re
+import select
+import socket
+import sys
+import time
+
+rx_kv = re.compile('(\w+)="?([^",]*)"?')
+
+def percentile(values, p):
+    """Nearest rank percentile of the sorted `values`, None if empty
+    """
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def latency_stats(values):
+    """Percentiles of `values` (seconds) in milliseconds
+    """
+    values = sorted(values)
+    stats = {'count': len(values)}
+    for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)):
+        value = percentile(values, p)
+        stats[name] = None if value is None else round(value * 1000, 3)
+    return stats
+
+def parse(data):
+    """Return the start line, the first value of every header keyed by
+    lowercase name and the header lines
+    """
+    head = data.split("\r\n\r\n", 1)[0]
+    lines = head.split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers.setdefault(name.strip().lower(), value.strip())
+    return lines[0], headers, lines[1:]
+
+def header_lines(lines, *names):
+    names = tuple("%s:" % name.lower() for name in names)
+    return [line for line in lines if line.lower().startswith(names)]
+
+def digest(challenge, method, uri, username, password):
+    """Authorization header value answering the `challenge` header line
+    """
+    params = dict(rx_kv.findall(challenge))
+    md5 = lambda s: hashlib.md5(s).hexdigest()
+    ha1 = md5("%s:%s:%s" % (username, params.get('realm', ''), password))
+    ha2 = md5("%s:%s" % (method, uri))
+    response = md5("%s:%s:%s" % (ha1, params.get('nonce', ''), ha2))
+    return 'Digest username="%s", realm="%s", nonce="%s", uri="%s", response="%s", algorithm=MD5' % (
+            username, params.get('realm', ''), params.get('nonce', ''), uri, response)
+
+class Transaction(object):
+    """A REGISTER or a call in progress
+    """
+
+    def __init__(self, kind, call_id, user, peer, started, sock=None):
+        self.kind = kind
+        self.sock = sock
+        self.call_id = call_id
+        self.user = user
+        self.peer = peer
+        self.started = started
+        self.setup = None
+        self.cseq = 1
+        self.route = []
+        self.authenticated = False
+        self.done = False
+
+class LoadGenerator(object):
+
+    def __init__(self, options):
+        self.options = options
+        host, port = options.proxy.rsplit(":", 1)
+        self.proxy = (host, int(port))
+        self.domain = host
+        self.uac = self.bind(options.uac_port)
+        self.uas = self.bind(options.uas_port)
+        self.uac_address = self.uac.getsockname()
+        self.uas_address = self.uas.getsockname()
+        self.prefix = "lg%d" % os.getpid()
+        self.serial = 0
+        self.pending = {}
+        # transactions in start order, for the timeouts
+        self.started = collections.deque()
+        self.failures = collections.Counter()
+        self.register_latency = []
+        self.setup_latency = []
+        self.call_latency = []
+        self.calls_ok = 0
+        self.registered = 0
+
+    def bind(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        sock.bind((self.options.ip_address, port))
+        sock.setblocking(False)
+        return sock
+
+    def send(self, sock, data):
+        try:
+            sock.sendto(data, self.proxy)
+        except socket.error, e:
+            self.failures["send error: %s" % e.args[-1]] += 1
+
+    def new_call_id(self):
+        self.serial += 1
+        return "%s-%d" % (self.prefix, self.serial)
+
+    def branch(self):
+        self.serial += 1
+        return "z9hG4bK%s-%d" % (self.prefix, self.serial)
+
+    # REGISTER
+
+    def register_message(self, t, sock, authorization=None):
+        address = sock.getsockname()
+        lines = [
+            "REGISTER sip:%s SIP/2.0" % self.domain,
+            "Via: SIP/2.0/UDP %s:%d;branch=%s;rport" % (address[0], address[1], self.branch()),
+            "Max-Forwards: 70",
+            "From: <sip:%s@%s>;tag=%s" % (t.user, self.domain, t.call_id),
+            "To: <sip:%s@%s>" % (t.user, self.domain),
+            "Call-ID: %s" % t.call_id,
+            "CSeq: %d REGISTER" % t.cseq,
+            "Contact: <sip:%s@%s:%d>" % (t.user, address[0], address[1]),
+            "Expires: %d" % self.options.expires,
+        ]
+        if authorization:
+            lines.append("Authorization: %s" % authorization)
+        lines.append("Content-Length: 0")
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    def register(self, user, sock):
+        t = Transaction("REGISTER", self.new_call_id(), user, None, time.time(), sock)
+        self.pending[t.call_id] = t
+        self.started.append(t)
+        self.send(sock, self.register_message(t, sock))
+
+    def register_response(self, t, code, lines):
+        if code in ("401", "407") and not t.authenticated:
+            challenge = header_lines(lines, "WWW-Authenticate", "Proxy-Authenticate")
+            if challenge:
+                t.authenticated = True
+                t.cseq += 1
+                authorization = digest(challenge[0], "REGISTER", "sip:%s" % self.domain, t.user, self.options.password)
+                self.send(t.sock, self.register_message(t, t.sock, authorization))
+                return
+        self.finish(t)
+        if code == "200":
+            self.registered += 1
+            self.register_latency.append(time.time() - t.started)
+        else:
+            self.failures["REGISTER %s" % code] += 1
+
+    # calls
+
+    def invite_message(self, t, authorization=None):
+        sdp = ("v=0\r\no=- %d 1 IN IP4 %s\r\ns=-\r\nc=IN IP4 %s\r\nt=0 0\r\nm=audio 4000 RTP/AVP 0\r\n" %
+                (self.serial, self.uac_address[0], self.uac_address[0]))
+        lines = [
+            "INVITE sip:%s@%s SIP/2.0" % (t.peer, self.domain),
+            "Via: SIP/2.0/UDP %s:%d;branch=%s;rport" % (self.uac_address[0], self.uac_address[1], self.branch()),
+            "Max-Forwards: 70",
+            "From: <sip:%s@%s>;tag=%s" % (t.user, self.domain, t.call_id),
+            "To: <sip:%s@%s>" % (t.peer, self.domain),
+            "Call-ID: %s" % t.call_id,
+            "CSeq: %d INVITE" % t.cseq,
+            "Contact: <sip:%s@%s:%d>" % (t.user, self.uac_address[0], self.uac_address[1]),
+        ]
+        if authorization:
+            lines.append("Proxy-Authorization: %s" % authorization)
+        lines.append("Content-Type: application/sdp")
+        lines.append("Content-Length: %d" % len(sdp))
+        return "\r\n".join(lines) + "\r\n\r\n" + sdp
+
+    def in_dialog_message(self, t, method, cseq, to):
+        lines = [
+            "%s %s SIP/2.0" % (method, t.contact),
+            "Via: SIP/2.0/UDP %s:%d;branch=%s;rport" % (self.uac_address[0], self.uac_address[1], self.branch()),
+            "Max-Forwards: 70",
+        ]
+        lines.extend("Route: %s" % route for route in t.route)
+        lines.extend([
+            "From: <sip:%s@%s>;tag=%s" % (t.user, self.domain, t.call_id),
+            to,
+            "Call-ID: %s" % t.call_id,
+            "CSeq: %d %s" % (cseq, method),
+            "Content-Length: 0",
+        ])
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    def call(self, index):
+        users = self.options.users
+        t = Transaction("INVITE", self.new_call_id(), "1%04d" % (index % users), "2%04d" % (index % users), time.time())
+        self.pending[t.call_id] = t
+        self.started.append(t)
+        self.send(self.uac, self.invite_message(t))
+
+    def invite_response(self, t, code, headers, lines):
+        if code[0] == "1":
+            return
+        if code in ("401", "407") and not t.authenticated:
+            # ACK the challenge then send the INVITE again with the credentials
+            t.authenticated = True
+            self.send(self.uac, self.ack_failure(t, headers, lines))
+            challenge = header_lines(lines, "WWW-Authenticate", "Proxy-Authenticate")
+            if challenge:
+                t.cseq += 1
+                uri = "sip:%s@%s" % (t.peer, self.domain)
+                self.send(self.uac, self.invite_message(t, digest(challenge[0], "INVITE", uri, t.user, self.options.password)))
+                return
+        elif code[0] != "2":
+            self.send(self.uac, self.ack_failure(t, headers, lines))
+        if code[0] != "2":
+            self.failures["INVITE %s" % code] += 1
+            self.finish(t)
+            return
+        if t.setup is not None:
+            # 200 retransmission
+            return
+        now = time.time()
+        t.setup = now
+        self.setup_latency.append(now - t.started)
+        t.to = "To: %s" % headers.get('to', '')
+        contact = re.search("<([^>]*)>", headers.get('contact', '')) or re.search("(sip:\S+)", headers.get('contact', ''))
+        t.contact = contact.group(1) if contact else "sip:%s@%s" % (t.peer, self.domain)
+        t.route = [line.split(":", 1)[1].strip() for line in reversed(header_lines(lines, "Record-Route"))]
+        self.send(self.uac, self.in_dialog_message(t, "ACK", t.cseq, t.to))
+        self.send(self.uac, self.in_dialog_message(t, "BYE", t.cseq + 1, t.to))
+        t.kind = "BYE"
+
+    def ack_failure(self, t, headers, lines):
+        via = header_lines(lines, "Via")
+        result = [
+            "ACK sip:%s@%s SIP/2.0" % (t.peer, self.domain),
+            via[0] if via else "",
+            "Max-Forwards: 70",
+            "From: <sip:%s@%s>;tag=%s" % (t.user, self.domain, t.call_id),
+            "To: %s" % headers.get('to', ''),
+            "Call-ID: %s" % t.call_id,
+            "CSeq: %d ACK" % t.cseq,
+            "Content-Length: 0",
+        ]
+        return "\r\n".join(result) + "\r\n\r\n"
+
+    def bye_response(self, t, code):
+        self.finish(t)
+        if code == "200":
+            self.calls_ok += 1
+            self.call_latency.append(time.time() - t.started)
+        else:
+            self.failures["BYE %s" % code] += 1
+
+    def uas_request(self, data):
+        """Answer the requests received by the UASes: 200 to INVITE and BYE
+        """
+        start, headers, lines = parse(data)
+        method = start.split(" ", 1)[0]
+        if method == "ACK":
+            return
+        to = header_lines(lines, "To")
+        if method == "INVITE" and to and ";tag=" not in to[0]:
+            to = [to[0] + ";tag=uas-%s" % headers.get('call-id', '')]
+        uri = start.split(" ")[1]
+        response = ["SIP/2.0 200 OK"]
+        response.extend(header_lines(lines, "Via", "Record-Route", "From"))
+        response.extend(to)
+        response.extend(header_lines(lines, "Call-ID", "CSeq"))
+        if method == "INVITE":
+            user = uri[4:].split("@", 1)[0]
+            response.append("Contact: <sip:%s@%s:%d>" % (user, self.uas_address[0], self.uas_address[1]))
+        response.append("Content-Length: 0")
+        self.send(self.uas, "\r\n".join(response) + "\r\n\r\n")
+
+    def uac_response(self, data):
+        start, headers, lines = parse(data)
+        t = self.pending.get(headers.get('call-id'))
+        if t is None:
+            return
+        code = start.split(" ", 2)[1]
+        if t.kind == "REGISTER":
+            self.register_response(t, code, lines)
+        elif t.kind == "INVITE":
+            self.invite_response(t, code, headers, lines)
+        elif t.kind == "BYE" and headers.get('cseq', '').endswith("BYE"):
+            self.bye_response(t, code)
+
+    def read(self, sock):
+        while True:
+            try:
+                data, address = sock.recvfrom(65535)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.failures["receive error: %s" % e.args[-1]] += 1
+                return
+            if not data.startswith("SIP/2.0 "):
+                if sock is self.uas:
+                    self.uas_request(data)
+            else:
+                # REGISTER responses come on both sockets
+                self.uac_response(data)
+
+    def finish(self, t):
+        t.done = True
+        self.pending.pop(t.call_id, None)
+
+    def expire(self, now):
+        deadline = now - self.options.timeout
+        while self.started and (self.started[0].done or self.started[0].started < deadline):
+            t = self.started.popleft()
+            if not t.done:
+                self.failures["%s timeout" % t.kind] += 1
+                self.finish(t)
+
+    def poll(self, timeout):
+        try:
+            ready, _, _ = select.select([self.uac, self.uas], [], [], max(timeout, 0))
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for sock in ready:
+            self.read(sock)
+        self.expire(time.time())
+
+    def run_phase(self, count, rate, start):
+        """Call `start(index)` `count` times at `rate` per second, then wait
+        for the pending transactions, return the elapsed time
+        """
+        began = time.time()
+        sent = 0
+        while sent < count:
+            now = time.time()
+            due = min(count, int((now - began) * rate) + 1)
+            while sent < due:
+                start(sent)
+                sent += 1
+            self.poll(began + float(sent) / rate - time.time())
+        while self.pending:
+            self.poll(0.05)
+        return time.time() - began
+
+    def run(self):
+        options = self.options
+        users = ["1%04d" % i for i in range(options.users)] + ["2%04d" % i for i in range(options.users)]
+        register_time = self.run_phase(len(users), options.register_rate,
+                lambda i: self.register(users[i], self.uac if users[i][0] == "1" else self.uas))
+        calls = int(options.rate * options.duration)
+        call_time = 0
+        if self.registered == len(users):
+            call_time = self.run_phase(calls, options.rate, self.call)
+        return {
+            'registrations': len(users),
+            'registered': self.registered,
+            'register_rate': round(self.registered / register_time, 1) if register_time else 0,
+            'register_latency_ms': latency_stats(self.register_latency),
+            'calls': calls,
+            'calls_ok': self.calls_ok,
+            'success_rate': round(100.0 * self.calls_ok / calls, 2) if calls else 0,
+            'target_cps': options.rate,
+            'cps': round(self.calls_ok / call_time, 1) if call_time else 0,
+            'setup_latency_ms': latency_stats(self.setup_latency),
+            'call_latency_ms': latency_stats(self.call_latency),
+            'failures': dict(self.failures),
+        }
+
+def print_report(result):
+    print "Registrations: %(registered)d/%(registrations)d, %(register_rate).1f/s" % result
+    print "Calls:         %(calls_ok)d/%(calls)d ok (%(success_rate).2f%%), %(cps).1f cps (target %(target_cps)s)" % result
+    for name in ('register_latency_ms', 'setup_latency_ms', 'call_latency_ms'):
+        stats = result[name]
+        if stats['count']:
+            print "%-14s p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+                    name.replace('_latency_ms', ':').capitalize(), stats['p50'], stats['p90'], stats['p99'], stats['max'])
+    for reason, count in sorted(result['failures'].items()):
+        print "Failed:        %s: %d" % (reason, count)
+
+if __name__ == "__main__":
+    opt = optparse.OptionParser(usage="%prog [OPTIONS]")
+    opt.add_option('--proxy', dest='proxy', default='127.0.0.1:5060',
+            help='Address of the SPLiT proxy (default: 127.0.0.1:5060)')
+    opt.add_option('-i', dest='ip_address', default='127.0.0.1',
+            help='Local IP address of the UACs and UASes (default: 127.0.0.1)')
+    opt.add_option('--uac-port', dest='uac_port', type='int', default=0,
+            help='UDP port of the UACs (default: any)')
+    opt.add_option('--uas-port', dest='uas_port', type='int', default=0,
+            help='UDP port of the UASes (default: any)')
+    opt.add_option('--users', dest='users', type='int', default=50,
+            help='Number of UACs, and of UASes (default: 50)')
+    opt.add_option('--password', dest='password', default='protected',
+            help='Password of all the users (default: protected)')
+    opt.add_option('--expires', dest='expires', type='int', default=3600,
+            help='Registrations expires (default: 3600)')
+    opt.add_option('--register-rate', dest='register_rate', type='float', default=500,
+            help='REGISTER per second (default: 500)')
+    opt.add_option('--rate', dest='rate', type='float', default=100,
+            help='Target calls per second (default: 100)')
+    opt.add_option('--duration', dest='duration', type='float', default=10,
+            help='Seconds of calls (default: 10)')
+    opt.add_option('--timeout', dest='timeout', type='float', default=5,
+            help='Seconds after which a registration or call without answer fails (default: 5)')
+    opt.add_option('--json', dest='json', default=False, action='store_true',
+            help='Print the results as JSON')
+    options, args = opt.parse_args(sys.argv[1:])
+
+    result = LoadGenerator(options).run()
+    if options.json:
+        print json.dumps(result, indent=2, sort_keys=True)
+    else:
+        print_report(result)
+    sys.exit(0 if result['registered'] == result['registrations'] and result['calls_ok'] == result['calls'] else 1)
@@ -0,0 +1,123 @@
+#    Copyright 2015 Pietro Bertera <pietro@bertera.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import time
+
+# RFC 3261 timers
+T1 = 0.5
+TIMER_H = 64 * T1 # wait time for the ACK of an INVITE final response
+TIMER_J = 64 * T1 # wait time for the non-INVITE request retransmissions
+
+class TransactionCache(object):
+    """Last message sent for every recent request, keyed by transaction
+
+    A transaction is identified by the top Via branch, the method and the
+    source address of the request. The first time a request is handled the
+    message sent for it (the response or the forwarded request) is stored,
+    the retransmissions of the request are answered by sending it again.
+    When the final response of a forwarded request passes through the proxy
+    it replaces the forwarded request, so the retransmissions get the response.
+    Only the requests identical to the first one are retransmissions, a
+    different request reusing the branch is handled again.
+
+    The entries live `TIMER_H` (INVITE) or `TIMER_J` (other methods) seconds,
+    both timers have the same value so the entries expire in insertion order.
+    When `max_size` entries are stored the oldest ones are dropped.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        # (branch, method) -> key of the forwarded requests
+        self.forwarded = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.evicted = 0
+
+    def key(self, branch, method, source):
+        if not branch or not branch.startswith("z9hG4bK"):
+            # RFC 2543 branches are not unique
+            return None
+        return (branch, method, source)
+
+    def lookup(self, key, request, now=None):
+        """Return the ``(data, address, socket)`` sent for the `request` with
+        `key`, None if unknown
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now or entry[1] != request:
+                return None
+            self.hits += 1
+            return entry[2:]
+
+    def contains(self, key, request, now=None):
+        """True if `request` with `key` is a retransmission, without counting
+        it as a hit
+        """
+        if now is None:
+            now = time.time()
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] > now and entry[1] == request
+
+    def store(self, key, request, data, address, socket, forwarded=False, now=None):
+        """Remember that `data` was sent to `address` for the `key` request,
+        `forwarded` is True if `request` itself was forwarded
+        """
+        if now is None:
+            now = time.time()
+        lifetime = TIMER_H if key[1] == "INVITE" else TIMER_J
+        with self.lock:
+            self.expire(now)
+            self.entries.pop(key, None)
+            self.entries[key] = (now + lifetime, request, data, address, socket)
+            if forwarded:
+                self.forwarded[key[:2]] = key
+            while len(self.entries) > self.max_size:
+                old_key, entry = self.entries.popitem(last=False)
+                self.forwarded.pop(old_key[:2], None)
+                self.evicted += 1
+
+    def complete(self, branch, method, data, address, socket):
+        """Store the final response `data` of a forwarded request
+        """
+        with self.lock:
+            key = self.forwarded.pop((branch, method), None)
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            self.entries[key] = (entry[0], entry[1], data, address, socket)
+            return True
+
+    def expire(self, now):
+        # called with the lock held
+        while self.entries:
+            key, entry = next(self.entries.iteritems())
+            if entry[0] > now:
+                break
+            del self.entries[key]
+            if self.forwarded.get(key[:2]) == key:
+                del self.forwarded[key[:2]]
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'evicted': self.evicted,
+        }
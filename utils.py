@@ -16,9 +16,19 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import bisect
 import logging
+import os
+import threading
+import time
+import Queue
+import SocketServer
 
-def setup_logger(logger_name, log_file=None, debug=False, str_format='%(asctime)s %(levelname)s %(message)s', handler=None):
+# the alphanumeric chars are dumped as they are, the others as a dot
+dump_chars = "".join(c if c.isalnum() else "." for c in map(chr, range(256)))
+
+def setup_logger(logger_name, log_file=None, debug=False, str_format='%(asctime)s %(levelname)s %(message)s', handler=None, flush_interval=0, queue_size=10000):
     """Register a logging instance with name `logger_name`
 
     Args:
@@ -27,6 +37,9 @@ def setup_logger(logger_name, log_file=None, debug=False, str_format='%(asctime)
         debug (bool, optional): if `True` the logger level will be `logging.DEBUG` else `logging.INFO`
         str_format (str, optional): the logger format string, default is '%(asctime)s %(levelname)s %(message)s'
         handler (logging.Handler, optional): if present the handler will be added to the logger
+        flush_interval (float, optional): if greater than 0 the file or stream is written by an `AsyncLogHandler`
+            thread every `flush_interval` seconds, default 0 (write synchronously)
+        queue_size (int, optional): max number of records waiting for the `AsyncLogHandler` writer
 
     Returns: the ``logging.Logger` instance
     """
@@ -45,10 +58,292 @@ def setup_logger(logger_name, log_file=None, debug=False, str_format='%(asctime)
     elif log_file:
         fileHandler = logging.FileHandler(log_file, mode='w')
         fileHandler.setFormatter(formatter)
-        l.addHandler(fileHandler)
+        target = fileHandler
     else: 
         streamHandler = logging.StreamHandler()
         streamHandler.setFormatter(formatter)
-        l.addHandler(streamHandler)
+        target = streamHandler
+
+    if flush_interval > 0:
+        target = AsyncLogHandler(target, flush_interval, queue_size, name="%s-writer" % logger_name)
+    l.addHandler(target)
 
     return l
+
+class AsyncLogHandler(logging.Handler):
+    """Log handler writing the records of `target` from a background thread
+
+    `emit()` only puts the record in a bounded queue, when the queue is full
+    the record is dropped and counted. The writer thread formats the queued
+    records and writes them to the `target` stream in a single write,
+    then flushes it at most every `flush_interval` seconds.
+    """
+
+    def __init__(self, target, flush_interval=0.5, queue_size=10000, name="log-writer"):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.name = name
+        self.max_depth = 0
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.written = 0
+        self.writer = None
+        self.start()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.records = Queue.Queue(self.queue_size)
+        self.writer = threading.Thread(name=self.name, target=self.write_records)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            # forked: the writer thread is left in the parent process
+            self.start()
+        try:
+            self.records.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            return
+        depth = self.records.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def write_records(self):
+        records = self.records
+        running = True
+        while running:
+            deadline = time.time() + self.flush_interval
+            batch = []
+            while True:
+                try:
+                    record = records.get(timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if record is None:
+                    running = False
+                    break
+                batch.append(record)
+                if time.time() >= deadline:
+                    break
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.target.format(record))
+            except Exception:
+                self.handleError(record)
+        dropped = self.dropped
+        if dropped > self.reported_dropped:
+            lines.append("Log queue full: %d records dropped" % (dropped - self.reported_dropped))
+            self.reported_dropped = dropped
+        if not lines:
+            return
+        self.target.acquire()
+        try:
+            self.target.stream.write("\n".join(lines) + "\n")
+            self.target.flush()
+        except Exception:
+            pass
+        finally:
+            self.target.release()
+        self.written += len(batch)
+
+    def stats(self):
+        """Return the queue depth and the written and dropped records count
+        """
+        return {
+            'queue_size': self.queue_size,
+            'queue_depth': self.records.qsize(),
+            'queue_max_depth': self.max_depth,
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+    def close(self):
+        """Write the queued records and stop the writer thread
+        """
+        if self.writer is not None and self.writer.is_alive() and self.pid == os.getpid():
+            self.records.put(None)
+            self.writer.join(5)
+        self.writer = None
+        self.target.close()
+        logging.Handler.close(self)
+
+def is_keepalive(data):
+    """True for the NAT keep-alives: the CRLF pings (RFC 5626) and the
+    probes of at most 4 bytes
+    """
+    return len(data) <= 4 or not data.strip("\r\n")
+
+def hexdump(chars, sep=' ', width=16):
+    """Dump chars in hex and ascii format, `width` chars per line
+    """
+    if not chars:
+        return []
+    chars = chars.ljust((len(chars) + width - 1) // width * width, '\000')
+    hexa = binascii.hexlify(chars)
+    text = chars.translate(dump_chars)
+    # the hex digits of a line, two by two, followed by the separator
+    line = ("%s%s" + sep.replace("%", "%%")) * width + "%s"
+    return [line % (tuple(hexa[2 * i:2 * (i + width)]) + (text[i:i + width],)) for i in range(0, len(chars), width)]
+
+class RateLimit(object):
+    """Token bucket allowing `rate` events per second, with bursts of `burst`
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.time()
+        self.suppressed = 0
+
+    def allow(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.suppressed += 1
+        return False
+
+    def take_suppressed(self):
+        """Return the number of events suppressed since the last call
+        """
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+class Histogram(object):
+    """Count of the observed values per bucket
+
+    A value is counted in the first bucket whose upper bound is greater or
+    equal to it, the last bucket has no upper bound.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def buckets(self):
+        """Return the ``(upper_bound, count)`` pairs, the last bound is None
+        """
+        return zip(self.bounds + [None], self.counts)
+
+    def __str__(self):
+        buckets = []
+        for bound, count in self.buckets():
+            if bound is None:
+                buckets.append(">%s: %d" % (self.bounds[-1], count))
+            else:
+                buckets.append("<=%s: %d" % (bound, count))
+        return ", ".join(buckets)
+
+class WorkerPoolMixIn(SocketServer.ThreadingMixIn):
+    """Mix-in class to handle the requests in a fixed pool of worker threads
+
+    Requests are fed to the workers through a bounded queue. Until
+    `start_workers()` is called the class behaves like `SocketServer.ThreadingMixIn`
+    and spawns a new thread for each request.
+    """
+
+    workers = 0
+    queue_full_policy = "drop"
+
+    def start_workers(self, workers, queue_size, queue_full_policy="drop", name="worker"):
+        """Start the worker pool
+
+        Args:
+            workers (int): number of worker threads, if 0 a thread per request is used
+            queue_size (int): max number of requests waiting for a worker
+            queue_full_policy (str): "drop" to silently discard the requests when the queue is full,
+                "503" to pass them to `reject_request()`
+            name (str): the worker threads name prefix
+        """
+        self.workers = workers
+        self.queue_full_policy = queue_full_policy
+        self.requests_queue = Queue.Queue(queue_size)
+        self.queue_max_depth = 0
+        self.queue_dropped = 0
+        self.queue_rejected = 0
+        self.queue_last_warning = 0
+        self.worker_threads = []
+        for i in range(workers):
+            t = threading.Thread(name="%s-%d" % (name, i), target=self.process_queue)
+            t.daemon = True
+            t.start()
+            self.worker_threads.append(t)
+
+    def process_queue(self):
+        while True:
+            item = self.requests_queue.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.workers:
+            return SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        try:
+            self.requests_queue.put_nowait((request, client_address))
+        except Queue.Full:
+            if self.queue_full_policy == "503":
+                self.queue_rejected += 1
+                self.reject_request(request, client_address)
+            else:
+                self.queue_dropped += 1
+            self.shutdown_request(request)
+            now = time.time()
+            if now - self.queue_last_warning > 10:
+                self.queue_last_warning = now
+                self.main_logger.warning("Worker queue full (%d requests): %d dropped, %d rejected so far" %
+                        (self.requests_queue.qsize(), self.queue_dropped, self.queue_rejected))
+            return
+        depth = self.requests_queue.qsize()
+        if depth > self.queue_max_depth:
+            self.queue_max_depth = depth
+
+    def reject_request(self, request, client_address):
+        """Called for the requests not queued because the queue is full and the policy is "503",
+        the default implementation drops the request
+        """
+        pass
+
+    def pool_stats(self):
+        """Return the worker pool statistics as a dict
+        """
+        if not self.workers:
+            return {'workers': 0}
+        return {
+            'workers': self.workers,
+            'queue_size': self.requests_queue.maxsize,
+            'queue_depth': self.requests_queue.qsize(),
+            'queue_max_depth': self.queue_max_depth,
+            'dropped': self.queue_dropped,
+            'rejected': self.queue_rejected,
+        }
+
+    def stop_workers(self):
+        """Stop the worker threads once the queued requests are processed
+        """
+        for t in getattr(self, 'worker_threads', []):
+            self.requests_queue.put(None)
+        self.worker_threads = []